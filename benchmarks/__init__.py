@@ -0,0 +1,5 @@
+"""
+Benchmarks for the DISCO inference and data pipelines.
+
+Run with ``python -m benchmarks``. See benchmarks/README.md for details.
+"""
@@ -0,0 +1,144 @@
+"""
+Run the benchmark suite: ``python -m benchmarks --help``.
+"""
+import os
+
+# the benchmarks are defined on CPU so numbers are comparable across machines.
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import logging
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from benchmarks.results import (
+    compare_to_baseline,
+    environment,
+    format_comparison,
+    load_results,
+    save_results,
+    time_callable,
+)
+from benchmarks.stages import STAGES, random_ensemble
+from benchmarks.synthetic import write_synthetic_recording
+
+logger = logging.getLogger("benchmarks")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Time each stage of the DISCO pipeline on a synthetic recording.",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=300, help="recording length (s)"
+    )
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--n-models", type=int, default=2, help="ensemble size")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--stages",
+        nargs="*",
+        default=None,
+        choices=list(STAGES),
+        help="stages to time (default: all)",
+    )
+    parser.add_argument(
+        "--workdir", default=None, help="scratch directory (default: a temp dir)"
+    )
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--baseline", default=None, help="results file to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed fractional slowdown relative to the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def run_benchmarks(args, workdir):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    wav_file, csv_file = write_synthetic_recording(
+        os.path.join(workdir, "recordings"),
+        args.duration,
+        sample_rate=args.sample_rate,
+        seed=args.seed,
+    )
+    ctx = SimpleNamespace(
+        workdir=workdir,
+        wav_file=wav_file,
+        csv_file=csv_file,
+        sample_rate=args.sample_rate,
+        duration=args.duration,
+        batch_size=args.batch_size,
+        seed=args.seed,
+        ensemble=random_ensemble(args.n_models, seed=args.seed),
+        outputs={},
+    )
+
+    timings = {}
+    for name in args.stages or list(STAGES):
+        logger.info(f"Timing stage {name}.")
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        fn = STAGES[name](ctx)
+        timings[name], ctx.outputs[name] = time_callable(fn, repeats=args.repeats)
+        if hasattr(fn, "items"):
+            timings[name]["items"] = fn.items
+            timings[name]["items_per_s"] = fn.items / timings[name]["median_s"]
+        timings[name].update(getattr(fn, "extra", {}))
+        logger.info(f"{name}: {timings[name]['median_s']:.4f}s (median)")
+
+    config = {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}
+    return {"config": config, "environment": environment(), "stages": timings}
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    args = parse_args(argv)
+
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(args, workdir)
+    else:
+        results = run_benchmarks(args, args.workdir)
+
+    save_results(results, args.output)
+    logger.info(f"Saved results to {args.output}.")
+
+    if args.baseline is None:
+        return 0
+
+    baseline = load_results(args.baseline)
+    for key in ("duration", "sample_rate", "n_models", "batch_size"):
+        if baseline["config"].get(key) != results["config"][key]:
+            logger.warning(
+                f"Baseline was run with {key}={baseline['config'].get(key)}, "
+                f"this run used {key}={results['config'][key]}."
+            )
+
+    rows, regressions = compare_to_baseline(results, baseline, args.tolerance)
+    print(format_comparison(rows, args.tolerance))
+    if regressions:
+        print(f"{len(regressions)} stage(s) regressed: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
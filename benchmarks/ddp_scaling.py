@@ -0,0 +1,184 @@
+"""
+Measure how UNet1D training throughput scales from 1 to N CPU processes with DDP on gloo, on one machine:
+``python -m benchmarks.ddp_scaling --help``.
+"""
+import os
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import json
+import logging
+import socket
+import tempfile
+import time
+from glob import glob
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import torch.multiprocessing
+
+import disco_sound.cfg as cfg
+from benchmarks.results import environment, save_results
+from disco_sound import make_dataloader
+from disco_sound.datasets.beetles_data import SpectrogramDatasetMultiLabel
+from disco_sound.distributed import (
+    distributed_trainer_args,
+    is_distributed,
+    rank_and_world_size,
+    shard_dataset_args,
+)
+from disco_sound.models.unet_1d import UNet1D
+
+logger = logging.getLogger("benchmarks")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.ddp_scaling",
+        description="Time UNet1D training epochs on 1 to N DDP processes on the CPU.",
+    )
+    parser.add_argument("train_directory", help="directory of extracted .pkl files")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--epochs", type=int, default=3, help="the first is warmup")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--n-buckets", type=int, default=10)
+    parser.add_argument("--bootstrap-sample", action="store_true")
+    parser.add_argument("--vertical-trim", type=int, default=20)
+    parser.add_argument(
+        "--num-threads", type=int, default=1, help="torch threads per process"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="ddp_scaling.json")
+    return parser.parse_args(argv)
+
+
+class _EpochTimer(pl.Callback):
+    def __init__(self):
+        self.epoch_s = []
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._begin = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self.epoch_s.append(time.perf_counter() - self._begin)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run_process(local_rank, args, processes, port, result_path):
+    # the environment Lightning gives processes it launches, so it doesn't launch more
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        NODE_RANK="0",
+        LOCAL_RANK=str(local_rank),
+        WORLD_SIZE=str(processes),
+    )
+    torch.set_num_threads(args.num_threads)
+    trainer_args = {
+        "accelerator": "cpu",
+        "devices": processes,
+        "strategy": "ddp" if processes > 1 else None,
+        "max_epochs": args.epochs,
+    }
+    dataset_args = {
+        "files": sorted(glob(os.path.join(args.train_directory, "*.pkl"))),
+        "vertical_trim": args.vertical_trim,
+        "bootstrap_sample": args.bootstrap_sample,
+    }
+    if is_distributed(trainer_args):
+        rank, world_size = rank_and_world_size(trainer_args)
+        dataset_args = shard_dataset_args(
+            "SpectrogramDatasetMultiLabel",
+            dataset_args,
+            rank,
+            world_size,
+            seed=args.seed,
+        )
+        trainer_args = distributed_trainer_args(trainer_args)
+    else:
+        trainer_args.pop("strategy")
+
+    dataset = SpectrogramDatasetMultiLabel(**dataset_args)
+    dataloader = make_dataloader(
+        dataset,
+        {"batch_size": args.batch_size, "shuffle": True, "n_buckets": args.n_buckets},
+    )
+    torch.manual_seed(args.seed)
+    model = UNet1D(
+        in_channels=dataset[0][0].shape[0],
+        out_channels=len(set(cfg.class_code_to_name)),
+        learning_rate=1e-3,
+        mask_character=cfg.mask_flag,
+    )
+    timer = _EpochTimer()
+    trainer = pl.Trainer(
+        **trainer_args,
+        callbacks=[timer],
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(model, train_dataloaders=dataloader)
+
+    if local_rank == 0:
+        with open(result_path, "w") as dst:
+            json.dump(
+                {
+                    "examples_per_process": len(dataset),
+                    "steps_per_epoch": len(dataloader),
+                    "epoch_s": timer.epoch_s,
+                },
+                dst,
+            )
+
+
+def time_processes(args, processes):
+    """
+    :return: dict. Epoch times of training on :param processes: processes, and the examples per second after the
+    first (warmup) epoch.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        result_path = os.path.join(directory, "result.json")
+        torch.multiprocessing.start_processes(
+            _run_process,
+            args=(args, processes, _free_port(), result_path),
+            nprocs=processes,
+            start_method="spawn",
+        )
+        with open(result_path) as src:
+            result = json.load(src)
+    epoch_s = float(np.median(result["epoch_s"][1:] or result["epoch_s"]))
+    result["examples_per_s"] = result["examples_per_process"] * processes / epoch_s
+    return result
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    results = {"config": vars(args), "environment": environment(), "processes": {}}
+    for processes in args.processes:
+        results["processes"][processes] = time_processes(args, processes)
+
+    # scaling relative to the fewest processes timed, per process
+    base = min(args.processes)
+    base_throughput = results["processes"][base]["examples_per_s"] / base
+    for processes, result in results["processes"].items():
+        result["efficiency"] = result["examples_per_s"] / (base_throughput * processes)
+        logger.info(
+            f"{processes} processes: {result['examples_per_s']:.1f} examples/s, "
+            f"{result['steps_per_epoch']} steps per epoch, efficiency {result['efficiency']:.2f}."
+        )
+    save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Timing, storage and baseline comparison of benchmark results.
+"""
+import json
+import platform
+import statistics
+import time
+
+import numpy as np
+import torch
+
+
+def time_callable(fn, repeats, warmup=1):
+    """
+    Time a zero-argument callable.
+    :param fn: The callable to time.
+    :param repeats: int. Number of timed calls.
+    :param warmup: int. Number of untimed calls made before timing.
+    :return: tuple (dict, object). Timing summary and the return value of the last call.
+    """
+    result = None
+    for _ in range(warmup):
+        result = fn()
+
+    times = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - begin)
+
+    summary = {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "mean_s": statistics.mean(times),
+        "repeats": repeats,
+    }
+    return summary, result
+
+
+def environment():
+    """
+    :return: dict describing the machine and library versions the benchmarks ran with.
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "torch_num_threads": torch.get_num_threads(),
+    }
+
+
+def save_results(results, path):
+    with open(path, "w") as dst:
+        json.dump(results, dst, indent=2)
+
+
+def load_results(path):
+    with open(path, "r") as src:
+        return json.load(src)
+
+
+def compare_to_baseline(results, baseline, tolerance, key="median_s"):
+    """
+    Compare stage timings against a baseline.
+    :param results: dict. Output of a benchmark run.
+    :param baseline: dict. Output of a previous benchmark run.
+    :param tolerance: float. Allowed fractional slowdown (0.2 allows a stage to be 20% slower than the baseline).
+    :param key: Which timing statistic to compare.
+    :return: tuple (list, list). Rows of (stage, baseline, current, ratio) for every compared stage, and the
+    names of the stages that regressed.
+    """
+    rows = []
+    regressions = []
+    for name, timing in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        old = baseline["stages"][name][key]
+        new = timing[key]
+        ratio = new / old if old > 0 else float("inf")
+        rows.append((name, old, new, ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return rows, regressions
+
+
+def format_comparison(rows, tolerance):
+    lines = [f"{'stage':<32}{'baseline (s)':>14}{'current (s)':>14}{'ratio':>8}"]
+    for name, old, new, ratio in rows:
+        flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+        lines.append(f"{name:<32}{old:>14.4f}{new:>14.4f}{ratio:>8.2f}{flag}")
+    return "\n".join(lines)
@@ -0,0 +1,524 @@
+"""
+Benchmark stages. Each stage is registered with the @stage decorator and receives the shared benchmark context.
+A stage does its (untimed) setup and returns a zero-argument callable; only that callable is timed.
+Whatever the callable returns is stored in ``ctx.outputs`` under the stage name for use by later stages.
+If the callable has an ``items`` attribute (ex: number of samples it processes), throughput is reported too, and
+any ``extra`` dict attribute is copied into the stage's results.
+"""
+import logging
+import os
+import shutil
+import time
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import torch
+import torchaudio
+
+import disco_sound.cfg as cfg
+import disco_sound.util.heuristics as heuristics
+import disco_sound.util.inference_utils as infer
+from disco_sound.datasets.beetles_data import (
+    PadCollate,
+    ShardedSpectrogramDataset,
+    SpectrogramDatasetMultiLabel,
+    SpectrogramIterator,
+)
+from disco_sound.datasets.whale_data import WhaleDataset
+from disco_sound.models.unet_1d import UNet1D
+from disco_sound.util.compiled_inference import compile_ensemble
+from disco_sound.util.extract_data import extract_single_file
+from disco_sound.util.receptive_field import retile_for_models, seam_error
+from disco_sound.util.samplers import BucketBatchSampler, padding_efficiency
+from disco_sound.util.shards import convert_pickles
+from disco_sound.util.util import add_gaussian_beeps
+
+logger = logging.getLogger(__name__)
+
+STAGES = {}
+
+spectrogram_args = {
+    "tile_size": 1024,
+    "tile_overlap": 128,
+    "vertical_trim": 20,
+    "n_fft": 1150,
+    "hop_length": 200,
+    "log_spect": True,
+    "mel_transform": True,
+}
+
+augmentations = {
+    "AddNoise": {"snr": (10, 40)},
+    "AddBeeps": {},
+    "TimeMask": {"n_masks": 2},
+    "FrequencyMask": {"n_masks": 2},
+}
+
+
+def stage(name):
+    """
+    Register a benchmark stage under :param name:. Stages run in registration order.
+    """
+
+    def decorator(fn):
+        STAGES[name] = fn
+        return fn
+
+    return decorator
+
+
+def require(ctx, name):
+    """
+    Get the output of the stage :param name:, running it untimed if it hasn't been run yet.
+    """
+    if name not in ctx.outputs:
+        logger.info(f"Running stage {name} (untimed) to satisfy a dependency.")
+        ctx.outputs[name] = STAGES[name](ctx)()
+    return ctx.outputs[name]
+
+
+def random_ensemble(n_models, in_channels=108, out_channels=3, seed=0):
+    """
+    Randomly initialized UNet1D ensemble in eval mode.
+    """
+    models = []
+    for i in range(n_models):
+        torch.manual_seed(seed + i)
+        model = UNet1D(
+            in_channels=in_channels,
+            out_channels=out_channels,
+            learning_rate=1e-3,
+            mask_character=cfg.mask_flag,
+        )
+        models.append(model.eval())
+    return models
+
+
+@stage("resample")
+def resample(ctx):
+    n_samples = int(ctx.duration * ctx.sample_rate)
+
+    def run():
+        return infer.load_wav_file(ctx.wav_file, sample_rate=44100)
+
+    run.items = n_samples
+    return run
+
+
+@stage("spectrogram_iterator")
+def spectrogram_iterator(ctx):
+    return lambda: SpectrogramIterator(wav_file=ctx.wav_file, **spectrogram_args)
+
+
+@stage("predict_with_ensemble")
+def predict_with_ensemble(ctx):
+    dataset = require(ctx, "spectrogram_iterator")
+    dataloader = torch.utils.data.DataLoader(
+        dataset, shuffle=False, batch_size=ctx.batch_size, drop_last=False
+    )
+    batches = list(dataloader)
+
+    def run():
+        return [infer.predict_with_ensemble(ctx.ensemble, b) for b in batches]
+
+    return run
+
+
+@stage("compiled_inference")
+def compiled_inference(ctx):
+    dataset = require(ctx, "spectrogram_iterator")
+    eager_preds = require(ctx, "predict_with_ensemble")
+    dataloader = torch.utils.data.DataLoader(
+        dataset, shuffle=False, batch_size=ctx.batch_size, drop_last=False
+    )
+    batches = list(dataloader)
+    tile_shape = (ctx.batch_size,) + tuple(batches[0].shape[1:])
+
+    begin = time.perf_counter()
+    compiled = compile_ensemble(
+        ctx.ensemble,
+        tile_shape,
+        cache_directory=os.path.join(ctx.workdir, "compiled"),
+    )
+    compile_s = time.perf_counter() - begin
+
+    def run():
+        return [infer.predict_with_ensemble(compiled, b) for b in batches]
+
+    max_abs_diff = max(
+        float((compiled_batch - eager_batch).abs().max())
+        for compiled_batch, eager_batch in zip(run(), eager_preds)
+    )
+    if max_abs_diff > 1e-4:
+        raise ValueError(f"Compiled and eager outputs differ by up to {max_abs_diff}.")
+
+    run.extra = {"compile_s": compile_s, "max_abs_diff": max_abs_diff}
+    return run
+
+
+@stage("seamless_tiles")
+def seamless_tiles(ctx):
+    dataset = SpectrogramIterator(
+        wav_file=ctx.wav_file, **dict(spectrogram_args, tile_overlap="auto")
+    )
+    begin = time.perf_counter()
+    retile_for_models(dataset, ctx.ensemble)
+    tiling_s = time.perf_counter() - begin
+    dataloader = torch.utils.data.DataLoader(
+        dataset, shuffle=False, batch_size=ctx.batch_size, drop_last=False
+    )
+    batches = list(dataloader)
+
+    def run():
+        return [infer.predict_with_ensemble(ctx.ensemble, b) for b in batches]
+
+    run.extra = {
+        "tile_size": dataset.tile_size,
+        "tile_overlap": dataset.tile_overlap,
+        "tiles": len(dataset),
+        "tiling_s": tiling_s,
+        "seam_error": max(
+            seam_error(model, dataset, ctx.batch_size) for model in ctx.ensemble
+        ),
+    }
+    return run
+
+
+@stage("calculate_ensemble_statistics")
+def calculate_ensemble_statistics(ctx):
+    overlap = spectrogram_args["tile_overlap"]
+    ensemble_preds = [
+        batch_preds[..., overlap:-overlap]
+        for batch_preds in require(ctx, "predict_with_ensemble")
+    ]
+
+    def run():
+        return [infer.calculate_ensemble_statistics(p) for p in ensemble_preds]
+
+    return run
+
+
+@stage("smooth_predictions_with_hmm")
+def smooth_predictions_with_hmm(ctx):
+    medians = torch.cat(
+        [m for _, m, _, _ in require(ctx, "calculate_ensemble_statistics")]
+    )
+    medians = torch.cat(tuple(medians), dim=-1).numpy()
+    predictions = np.argmax(medians, axis=0).squeeze()
+
+    return lambda: infer.smooth_predictions_with_hmm(
+        predictions,
+        cfg.hmm_transition_probabilities,
+        cfg.hmm_emission_probabilities,
+        cfg.hmm_start_probabilities,
+    )
+
+
+@stage("apply_heuristics")
+def apply_heuristics(ctx):
+    hmm_predictions = require(ctx, "smooth_predictions_with_hmm")
+    iqrs = torch.cat(
+        [i for i, _, _, _ in require(ctx, "calculate_ensemble_statistics")]
+    )
+    iqrs = torch.cat(tuple(iqrs), dim=-1).numpy()
+    pipeline = [
+        *heuristics.DEFAULT_HEURISTICS,
+        {"name": "merge_gaps", "max_gap": 10},
+        {"name": "drop_high_iqr", "max_iqr": 0.5},
+    ]
+
+    return lambda: heuristics.apply_heuristics(
+        hmm_predictions, pipeline, cfg.name_to_class_code, iqr=iqrs
+    )
+
+
+@stage("save_csv_from_predictions")
+def save_csv_from_predictions(ctx):
+    hmm_predictions = require(ctx, "smooth_predictions_with_hmm")
+    output_csv_path = os.path.join(ctx.workdir, "predictions", "detected.csv")
+
+    return lambda: infer.save_csv_from_predictions(
+        output_csv_path,
+        hmm_predictions.copy(),
+        sample_rate=ctx.sample_rate,
+        hop_length=spectrogram_args["hop_length"],
+        name_to_class_code=cfg.name_to_class_code,
+    )
+
+
+@stage("extract_single_file")
+def extract(ctx):
+    output_data_path = os.path.join(ctx.workdir, "extracted")
+
+    def run():
+        extract_single_file(
+            csv_file=ctx.csv_file,
+            wav_file=ctx.wav_file,
+            seed=ctx.seed,
+            no_mel_scale=False,
+            n_fft=spectrogram_args["n_fft"],
+            output_data_path=output_data_path,
+            overwrite=True,
+            snr=0,
+            add_beeps=False,
+            class_code_to_name=cfg.class_code_to_name,
+            name_to_class_code=cfg.name_to_class_code,
+            excluded_classes=("Y", "C"),
+        )
+        return sorted(glob(os.path.join(output_data_path, "*.pkl")))
+
+    return run
+
+
+@stage("dataset_init")
+def dataset_init(ctx):
+    files = require(ctx, "extract_single_file")
+
+    def run():
+        return SpectrogramDatasetMultiLabel(
+            files, vertical_trim=spectrogram_args["vertical_trim"]
+        )
+
+    run.items = len(files)
+    return run
+
+
+@stage("dataset_getitem")
+def dataset_getitem(ctx):
+    dataset = SpectrogramDatasetMultiLabel(
+        require(ctx, "extract_single_file"),
+        vertical_trim=spectrogram_args["vertical_trim"],
+    )
+
+    def run():
+        return [dataset[i] for i in range(len(dataset))]
+
+    run.items = len(dataset)
+    return run
+
+
+@stage("dataset_collate")
+def dataset_collate(ctx):
+    dataset = SpectrogramDatasetMultiLabel(
+        require(ctx, "extract_single_file"),
+        vertical_trim=spectrogram_args["vertical_trim"],
+    )
+    examples = [dataset[i] for i in range(len(dataset))]
+    batches = [
+        examples[i : i + ctx.batch_size]
+        for i in range(0, len(examples), ctx.batch_size)
+    ]
+    # reused buffers, as make_dataloader gives the Trainer; run()'s batches alias each other, which is fine as
+    # they're only timed
+    collate_fn = PadCollate(mask_flag=dataset.mask_flag, n_buffers=5)
+
+    def run():
+        return [collate_fn(batch) for batch in batches]
+
+    run.items = len(dataset)
+    run.extra = {
+        "padding_efficiency": padding_efficiency(
+            dataset.lengths(),
+            [
+                range(i, min(i + ctx.batch_size, len(dataset)))
+                for i in range(0, len(dataset), ctx.batch_size)
+            ],
+        )
+    }
+    return run
+
+
+@stage("bucketed_collate")
+def bucketed_collate(ctx):
+    dataset = SpectrogramDatasetMultiLabel(
+        require(ctx, "extract_single_file"),
+        vertical_trim=spectrogram_args["vertical_trim"],
+    )
+    sampler = BucketBatchSampler(dataset.lengths(), ctx.batch_size)
+    batches = [[dataset[i] for i in batch] for batch in sampler]
+    # reused buffers, as make_dataloader gives the Trainer; run()'s batches alias each other, which is fine as
+    # they're only timed
+    collate_fn = PadCollate(mask_flag=dataset.mask_flag, n_buffers=5)
+
+    def run():
+        return [collate_fn(batch) for batch in batches]
+
+    run.items = len(dataset)
+    run.extra = {"padding_efficiency": sampler.padding_efficiency}
+    return run
+
+
+@stage("augment")
+def augment(ctx):
+    dataset = SpectrogramDatasetMultiLabel(
+        require(ctx, "extract_single_file"),
+        vertical_trim=spectrogram_args["vertical_trim"],
+        augmentations=augmentations,
+        augment_seed=ctx.seed,
+    )
+
+    def run():
+        return [dataset[i] for i in range(len(dataset))]
+
+    run.items = len(dataset)
+    return run
+
+
+@stage("gaussian_beeps")
+def gaussian_beeps(ctx):
+    waveform, _ = infer.load_wav_file(ctx.wav_file)
+    rng = np.random.default_rng(ctx.seed)
+
+    def run():
+        return add_gaussian_beeps(waveform.clone(), ctx.sample_rate, rng=rng)
+
+    run.items = waveform.shape[-1]
+    return run
+
+
+def train_epoch(model, optimizer, batches, precision=32):
+    """
+    One optimizer step per batch. :param precision: 32, or "bf16" for bfloat16 autocast as Trainer(precision="bf16")
+    uses.
+    :return: float. Mean training loss.
+    """
+    model.train()
+    losses = []
+    for batch in batches:
+        optimizer.zero_grad()
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=precision == "bf16"):
+            loss = model._shared_step(batch)[0]
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return float(np.mean(losses))
+
+
+def _train_step_stage(ctx, precision):
+    dataset = SpectrogramDatasetMultiLabel(
+        require(ctx, "extract_single_file"),
+        vertical_trim=spectrogram_args["vertical_trim"],
+    )
+    collate_fn = PadCollate(n_buffers=0)
+    batches = [
+        collate_fn([dataset[i] for i in batch])
+        for batch in BucketBatchSampler(
+            dataset.lengths(), ctx.batch_size, seed=ctx.seed
+        )
+    ]
+    model = random_ensemble(1, in_channels=batches[0][0].shape[1], seed=ctx.seed)[0]
+    optimizer = torch.optim.Adam(model.parameters(), lr=model.learning_rate)
+
+    def run():
+        return train_epoch(model, optimizer, batches, precision)
+
+    run.items = len(dataset)
+    return run
+
+
+@stage("train_step")
+def train_step(ctx):
+    return _train_step_stage(ctx, 32)
+
+
+@stage("train_step_bf16")
+def train_step_bf16(ctx):
+    return _train_step_stage(ctx, "bf16")
+
+
+def write_clips(ctx, n_clips=100, clip_s=2.0):
+    """
+    Cut the recording into .wav clips with a label csv, as WhaleDataset and TwoDDataset read them (written once).
+    :return: tuple (list, str). The clip files and the csv.
+    """
+    directory = os.path.join(ctx.workdir, "clips")
+    label_csv = os.path.join(directory, "labels.csv")
+    files = [os.path.join(directory, f"clip_{i}.wav") for i in range(n_clips)]
+    if not os.path.isfile(label_csv):
+        os.makedirs(directory)
+        waveform, sample_rate = infer.load_wav_file(ctx.wav_file)
+        clip_length = int(clip_s * sample_rate)
+        for i, f in enumerate(files):
+            begin = (i * clip_length) % (waveform.shape[-1] - clip_length)
+            torchaudio.save(f, waveform[:, begin : begin + clip_length], sample_rate)
+        pd.DataFrame(
+            {
+                "clip": [os.path.basename(f) for f in files],
+                "label": np.arange(n_clips) % 2,
+            }
+        ).to_csv(label_csv, index=False)
+    return files, label_csv
+
+
+@stage("clip_getitem")
+def clip_getitem(ctx):
+    files, label_csv = write_clips(ctx)
+    dataset = WhaleDataset(
+        files, label_csv, n_fft=400, hop_length=100, cache_directory=None
+    )
+
+    def run():
+        return [dataset[i] for i in range(len(dataset))]
+
+    run.items = len(dataset)
+    return run
+
+
+@stage("clip_store_getitem")
+def clip_store_getitem(ctx):
+    files, label_csv = write_clips(ctx)
+    cache_directory = os.path.join(ctx.workdir, "features")
+    shutil.rmtree(cache_directory, ignore_errors=True)
+    begin = time.perf_counter()
+    dataset = WhaleDataset(
+        files, label_csv, n_fft=400, hop_length=100, cache_directory=cache_directory
+    )
+    build_s = time.perf_counter() - begin
+
+    def run():
+        return [dataset[i] for i in range(len(dataset))]
+
+    run.items = len(dataset)
+    run.extra = {"build_s": build_s}
+    return run
+
+
+@stage("convert_to_shard")
+def convert_to_shard(ctx):
+    files = require(ctx, "extract_single_file")
+    directory = os.path.join(ctx.workdir, "shard")
+
+    def run():
+        convert_pickles(files, directory)
+        return directory
+
+    run.items = len(files)
+    return run
+
+
+@stage("shard_dataset_init")
+def shard_dataset_init(ctx):
+    directory = require(ctx, "convert_to_shard")
+
+    def run():
+        return ShardedSpectrogramDataset(
+            directory, vertical_trim=spectrogram_args["vertical_trim"]
+        )
+
+    run.items = len(require(ctx, "extract_single_file"))
+    return run
+
+
+@stage("shard_getitem")
+def shard_getitem(ctx):
+    dataset = ShardedSpectrogramDataset(
+        require(ctx, "convert_to_shard"),
+        vertical_trim=spectrogram_args["vertical_trim"],
+    )
+
+    def run():
+        return [dataset[i] for i in range(len(dataset))]
+
+    run.items = len(dataset)
+    return run
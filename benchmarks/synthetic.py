@@ -0,0 +1,95 @@
+"""
+Deterministic synthetic recordings used by the benchmarks.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+import torchaudio
+
+from disco_sound.util.util import add_white_noise
+
+# center frequency (Hz) of the tone used for each synthetic sound type
+class_to_frequency = {"A": 2000.0, "B": 4000.0}
+
+
+def synthetic_recording(
+    duration,
+    sample_rate=48000,
+    events_per_minute=60,
+    snr=10,
+    seed=0,
+):
+    """
+    Build a recording made of gaussian-enveloped tones ("beeps") on top of white noise.
+    Each beep is labeled A or B depending on its frequency; long gaps between beeps are labeled BACKGROUND.
+    :param duration: float. Length of the recording in seconds.
+    :param sample_rate: int. Sample rate of the recording.
+    :param events_per_minute: int. How many labeled beeps to place per minute of audio.
+    :param snr: float. Signal to noise ratio of the white noise added on top of the beeps.
+    :param seed: int. Seed for the random number generators; equal seeds give identical recordings.
+    :return: tuple (torch.Tensor, pd.DataFrame). The 1xN waveform and its raven-format labels.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration * sample_rate)
+    waveform = np.zeros(n_samples, dtype=np.float32)
+
+    n_events = max(1, int(duration * events_per_minute / 60))
+    centers = np.sort(rng.uniform(0.5, max(duration - 0.5, 0.5), n_events))
+    widths = rng.uniform(0.03, 0.1, n_events)
+    sound_types = rng.choice(list(class_to_frequency), n_events)
+
+    rows = []
+    previous_end = 0.0
+    for center, width, sound_type in zip(centers, widths, sound_types):
+        begin = max(center - 2 * width, 0.0)
+        end = min(center + 2 * width, duration)
+        if begin < previous_end:
+            # don't let labeled regions overlap.
+            continue
+
+        # only synthesize the samples under the envelope to keep this fast on long recordings.
+        lo = int(max(center - 4 * width, 0) * sample_rate)
+        hi = int(min(center + 4 * width, duration) * sample_rate)
+        t = np.arange(lo, hi) / sample_rate
+        envelope = np.exp(-((t - center) ** 2) / (2 * width**2))
+        tone = np.sin(2 * np.pi * class_to_frequency[sound_type] * t)
+        waveform[lo:hi] += (envelope * tone).astype(np.float32)
+
+        if begin - previous_end > 0.2:
+            rows.append([previous_end + 0.05, begin - 0.05, "BACKGROUND"])
+        rows.append([begin, end, sound_type])
+        previous_end = end
+
+    waveform = torch.from_numpy(waveform).unsqueeze(0)
+    torch.manual_seed(seed)
+    waveform = add_white_noise(waveform, snr=snr)
+
+    labels = pd.DataFrame(
+        rows, columns=["Begin Time (s)", "End Time (s)", "Sound_Type"]
+    )
+    return waveform, labels
+
+
+def write_synthetic_recording(directory, duration, sample_rate=48000, **kwargs):
+    """
+    Save a synthetic recording and its labels as a .wav and .csv pair.
+    :param directory: str. Where to save the files.
+    :param duration: float. Length of the recording in seconds.
+    :param sample_rate: int. Sample rate of the recording.
+    :param kwargs: Passed on to synthetic_recording.
+    :return: tuple (str, str). Paths to the .wav file and the .csv file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    basename = f"synthetic_{int(duration)}s"
+    wav_path = os.path.join(directory, basename + ".wav")
+    csv_path = os.path.join(directory, basename + ".csv")
+
+    waveform, labels = synthetic_recording(duration, sample_rate=sample_rate, **kwargs)
+    labels["Filename"] = wav_path
+
+    torchaudio.save(wav_path, waveform, sample_rate)
+    labels.to_csv(csv_path, index=False)
+
+    return wav_path, csv_path
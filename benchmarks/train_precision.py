@@ -0,0 +1,135 @@
+"""
+Compare time-to-target validation loss of UNet1D trained in float32 and with bfloat16 autocast on the CPU:
+``python -m benchmarks.train_precision --help``.
+"""
+import os
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import argparse
+import logging
+import time
+from glob import glob
+
+import numpy as np
+import torch
+
+import disco_sound.cfg as cfg
+from benchmarks.results import environment, save_results
+from benchmarks.stages import train_epoch
+from disco_sound.datasets.beetles_data import PadCollate, SpectrogramDatasetMultiLabel
+from disco_sound.models.unet_1d import UNet1D
+from disco_sound.util.samplers import BucketBatchSampler
+
+logger = logging.getLogger("benchmarks")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.train_precision",
+        description="Time UNet1D training to a target validation loss in float32 and bfloat16.",
+    )
+    parser.add_argument("train_directory", help="directory of extracted .pkl files")
+    parser.add_argument("validation_directory")
+    parser.add_argument("--target", type=float, required=True, help="val loss")
+    parser.add_argument("--max-epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--vertical-trim", type=int, default=20)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="train_precision.json")
+    return parser.parse_args(argv)
+
+
+def _batches(directory, args, shuffle):
+    dataset = SpectrogramDatasetMultiLabel(
+        sorted(glob(os.path.join(directory, "*.pkl"))),
+        vertical_trim=args.vertical_trim,
+        mask_flag=cfg.mask_flag,
+    )
+    if not len(dataset):
+        raise ValueError(f"No .pkl files in {directory}.")
+    collate_fn = PadCollate(mask_flag=cfg.mask_flag, n_buffers=0)
+    sampler = BucketBatchSampler(
+        dataset.lengths(), args.batch_size, shuffle=shuffle, seed=args.seed
+    )
+    return [collate_fn([dataset[i] for i in batch]) for batch in sampler]
+
+
+@torch.no_grad()
+def validation_loss(model, batches, precision):
+    model.eval()
+    losses = []
+    for batch in batches:
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=precision == "bf16"):
+            loss = model._shared_step(batch)[0]
+        losses.append(loss.item())
+    return float(np.mean(losses))
+
+
+def _precision_name(precision):
+    return "float32" if precision == 32 else precision
+
+
+def time_to_target(args, precision, train_batches, val_batches):
+    """
+    :return: dict. Training time (excluding validation) until the validation loss first reached the target, or None,
+    and the loss after every epoch.
+    """
+    torch.manual_seed(args.seed)
+    model = UNet1D(
+        in_channels=train_batches[0][0].shape[1],
+        out_channels=len(set(cfg.class_code_to_name)),
+        learning_rate=args.learning_rate,
+        mask_character=cfg.mask_flag,
+    )
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate)
+    rng = np.random.default_rng(args.seed)
+
+    train_s = 0.0
+    val_losses = []
+    for epoch in range(args.max_epochs):
+        order = rng.permutation(len(train_batches))
+        begin = time.perf_counter()
+        train_epoch(model, optimizer, [train_batches[i] for i in order], precision)
+        train_s += time.perf_counter() - begin
+        val_losses.append(validation_loss(model, val_batches, precision))
+        logger.info(
+            f"{_precision_name(precision)} epoch {epoch}: val loss {val_losses[-1]:.4f}"
+        )
+        if val_losses[-1] <= args.target:
+            return {"epochs": epoch + 1, "train_s": train_s, "val_losses": val_losses}
+    return {"epochs": None, "train_s": None, "val_losses": val_losses}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    train_batches = _batches(args.train_directory, args, shuffle=True)
+    val_batches = _batches(args.validation_directory, args, shuffle=False)
+    results = {
+        "config": vars(args),
+        "environment": environment(),
+        "float32": time_to_target(args, 32, train_batches, val_batches),
+        "bf16": time_to_target(args, "bf16", train_batches, val_batches),
+    }
+    save_results(results, args.output)
+
+    for precision in ("float32", "bf16"):
+        result = results[precision]
+        if result["epochs"] is None:
+            logger.info(
+                f"{precision}: didn't reach {args.target} in {args.max_epochs} epochs."
+            )
+        else:
+            logger.info(
+                f"{precision}: reached {args.target} after {result['epochs']} epochs, {result['train_s']:.1f}s."
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ DISCO Implements Sound Classification Obediently.
 __version__ = "0.0.2"
 import logging
 import os
+import pickle
 import sys
 import time
 from pathlib import Path
@@ -15,20 +16,65 @@ from pytorch_lightning.loggers import TensorBoardLogger
 from sacred.observers import FileStorageObserver
 
 import disco_sound.cfg as cfg
-from disco_sound.callbacks import CallbackSet
+from disco_sound.callbacks import CallbackSet, monitors_throughput
+from disco_sound.cfg.distill_config import distill_experiment
+from disco_sound.cfg.eval_config import eval_experiment
 from disco_sound.cfg.extract_config import extract_experiment
 from disco_sound.cfg.infer_config import infer_experiment
 from disco_sound.cfg.label_config import label_experiment
+from disco_sound.cfg.prune_config import prune_experiment
 from disco_sound.cfg.shuffle_config import shuffle_experiment
+from disco_sound.cfg.sweep_config import sweep_experiment
 from disco_sound.cfg.train_config import train_experiment
 from disco_sound.cfg.viz_config import viz_experiment
+from disco_sound.distributed import (
+    distributed_trainer_args,
+    is_distributed,
+    rank_and_world_size,
+    shard_dataset_args,
+    threads_per_process,
+)
+from disco_sound.util.background import AsyncCheckpointIO
 from disco_sound.util.loading import load_dataset_class, load_model_class
+from disco_sound.util.samplers import (
+    BucketBatchSampler,
+    ReadAheadBatchSampler,
+    ReadAheadSampler,
+)
 
 root = os.path.dirname(os.path.abspath(__file__))
 
 logger = logging.getLogger("disco")
 
 
+# datasets kept for later training runs in the same process, by their arguments (`disco sweep` workers set this to a
+# dict); None keeps nothing
+dataset_cache = None
+
+
+def load_dataset(dataset_class, dataset_args):
+    """
+    Build a :param dataset_class: from :param dataset_args:, or reuse the one already built from the same arguments
+    if dataset_cache is set. With bootstrap_sample the dataset is built once without it and each call gets a new
+    draw (see bootstrap_copy), except for lazily loaded datasets, which are cheap to build.
+    """
+    if dataset_cache is None or dataset_args.get("lazy"):
+        return dataset_class(**dataset_args)
+
+    dataset_args = dict(dataset_args)
+    bootstrap_sample = dataset_args.pop("bootstrap_sample", False)
+    if bootstrap_sample and not hasattr(dataset_class, "bootstrap_copy"):
+        return dataset_class(**dataset_args, bootstrap_sample=True)
+
+    key = (dataset_class.__name__, pickle.dumps(sorted(dataset_args.items())))
+    if key not in dataset_cache:
+        dataset_cache[key] = dataset_class(**dataset_args)
+    else:
+        logger.info(f"Reusing the {dataset_class.__name__} loaded by an earlier run.")
+    dataset = dataset_cache[key]
+    return dataset.bootstrap_copy() if bootstrap_sample else dataset
+
+
 @train_experiment.config
 def _observer(log_dir, model_name):
     train_experiment.observers.append(FileStorageObserver(f"{log_dir}/{model_name}/"))
@@ -40,32 +86,123 @@ def _cls_loader(model_name, dataset_name):
     dataset_class = load_dataset_class(dataset_name)
 
 
+def make_dataloader(dataset, dataloader_args):
+    """
+    Build the DataLoader the Trainer trains or validates on with :param dataset:. Batches are collated into reused
+    buffers (see PadCollate), so each is only valid until the loader has collated a few more.
+    Datasets that read ahead (see SpectrogramDatasetMultiLabel's lazy mode) get their sampler wrapped so they're told
+    which examples come next.
+    If :param dataloader_args: has n_buckets > 0 examples of similar length are batched together by a
+    BucketBatchSampler with that many buckets (datasets must have a lengths() method). Its shuffle key then defaults
+    to True and shuffles within and across buckets.
+    """
+    dataloader_args = dict(dataloader_args)
+    n_buckets = dataloader_args.pop("n_buckets", 0)
+    read_ahead = getattr(dataset, "read_ahead", 0)
+    collate_fn = dataset.collate_fn()
+
+    if hasattr(collate_fn, "n_buffers"):
+        # the Trainer is done with each batch before it fetches much further, so batches can reuse a ring of buffers:
+        # the one being used, the one Lightning fetches ahead, one being pinned and each worker's up to
+        # prefetch_factor queued ones
+        collate_fn.n_buffers = 5
+        if dataloader_args.get("num_workers", 0):
+            collate_fn.n_buffers = max(5, dataloader_args.get("prefetch_factor", 2) + 3)
+
+    if n_buckets:
+        batch_sampler = BucketBatchSampler(
+            dataset.lengths(),
+            batch_size=dataloader_args.pop("batch_size", 1),
+            n_buckets=n_buckets,
+            shuffle=dataloader_args.pop("shuffle", True),
+            drop_last=dataloader_args.pop("drop_last", False),
+            pad_to=getattr(collate_fn, "divisible_by", 1),
+        )
+        if read_ahead:
+            batch_sampler = ReadAheadBatchSampler(
+                batch_sampler,
+                num_workers=dataloader_args.get("num_workers", 0),
+                read_ahead=read_ahead,
+            )
+        dataloader_args["batch_sampler"] = batch_sampler
+    elif read_ahead:
+        if dataloader_args.pop("shuffle", False):
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+        dataloader_args["sampler"] = ReadAheadSampler(
+            sampler,
+            batch_size=dataloader_args.get("batch_size", 1),
+            num_workers=dataloader_args.get("num_workers", 0),
+            read_ahead=read_ahead,
+        )
+
+    return torch.utils.data.DataLoader(
+        dataset, collate_fn=collate_fn, **dataloader_args
+    )
+
+
 @train_experiment.main
 def train(_config):
     params = SimpleNamespace(**_config)
+
+    if getattr(params, "bootstrap_members", 0):
+        from disco_sound.bootstrap import train_bootstrap_ensemble
+
+        train_bootstrap_ensemble(
+            model_class=params.model_class,
+            model_args=params.model_args,
+            dataset_name=params.dataset_name,
+            train_dataset_args=params.train_dataset_args,
+            val_dataset_args=getattr(params, "val_dataset_args", None),
+            dataloader_args=params.dataloader_args,
+            trainer_args=params.trainer_args,
+            log_dir=train_experiment.observers[0].dir,
+            members=params.bootstrap_members,
+            max_concurrent=params.max_concurrent_members,
+            seed=params.bootstrap_seed,
+            async_checkpoints=params.async_checkpoints,
+            throughput_monitor=params.throughput_monitor,
+        )
+        return
+
+    trainer_args = params.trainer_args
+    train_dataset_args = params.train_dataset_args
+    val_dataset_args = getattr(params, "val_dataset_args", None)
+
+    if is_distributed(trainer_args):
+        # each process loads only its share of the data
+        rank, world_size = rank_and_world_size(trainer_args)
+        train_dataset_args = shard_dataset_args(
+            params.dataset_name,
+            train_dataset_args,
+            rank,
+            world_size,
+            seed=getattr(params, "bootstrap_seed", 0),
+        )
+        if val_dataset_args is not None:
+            val_dataset_args = shard_dataset_args(
+                params.dataset_name, val_dataset_args, rank, world_size
+            )
+        trainer_args = distributed_trainer_args(trainer_args)
+        if trainer_args.get("accelerator") == "cpu":
+            torch.set_num_threads(threads_per_process(trainer_args))
+
     model = params.model_class(**params.model_args)
-    train_dataset = params.dataset_class(**params.train_dataset_args)
+    train_dataset = load_dataset(params.dataset_class, train_dataset_args)
 
-    if hasattr(params, "val_dataset_args"):
-        val_dataset = params.dataset_class(**params.val_dataset_args)
+    if val_dataset_args is not None:
+        val_dataset = load_dataset(params.dataset_class, val_dataset_args)
     else:
         val_dataset = None
 
     logger.info(
         f"Training model {params.model_name} with dataset {params.dataset_name}."
     )
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        collate_fn=train_dataset.collate_fn(),
-        **params.dataloader_args,
-    )
+    train_dataloader = make_dataloader(train_dataset, params.dataloader_args)
 
     if val_dataset is not None:
-        val_dataloader = torch.utils.data.DataLoader(
-            val_dataset,
-            collate_fn=val_dataset.collate_fn(),
-            **params.dataloader_args,
-        )
+        val_dataloader = make_dataloader(val_dataset, params.dataloader_args)
     else:
         val_dataloader = None
 
@@ -84,10 +221,23 @@ def train(_config):
     else:
         logger.info("No description of training run provided.")
 
+    throughput_monitor = monitors_throughput(trainer_args, params.throughput_monitor)
+    if getattr(params, "profile_steps", None):
+        throughput_monitor = True
+        CallbackSet.throughput_monitor.profile_steps = params.profile_steps
+        CallbackSet.throughput_monitor.trace_path = os.path.join(
+            train_experiment.observers[0].dir, "trace.json"
+        )
+
+    plugins = []
+    if params.async_checkpoints:
+        plugins.append(AsyncCheckpointIO())
+
     trainer = Trainer(
-        **params.trainer_args,
-        callbacks=CallbackSet.callbacks(),
+        **trainer_args,
+        callbacks=CallbackSet.callbacks(throughput_monitor),
         logger=tb_logger,
+        plugins=plugins,
     )
 
     trainer.fit(
@@ -96,6 +246,17 @@ def train(_config):
         val_dataloaders=val_dataloader,
     )
 
+    # the run's result, as sacred records it (see also `disco sweep`)
+    metrics = {k: float(v) for k, v in trainer.callback_metrics.items()}
+    checkpoint_callback = trainer.checkpoint_callback
+    if (
+        checkpoint_callback is not None
+        and checkpoint_callback.best_model_score is not None
+    ):
+        metrics["best_val_loss"] = float(checkpoint_callback.best_model_score)
+        metrics["best_model_path"] = checkpoint_callback.best_model_path
+    return metrics
+
 
 @label_experiment.main
 def label(_config):
@@ -145,6 +306,24 @@ def infer(_config):
     predict_wav_file(**_config)
 
 
+@eval_experiment.config
+def _load_eval_model(model_name):
+    model_class = load_model_class(model_name)
+
+
+@eval_experiment.main
+def evaluate(_config):
+
+    from disco_sound.evaluate import evaluate_ensemble
+
+    _config = dict(_config)
+    del _config["model_name"]
+    # evaluation is deterministic; sacred's seed isn't used
+    del _config["seed"]
+
+    evaluate_ensemble(**_config)
+
+
 @extract_experiment.main
 def extract(_config):
     from disco_sound.util.extract_data import extract_single_file
@@ -166,11 +345,49 @@ def shuffle(_config):
     shuffle_data(**_config)
 
 
+@sweep_experiment.main
+def sweep(_config, grid, random, base_updates):
+    # naming the dict entries lets sacred accept the config entries added to them
+    from disco_sound.sweep import run_sweep
+
+    run_sweep(**_config)
+
+
+@distill_experiment.config
+def _load_distill_model(model_name):
+    model_class = load_model_class(model_name)
+
+
+@distill_experiment.main
+def distill(_config):
+    from disco_sound.distill import distill as distill_ensemble
+
+    _config = dict(_config)
+    del _config["model_name"]
+
+    distill_ensemble(**_config)
+
+
+@prune_experiment.config
+def _load_prune_model(model_name):
+    model_class = load_model_class(model_name)
+
+
+@prune_experiment.main
+def prune(_config):
+    from disco_sound.prune import prune_model
+
+    _config = dict(_config)
+    del _config["model_name"]
+
+    prune_model(**_config)
+
+
 def main():
     if len(sys.argv) == 1:
         print(
             f"DISCO version {__version__}. Usage: "
-            f"disco <label, extract, shuffle, train, infer>. "
+            f"disco <label, extract, shuffle, train, sweep, distill, prune, infer, eval>. "
             f"See docs at https://github.com/TravisWheelerLab/disco/wiki for more help."
         )
         exit()
@@ -181,15 +398,23 @@ def main():
         label_experiment.run_commandline(sys.argv[1:])
     elif sys.argv[1] == "infer":
         infer_experiment.run_commandline(sys.argv[1:])
+    elif sys.argv[1] == "eval":
+        eval_experiment.run_commandline(sys.argv[1:])
     elif sys.argv[1] == "extract":
         extract_experiment.run_commandline(sys.argv[1:])
     elif sys.argv[1] == "viz":
         viz_experiment.run_commandline(sys.argv[1:])
     elif sys.argv[1] == "shuffle":
         shuffle_experiment.run_commandline(sys.argv[1:])
+    elif sys.argv[1] == "sweep":
+        sweep_experiment.run_commandline(sys.argv[1:])
+    elif sys.argv[1] == "distill":
+        distill_experiment.run_commandline(sys.argv[1:])
+    elif sys.argv[1] == "prune":
+        prune_experiment.run_commandline(sys.argv[1:])
     else:
         raise ValueError(
-            "must choose one of <train, label, infer, extract, viz, shuffle>"
+            "must choose one of <train, sweep, distill, prune, label, infer, eval, extract, viz, shuffle>"
         )
 
 
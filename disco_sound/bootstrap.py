@@ -0,0 +1,263 @@
+"""
+Train the members of a bootstrap ensemble concurrently from one copy of the training data.
+
+The corpus is packed into shards once (or the configured shards are used as they are). Every member trains in its own
+process on a ShardedSpectrogramDataset serving that member's bootstrap draw - a vector of example indices - so the
+examples are memory-mapped from the same files and every process shares them through the page cache, instead of
+each run loading its own copy of the examples it drew.
+"""
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+import torch
+
+from disco_sound.datasets.beetles_data import ShardedSpectrogramDataset
+from disco_sound.util.shards import FEATURES_FILE, LABELS_FILE, convert_pickles
+
+logger = logging.getLogger(__name__)
+
+# arguments of SpectrogramDatasetMultiLabel that ShardedSpectrogramDataset doesn't take
+_PICKLE_ONLY_ARGS = ("files", "lazy", "cache_bytes", "read_ahead", "io_threads")
+
+
+def bootstrap_indices(n_examples, members, seed=0):
+    """
+    :return: list of :param members: np.arrays, each :param n_examples: indices drawn with replacement.
+    """
+    return [
+        np.random.default_rng((seed, member)).integers(0, n_examples, n_examples)
+        for member in range(members)
+    ]
+
+
+def _shared_dataset_args(dataset_name, dataset_args, directory):
+    """
+    ShardedSpectrogramDataset arguments serving the same examples as :param dataset_args:, packing pickled examples
+    into a shard in :param directory: if needed.
+    """
+    dataset_args = dict(dataset_args)
+    dataset_args.pop("bootstrap_sample", None)
+
+    if dataset_name == "ShardedSpectrogramDataset":
+        return dataset_args
+    if dataset_name != "SpectrogramDatasetMultiLabel":
+        raise ValueError(
+            "Bootstrap ensembles train from SpectrogramDatasetMultiLabel or ShardedSpectrogramDataset, "
+            f"not {dataset_name}."
+        )
+
+    files = list(dict.fromkeys(dataset_args["files"]))
+    if not files:
+        raise ValueError(f"No files to pack into {directory}.")
+    convert_pickles(files, directory, log2=dataset_args.get("apply_log", True))
+    for key in _PICKLE_ONLY_ARGS:
+        dataset_args.pop(key, None)
+    dataset_args["shards"] = directory
+    return dataset_args
+
+
+def _shard_bytes(shards):
+    if isinstance(shards, str):
+        shards = [shards]
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory in shards
+        for name in (FEATURES_FILE, LABELS_FILE)
+    )
+
+
+def _loaded_bytes(dataset, indices):
+    """
+    Bytes a SpectrogramDatasetMultiLabel would hold for the distinct examples among :param indices: (float32
+    features and int64 labels).
+    """
+    rows = dataset.shards[0].meta["rows"] - dataset.vertical_trim
+    lengths = dataset.lengths()[np.unique(indices)]
+    return int(lengths.sum() * (rows * 4 + 8))
+
+
+def _train_member(job):
+    import pytorch_lightning as pl
+    from pytorch_lightning import Trainer
+    from pytorch_lightning.loggers import TensorBoardLogger
+
+    from disco_sound import make_dataloader
+    from disco_sound.callbacks import CallbackSet, monitors_throughput
+    from disco_sound.util.background import AsyncCheckpointIO
+
+    begin = time.perf_counter()
+    torch.set_num_threads(job["num_threads"])
+    # pool processes train several members
+    CallbackSet.reset()
+    pl.seed_everything(job["seed"])
+
+    model = job["model_class"](**job["model_args"])
+    train_dataset = ShardedSpectrogramDataset(**job["train_dataset_args"])
+    train_dataloader = make_dataloader(train_dataset, job["dataloader_args"])
+    if job["val_dataset_args"] is not None:
+        val_dataset = ShardedSpectrogramDataset(**job["val_dataset_args"])
+        val_dataloader = make_dataloader(val_dataset, job["dataloader_args"])
+    else:
+        val_dataloader = None
+
+    tb_logger = TensorBoardLogger(
+        save_dir=job["log_dir"], version=f"member_{job['member']}", name=""
+    )
+    trainer = Trainer(
+        **job["trainer_args"],
+        callbacks=CallbackSet.callbacks(
+            monitors_throughput(job["trainer_args"], job["throughput_monitor"])
+        ),
+        logger=tb_logger,
+        plugins=[AsyncCheckpointIO()] if job["async_checkpoints"] else None,
+    )
+    trainer.fit(
+        model, train_dataloaders=train_dataloader, val_dataloaders=val_dataloader
+    )
+
+    return {
+        "member": job["member"],
+        "wall_s": time.perf_counter() - begin,
+        # ru_maxrss is in KiB on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "best_model_path": trainer.checkpoint_callback.best_model_path,
+    }
+
+
+def train_bootstrap_ensemble(
+    model_class,
+    model_args,
+    dataset_name,
+    train_dataset_args,
+    val_dataset_args,
+    dataloader_args,
+    trainer_args,
+    log_dir,
+    members,
+    max_concurrent=None,
+    seed=0,
+    shard_directory=None,
+    async_checkpoints=False,
+    throughput_monitor=None,
+):
+    """
+    Train :param members: bootstrap ensemble members, :param max_concurrent: at a time (default: all).
+    Member k trains on bootstrap draw k of :param seed: with model seed seed + k, and logs and saves checkpoints in
+    log_dir/member_k. With several GPUs in :param trainer_args: members are spread over them in turn.
+    Wall-clock time and memory use are logged and written to log_dir/bootstrap_summary.json, next to the time K
+    sequential runs would take and the memory K runs loading their own draws would need.
+
+    :param dataset_name: str. "SpectrogramDatasetMultiLabel", whose files are packed into a shard first, or
+    "ShardedSpectrogramDataset".
+    :param async_checkpoints: bool. Whether members save checkpoints in the background (see AsyncCheckpointIO).
+    :param throughput_monitor: bool or None. Whether members log throughput (see monitors_throughput).
+    :param shard_directory: str. Where to pack pickled examples. Defaults to a temporary directory in /dev/shm (or
+    the system temporary directory), deleted afterwards.
+    :return: dict. The summary.
+    """
+    begin = time.perf_counter()
+    max_concurrent = min(max_concurrent or members, members)
+    remove_shards = shard_directory is None
+    if shard_directory is None:
+        shard_directory = tempfile.mkdtemp(
+            prefix="disco_bootstrap_",
+            dir="/dev/shm" if os.path.isdir("/dev/shm") else None,
+        )
+
+    try:
+        train_args = _shared_dataset_args(
+            dataset_name, train_dataset_args, os.path.join(shard_directory, "train")
+        )
+        val_args = (
+            _shared_dataset_args(
+                dataset_name,
+                val_dataset_args,
+                os.path.join(shard_directory, "validation"),
+            )
+            if val_dataset_args is not None
+            else None
+        )
+        corpus = ShardedSpectrogramDataset(**train_args)
+        draws = bootstrap_indices(len(corpus), members, seed=seed)
+        pack_s = time.perf_counter() - begin
+        logger.info(
+            f"Training {members} bootstrap members of {len(corpus)} examples, {max_concurrent} at a time."
+        )
+
+        devices = trainer_args.get("devices", 1)
+        jobs = []
+        for member, draw in enumerate(draws):
+            member_trainer_args = dict(trainer_args)
+            if (
+                isinstance(devices, int)
+                and devices > 1
+                and trainer_args.get("accelerator") == "gpu"
+            ):
+                member_trainer_args["devices"] = [member % devices]
+            jobs.append(
+                {
+                    "member": member,
+                    "seed": seed + member,
+                    "num_threads": max(1, (os.cpu_count() or 1) // max_concurrent),
+                    "model_class": model_class,
+                    "model_args": model_args,
+                    "train_dataset_args": dict(
+                        train_args,
+                        examples=draw,
+                        augment_seed=train_args.get("augment_seed", 0) + member,
+                    ),
+                    "val_dataset_args": val_args,
+                    "dataloader_args": dataloader_args,
+                    "trainer_args": member_trainer_args,
+                    "log_dir": log_dir,
+                    "async_checkpoints": async_checkpoints,
+                    "throughput_monitor": throughput_monitor,
+                }
+            )
+
+        results = []
+        with ProcessPoolExecutor(
+            max_workers=max_concurrent, mp_context=get_context("spawn")
+        ) as executor:
+            for future in as_completed(
+                [executor.submit(_train_member, j) for j in jobs]
+            ):
+                result = future.result()
+                logger.info(
+                    f"Member {result['member']} finished in {result['wall_s']:.1f}s: {result['best_model_path']}"
+                )
+                results.append(result)
+
+        results.sort(key=lambda r: r["member"])
+        summary = {
+            "members": results,
+            "wall_s": time.perf_counter() - begin,
+            "pack_s": pack_s,
+            # each member ran with a share of the CPU threads, so this overestimates sequential runs on CPU
+            "sum_member_wall_s": sum(r["wall_s"] for r in results),
+            "shared_data_bytes": _shard_bytes(train_args["shards"]),
+            "independent_runs_bytes": sum(_loaded_bytes(corpus, d) for d in draws),
+            # shared pages count towards every process that touched them, so this is an upper bound
+            "sum_member_max_rss_bytes": sum(r["max_rss_bytes"] for r in results),
+        }
+    finally:
+        if remove_shards:
+            shutil.rmtree(shard_directory, ignore_errors=True)
+
+    with open(os.path.join(log_dir, "bootstrap_summary.json"), "w") as dst:
+        json.dump(summary, dst, indent=2)
+    logger.info(
+        f"Trained {members} members in {summary['wall_s']:.1f}s (members' own times sum to "
+        f"{summary['sum_member_wall_s']:.1f}s). Training data held once: "
+        f"{summary['shared_data_bytes'] / 2**20:.1f}MiB, versus "
+        f"{summary['independent_runs_bytes'] / 2**20:.1f}MiB for {members} separately loaded draws."
+    )
+    return summary
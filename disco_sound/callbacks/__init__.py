@@ -1,25 +1,331 @@
 from __future__ import annotations
 
+import logging
+import os
+import resource
+import time
+
 import pytorch_lightning as pl
+import torch
 
+from disco_sound.util.background import wait_all
 
-class CallbackSet:
+logger = logging.getLogger(__name__)
 
-    _callbacks = []
 
-    checkpoint_callback = pl.callbacks.model_checkpoint.ModelCheckpoint(
-        monitor="val_loss",
-        mode="min",
-        filename="epoch_{epoch}_{val_loss:.5f}",
-        auto_insert_metric_name=False,
-        save_top_k=10,
-    )
+def _loader(dataloader):
+    # lightning may wrap the loader (ex: CombinedLoader holds it in .loaders)
+    dataloader = getattr(dataloader, "loaders", dataloader)
+    if isinstance(dataloader, (list, tuple)):
+        dataloader = dataloader[0] if len(dataloader) else None
+    return dataloader
+
+
+def _dataset(dataloader):
+    return getattr(_loader(dataloader), "dataset", None)
+
+
+class CacheStatsLogger(pl.Callback):
+    """
+    Logs the cache hit rate and the time spent waiting on reads of datasets that load examples lazily (those with
+    a cache_stats attribute), once per epoch.
+    """
+
+    def _log(self, trainer, pl_module, dataset, stage):
+        stats = getattr(dataset, "cache_stats", None)
+        if stats is None:
+            return
+        totals = stats.totals()
+        stats.reset()
+        requests = totals["hits"] + totals["misses"]
+        if requests == 0:
+            return
+        hit_rate = totals["hits"] / requests
+        pl_module.log(f"{stage}_cache_hit_rate", hit_rate)
+        pl_module.log(f"{stage}_io_wait_s", totals["io_wait_s"])
+        logger.info(
+            f"Epoch {trainer.current_epoch} {stage}: cache hit rate {hit_rate:.3f}, "
+            f"{totals['io_wait_s']:.2f}s waiting on reads, {totals['bytes_read'] / 2**20:.1f}MiB read."
+        )
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self._log(trainer, pl_module, _dataset(trainer.train_dataloader), "train")
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        dataset = _dataset(trainer.val_dataloaders)
+        if trainer.sanity_checking:
+            if getattr(dataset, "cache_stats", None) is not None:
+                dataset.cache_stats.reset()
+            return
+        self._log(trainer, pl_module, dataset, "val")
+
+
+class PaddingEfficiencyLogger(pl.Callback):
+    """
+    Logs the fraction of padded batch frames that are real data for DataLoaders whose batch sampler measures it
+    (see disco_sound.util.samplers.BucketBatchSampler), once per epoch.
+    """
+
+    def _log(self, pl_module, dataloader, stage):
+        batch_sampler = getattr(_loader(dataloader), "batch_sampler", None)
+        efficiency = getattr(batch_sampler, "padding_efficiency", None)
+        if efficiency is not None:
+            pl_module.log(f"{stage}_padding_efficiency", efficiency)
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self._log(pl_module, trainer.train_dataloader, "train")
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if not trainer.sanity_checking:
+            self._log(pl_module, trainer.val_dataloaders, "val")
+
+
+class DatasetEpochSetter(pl.Callback):
+    """
+    Tells the training dataset which epoch is starting, for datasets with a set_epoch method (ex: to reseed their
+    augmentations).
+    """
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        dataset = _dataset(trainer.train_dataloader)
+        if hasattr(dataset, "set_epoch"):
+            dataset.set_epoch(trainer.current_epoch)
+
+
+def _batch_size_and_frames(batch):
+    """
+    :return: tuple (int, int). Examples in :param batch: and their real (unpadded) frames. Batches are (features,
+    masks, labels) with masks True on padding, as PadCollate makes them, or (features, labels).
+    """
+    features = batch[0]
+    if len(batch) == 3 and batch[1].dtype == torch.bool:
+        masks = batch[1]
+        return features.shape[0], int(masks.numel() - masks.sum())
+    return features.shape[0], features.shape[0] * features.shape[-1]
+
+
+def _children_cpu_s():
+    """
+    :return: dict mapping the pids of this process' live children (the DataLoader workers) to the CPU seconds each
+    has used, or None where /proc isn't available.
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    parent = os.getpid()
+    ticks_per_s = os.sysconf("SC_CLK_TCK")
+    cpu_s = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as src:
+                # fields after the parenthesized command name, which may contain spaces
+                fields = src.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            # utime and stime
+            cpu_s[pid] = (int(fields[11]) + int(fields[12])) / ticks_per_s
+    return cpu_s
+
+
+class ThroughputMonitor(pl.Callback):
+    """
+    Measures where training time goes and logs it to the trainer's logger every :param log_every_n_steps: steps
+    (default: the trainer's log_every_n_steps), averaged over those steps:
+
+    - data_wait_s: time between the end of one step and the start of the next, waiting on the DataLoader (and
+      moving the batch to the device).
+    - forward_s, backward_s, optimizer_s: time in training_step, in the backward pass and in the rest of the step.
+    - samples_per_s and frames_per_s: examples and real, unpadded frames trained on per second.
+    - worker_utilization: CPU time the DataLoader workers used as a fraction of the window's time (1 per worker
+      busy all the time), read from /proc on Linux.
+    - peak_rss_bytes: the training process' peak resident memory.
+
+    With :param profile_steps: (first, last) steps first to last - 1 are profiled with torch.profiler and saved in
+    Chrome trace format to :param trace_path: (open it in chrome://tracing or https://ui.perfetto.dev).
+    On GPUs the timings synchronize the device four times a step, which stalls the queue of kernels the CPU keeps
+    ahead of the GPU, so the monitor is left out of GPU training by default (see monitors_throughput).
+    """
+
+    def __init__(self, log_every_n_steps=None, profile_steps=None, trace_path=None):
+        self.log_every_n_steps = log_every_n_steps
+        self.profile_steps = profile_steps
+        self.trace_path = trace_path
+        self._profiler = None
+        self._reset()
+
+    def _reset(self):
+        self._totals = dict.fromkeys(
+            ("data_wait_s", "forward_s", "backward_s", "optimizer_s"), 0.0
+        )
+        self._steps = 0
+        self._samples = 0
+        self._frames = 0
+        self._window_begin = time.perf_counter()
+        self._window_cpu_s = _children_cpu_s()
 
-    _callbacks.append(checkpoint_callback)
+    def _now(self, pl_module):
+        if pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        # steps left from the last epoch were logged at its end; don't count validation in this window
+        self._reset()
+        self._last_end = self._now(pl_module)
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        if self.profile_steps and trainer.global_step == self.profile_steps[0]:
+            self._start_profiler(pl_module)
+        self._batch_begin = self._now(pl_module)
+        self._totals["data_wait_s"] += self._batch_begin - self._last_end
+        self._backward_begin = self._backward_end = None
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self._backward_begin = self._now(pl_module)
+
+    def on_after_backward(self, trainer, pl_module):
+        self._backward_end = self._now(pl_module)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self._last_end = self._now(pl_module)
+        if self._backward_begin is not None and self._backward_end is not None:
+            self._totals["forward_s"] += self._backward_begin - self._batch_begin
+            self._totals["backward_s"] += self._backward_end - self._backward_begin
+            self._totals["optimizer_s"] += self._last_end - self._backward_end
+        samples, frames = _batch_size_and_frames(batch)
+        self._samples += samples
+        self._frames += frames
+        self._steps += 1
+
+        if self._profiler is not None and trainer.global_step >= self.profile_steps[1]:
+            self._stop_profiler()
+
+        log_every_n_steps = self.log_every_n_steps or trainer.log_every_n_steps
+        if self._steps >= log_every_n_steps:
+            self._log(trainer)
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        if self._steps:
+            self._log(trainer)
+
+    def on_train_end(self, trainer, pl_module):
+        if self._profiler is not None:
+            self._stop_profiler()
+
+    def _log(self, trainer):
+        elapsed = time.perf_counter() - self._window_begin
+        metrics = {k: v / self._steps for k, v in self._totals.items()}
+        metrics["samples_per_s"] = self._samples / elapsed
+        metrics["frames_per_s"] = self._frames / elapsed
+        cpu_s = _children_cpu_s()
+        if cpu_s is not None and self._window_cpu_s is not None:
+            # workers that exited during the window aren't counted
+            metrics["worker_utilization"] = (
+                sum(s - self._window_cpu_s.get(pid, 0.0) for pid, s in cpu_s.items())
+                / elapsed
+            )
+        # ru_maxrss is in KiB on Linux
+        metrics["peak_rss_bytes"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        )
+        if trainer.logger is not None:
+            trainer.logger.log_metrics(
+                {f"throughput/{k}": v for k, v in metrics.items()},
+                step=trainer.global_step,
+            )
+        logger.debug(
+            f"Step {trainer.global_step}: {metrics['samples_per_s']:.1f} samples/s, "
+            f"{metrics['data_wait_s'] * 1e3:.1f}ms waiting on data per step."
+        )
+        self._reset()
+
+    def _start_profiler(self, pl_module):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if pl_module.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities)
+        self._profiler.__enter__()
+
+    def _stop_profiler(self):
+        self._profiler.__exit__(None, None, None)
+        trace_path = self.trace_path or "trace.json"
+        os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+        self._profiler.export_chrome_trace(trace_path)
+        logger.info(f"Saved a profile of steps {self.profile_steps} to {trace_path}.")
+        self._profiler = None
+
+
+def monitors_throughput(trainer_args, throughput_monitor=None):
+    """
+    :param throughput_monitor: bool or None. Whether to add a ThroughputMonitor to training, or None to add one
+    unless :param trainer_args: train on a GPU.
+    :return: bool.
+    """
+    if throughput_monitor is not None:
+        return bool(throughput_monitor)
+    accelerator = str(trainer_args.get("accelerator") or "auto")
+    if accelerator == "auto":
+        return not torch.cuda.is_available()
+    return accelerator not in ("gpu", "cuda")
+
+
+class BackgroundFlush(pl.Callback):
+    """
+    Waits for background work (checkpoints saved with AsyncCheckpointIO, figures) to finish when training ends, so
+    checkpoint paths are readable once fit returns.
+    """
+
+    def on_train_end(self, trainer, pl_module):
+        wait_all()
+
+    def on_exception(self, trainer, pl_module, exception):
+        wait_all()
+
+
+class CallbackSet:
+
+    _callbacks = []
+    checkpoint_callback = None
+    throughput_monitor = None
 
     def __init__(self):
         pass
 
     @staticmethod
-    def callbacks():
-        return CallbackSet._callbacks
+    def reset():
+        """
+        Replace the callbacks with new ones, for another training run in the same process (the checkpoint callback
+        keeps the directory and best checkpoints of the run it was used in).
+        """
+        CallbackSet.checkpoint_callback = pl.callbacks.model_checkpoint.ModelCheckpoint(
+            monitor="val_loss",
+            mode="min",
+            filename="epoch_{epoch}_{val_loss:.5f}",
+            auto_insert_metric_name=False,
+            save_top_k=10,
+        )
+        CallbackSet.throughput_monitor = ThroughputMonitor()
+        CallbackSet._callbacks = [
+            CallbackSet.checkpoint_callback,
+            CacheStatsLogger(),
+            PaddingEfficiencyLogger(),
+            DatasetEpochSetter(),
+            CallbackSet.throughput_monitor,
+            BackgroundFlush(),
+        ]
+
+    @staticmethod
+    def callbacks(throughput_monitor=True):
+        """
+        :param throughput_monitor: bool. Whether to include the ThroughputMonitor.
+        """
+        return [
+            callback
+            for callback in CallbackSet._callbacks
+            if throughput_monitor or callback is not CallbackSet.throughput_monitor
+        ]
+
+
+CallbackSet.reset()
@@ -5,7 +5,12 @@ from sacred import Experiment
 aws_download_link = (
     "https://disco-models.s3.us-west-1.amazonaws.com/random_init_model_{}.ckpt"
 )
+# expected "size" (bytes) and/or "sha256" of downloaded checkpoints, keyed by filename. Files without an entry are
+# checked against the Content-Length reported by the server.
+model_manifest = {}
 default_model_directory = os.path.join(os.path.expanduser("~"), ".cache", "disco_sound")
+default_compile_cache_directory = os.path.join(default_model_directory, "compiled")
+default_feature_cache_directory = os.path.join(default_model_directory, "features")
 mask_flag = -1
 name_to_class_code = {"A": 0, "B": 1, "BACKGROUND": 2, "X": 2}
 class_code_to_name = {0: "A", 1: "B", 2: "BACKGROUND"}
@@ -30,6 +35,10 @@ extract_experiment = Experiment()
 infer_experiment = Experiment()
 label_experiment = Experiment()
 shuffle_experiment = Experiment()
+eval_experiment = Experiment()
+sweep_experiment = Experiment()
+distill_experiment = Experiment()
+prune_experiment = Experiment()
 
 
 @train_experiment.config
@@ -63,15 +72,27 @@ def _infer_semi_permanent():
     )
 
 
+@eval_experiment.config
+def _eval_semi_permanent():
+    name_to_class_code = {"A": 0, "B": 1, "BACKGROUND": 2, "X": 2}
+    class_code_to_name = {0: "A", 1: "B", 2: "BACKGROUND"}
+    excluded_classes = ("Y", "C")
+    mask_flag = -1
+
+
 @extract_experiment.config
 def _extract_semi_permanent():
     seed = 0
     no_mel_scale = False
     n_fft = 1150
     overwrite = False
+    # noise and beeps added here are fixed into the extracted data; train_dataset_args.augmentations adds them
+    # afresh every epoch instead.
     snr = 0
     add_beeps = False
     extract_context = False
+    # resample recordings to this rate before extraction (None keeps each file's own rate)
+    sample_rate = None
     class_code_to_name = {0: "A", 1: "B", 2: "BACKGROUND"}
     name_to_class_code = {"A": 0, "B": 1, "BACKGROUND": 2, "X": 2}
     excluded_classes = ("Y", "C")
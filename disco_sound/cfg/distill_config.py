@@ -0,0 +1,48 @@
+import os
+from glob import glob
+
+from disco_sound.cfg import distill_experiment
+from disco_sound.util.util import to_dict
+
+
+@distill_experiment.config
+def config():
+    model_name = "UNet1D"
+    # the ensemble to distill (None: the downloaded models)
+    saved_model_directory = None
+    # student.pt and distill_report.json go here; `disco infer with saved_model_directory=<output_directory>` runs
+    # the student
+    output_directory = "/tmp/disco_student"
+    # extracted examples (their labels aren't used) and unlabeled recordings, labeled by the ensemble
+    train_files = glob("/tmp/extracted_test/train/*pkl")
+    wav_files = []
+    # recordings the report compares the student and the ensemble on
+    eval_wav_files = [
+        os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "resources",
+            "western_meadowlark.wav",
+        )
+    ]
+    # channels of the student at each depth; None keeps the ensemble's (32, 64, 128, 256)
+    student_widths = [16, 32, 64, 128]
+    vertical_trim = 20
+    epochs = 30
+    batch_size = 32
+    learning_rate = 1e-3
+    validation_fraction = 0.1
+    seed = 0
+    num_threads = 4
+
+    # how wav_files and eval_wav_files are cut into tiles; should match the infer config
+    @to_dict
+    class dataloader_args:
+        vertical_trim = 20
+        tile_size = 1024
+        # "auto", or an int (see the infer config)
+        tile_overlap = "auto"
+        n_fft = 1150
+        hop_length = 200
+        log_spect = (True,)
+        mel_transform = (True,)
+        sample_rate = None
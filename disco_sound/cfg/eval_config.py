@@ -0,0 +1,46 @@
+from glob import glob
+
+from disco_sound.cfg import eval_experiment
+from disco_sound.util.heuristics import DEFAULT_HEURISTICS
+from disco_sound.util.util import to_dict
+
+
+@eval_experiment.config
+def config():
+
+    model_name = "UNet1D"
+    saved_model_directory = None
+    # pickled (features, labels) examples, e.g. the test split written by `disco shuffle`
+    test_files = glob("/tmp/extracted_test/test/*pkl")
+    # labeled recordings, as [wav_file, csv_file] pairs
+    wav_csv_pairs = []
+    batch_size = 32
+    # processes evaluating in parallel, each with its own copy of the ensemble and num_threads torch threads
+    num_workers = 1
+    num_threads = 4
+    # how many spectrogram frames an event's onset/offset may be off by and still match the label
+    onset_tolerance = 10
+    offset_tolerance = 10
+    # post-processing applied before scoring, as in `disco infer`
+    smooth_with_hmm = True
+    heuristics = [dict(h) for h in DEFAULT_HEURISTICS]
+    # class of recording frames that no row of the csv covers (None ignores them)
+    unlabeled_class = "BACKGROUND"
+    output_path = None
+
+    @to_dict
+    class dataset_args:
+        vertical_trim = 20
+        apply_log = True
+
+    @to_dict
+    class spectrogram_args:
+        vertical_trim = 20
+        tile_size = 1024
+        # "auto", or an int (see the infer config)
+        tile_overlap = "auto"
+        n_fft = 1150
+        hop_length = 200
+        log_spect = True
+        mel_transform = True
+        sample_rate = None
@@ -11,3 +11,7 @@ def config():
     csv_file = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     csv_file = os.path.join(csv_file, "resources", "example_labels.csv")
     output_data_path = "/tmp/extracted_test/"
+    # "pickle" writes one file per example; "shard" packs them into one memory-mapped shard (see util/shards.py)
+    output_format = "pickle"
+    # shards only: "float16" halves their size
+    shard_dtype = "float32"
@@ -1,6 +1,7 @@
 import os
 
 from disco_sound.cfg import infer_experiment
+from disco_sound.util.heuristics import DEFAULT_HEURISTICS
 from disco_sound.util.util import to_dict
 
 
@@ -13,13 +14,23 @@ def config():
     dataset_name = "SpectrogramIterator"
     saved_model_directory = None
     output_directory = None
+    # set to "torchscript" (or "compile" on torch versions that have torch.compile) for compiled CPU inference
+    compile_backend = None
+
+    # post-processing applied in order to the hmm-smoothed predictions before they're saved.
+    # each entry names a heuristic in disco_sound.util.heuristics.HEURISTIC_FNS and gives its parameters.
+    heuristics = [dict(h) for h in DEFAULT_HEURISTICS]
 
     @to_dict
     class dataloader_args:
         vertical_trim = 20
         tile_size = 1024
-        tile_overlap = 128
+        # "auto" picks the smallest overlap (and the largest tile up to tile_size) for which tiled predictions equal
+        # whole-recording ones, from the models' receptive field (see disco_sound.util.receptive_field); an int fixes it
+        tile_overlap = "auto"
         n_fft = 1150
         hop_length = 200
         log_spect = (True,)
         mel_transform = (True,)
+        # resample the recording to this rate before inference (None keeps the file's own rate)
+        sample_rate = None
@@ -0,0 +1,25 @@
+from glob import glob
+
+from disco_sound.cfg import prune_experiment
+
+
+@prune_experiment.config
+def config():
+    model_name = "UNet1D"
+    # the checkpoint to prune, ex: one model of an ensemble or a distilled student
+    saved_model_path = None
+    # each pruned model goes to output_directory/sparsity_<sparsity>/model.pt (usable as a saved_model_directory),
+    # with prune_curve.csv and prune_report.json
+    output_directory = "/tmp/disco_pruned"
+    # labeled examples the accuracy and throughput curve is measured on
+    validation_files = glob("/tmp/extracted_test/validation/*pkl")
+    # fraction of the channels of each layer removed
+    sparsities = [0.25, 0.5, 0.75]
+    # > 0 fine-tunes each pruned model on train_files for this many epochs
+    finetune_epochs = 0
+    train_files = glob("/tmp/extracted_test/train/*pkl")
+    batch_size = 32
+    learning_rate = 1e-3
+    vertical_trim = 20
+    num_threads = 4
+    seed = 0
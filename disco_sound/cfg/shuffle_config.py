@@ -5,3 +5,7 @@ from disco_sound.cfg import shuffle_experiment
 def config():
     data_directory = "/tmp/extracted_test/"
     move = False
+    # "shard" packs the train/validation/test splits into memory-mapped shards under data_directory/shards,
+    # converting existing pickles (and *.shard directories from disco extract) on the way
+    output_format = "pickle"
+    shard_dtype = "float32"
@@ -0,0 +1,25 @@
+from disco_sound.cfg import sweep_experiment
+
+
+@sweep_experiment.config
+def config():
+    # runs (in sweep_directory/runs), their sacred records and checkpoints, and results.csv go here. Rerunning with
+    # the same spec skips the runs that finished.
+    sweep_directory = "/tmp/disco_sweep"
+    # every combination of these train config entries' values is trained. Entries are nested as in the train config,
+    # ex: {"model_args": {"learning_rate": [1e-3, 3e-4]}, "dataloader_args": {"batch_size": [16, 32]}}
+    grid = {}
+    # n_random draws of these entries, ex: {"model_args": {"learning_rate": {"log_uniform": [1e-4, 1e-2]}}}, are
+    # tried at every grid point. Distributions: uniform, log_uniform, int_uniform ([low, high]) or choice (a list).
+    random = {}
+    n_random = 0
+    # trains each configuration this many times with sacred seeds seed, seed + 1, ... (ex: for an ensemble)
+    repeats = 1
+    seed = 0
+    # train config updates and named configs shared by every run, ex: {"trainer_args": {"max_epochs": 20}}. Each
+    # run's DataLoader workers (dataloader_args.num_workers) come on top of its threads.
+    base_updates = {}
+    named_configs = []
+    # runs trained at once, each with threads_per_run torch threads (None: the CPU count / max_concurrent)
+    max_concurrent = 2
+    threads_per_run = None
@@ -8,7 +8,24 @@ from disco_sound.util.util import to_dict
 def beetles_config():
     model_name = "UNet1D"
     log_dir = "/tmp/bootstrap"
+    # use "ShardedSpectrogramDataset" with shards = ["/tmp/extracted_test/shards/train"] (etc.) to train from
+    # shards written by `disco shuffle with output_format=shard`
     dataset_name = "SpectrogramDatasetMultiLabel"
+    # > 0 trains this many bootstrap ensemble members at once (max_concurrent_members at a time, None for all)
+    # from one shared copy of the training data; train_dataset_args.bootstrap_sample is then ignored.
+    # See disco_sound.bootstrap.
+    bootstrap_members = 0
+    max_concurrent_members = None
+    bootstrap_seed = 0
+    # log throughput (data wait, step times, samples/s, worker utilization, ...) to tensorboard. On GPUs measuring
+    # step times synchronizes the device four times a step, which slows training, so None logs it only when not
+    # training on a GPU; True or False decides either way.
+    throughput_monitor = None
+    # (first, last) saves a Chrome trace of training steps first to last - 1 in the run's directory as trace.json,
+    # and logs throughput regardless of throughput_monitor.
+    profile_steps = None
+    # save checkpoints on a background thread from CPU copies of the model's state instead of in the training loop
+    async_checkpoints = False
 
     @to_dict
     class model_args:
@@ -22,6 +39,16 @@ def beetles_config():
         files = glob("/tmp/extracted_test/train/*pkl")
         vertical_trim = 20
         bootstrap_sample = True
+        # read examples on demand instead of loading them all up front, keeping up to cache_bytes of them in
+        # each DataLoader worker and reading read_ahead batches ahead. Set persistent_workers = True in
+        # dataloader_args so the workers' caches last between epochs.
+        lazy = False
+        cache_bytes = 2 * 2**30
+        read_ahead = 2
+        # augment examples as they're loaded, freshly each epoch (see disco_sound.util.augment), ex:
+        # {"AddNoise": {"snr": (10, 40), "p": 0.5}, "AddBeeps": {"p": 0.3}, "TimeMask": {}, "FrequencyMask": {}}
+        augmentations = {}
+        augment_seed = 0
 
     @to_dict
     class val_dataset_args:
@@ -32,11 +59,21 @@ def beetles_config():
     class dataloader_args:
         batch_size = 32
         num_workers = 8
+        # > 0 batches examples of similar length together (from this many length buckets) to cut padding.
+        n_buckets = 0
 
     @to_dict
     class trainer_args:
-        accelerator = "gpu"
+        # "auto" uses a GPU if there is one. precision = "bf16" trains with bfloat16 autocast, on GPUs or on CPUs
+        # (fastest on ones with AVX512-BF16 or AMX); the loss stays float32.
+        # To train on several CPU processes (DDP on gloo) set accelerator = "cpu", strategy = "ddp", devices to the
+        # processes per machine and num_nodes to the number of machines, and run `disco train` on each machine with
+        # NODE_RANK (0 to num_nodes - 1), MASTER_ADDR and MASTER_PORT set. Each process then loads only its share of
+        # the data, drawn from one bootstrap sample seeded with bootstrap_seed (see disco_sound.distributed). Strategies
+        # that spawn or fork their processes ("ddp_spawn", "ddp_fork", "ddp_notebook") aren't supported.
+        accelerator = "auto"
         devices = 1
+        precision = 32
         max_epochs = 100
 
 
@@ -83,6 +120,9 @@ def whale_config():
 
     @to_dict
     class trainer_args:
-        accelerator = "gpu"
+        # "auto" uses a GPU if there is one. precision = "bf16" trains with bfloat16 autocast, on GPUs or on CPUs
+        # (fastest on ones with AVX512-BF16 or AMX); the loss stays float32.
+        accelerator = "auto"
         devices = 1
+        precision = 32
         max_epochs = 100
@@ -1,11 +1,34 @@
+import copy
+import os
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import torchaudio
 
 from disco_sound.datasets import DataModule
+from disco_sound.util.augment import Augmentations
+from disco_sound.util.cache import CacheStats, LRUCache
 from disco_sound.util.inference_utils import load_wav_file
+from disco_sound.util.shards import Shard
+
+
+def _pad_into(batch, features, masks, labels, mask_flag):
+    """
+    Copy :param batch: of (features, labels) examples into the start of each row of the padded :param features: and
+    :param labels: and fill the rest, and :param masks:, in place.
+    """
+    lengths = torch.tensor([b[0].shape[-1] for b in batch])
+    torch.ge(torch.arange(features.shape[-1]), lengths[:, None], out=masks[:, 0])
+
+    for i, (f, l) in enumerate(batch):
+        # one contiguous block per example; faster on CPU than scattering the whole batch in a single indexed copy
+        features[i, :, : f.shape[-1]] = torch.as_tensor(f)
+        features[i, :, f.shape[-1] :] = 0
+        labels[i, : l.shape[-1]] = torch.as_tensor(l)
+    labels.masked_fill_(masks[:, 0], mask_flag)
 
 
 def pad_batch(batch, mask_flag=-1):
@@ -14,20 +37,83 @@ def pad_batch(batch, mask_flag=-1):
     :param mask_flag: int. What character to interpret as the mask.
     :return: The padded batch.
     """
-    features = [b[0] for b in batch]
-    labels = [b[1] for b in batch]
+    mxlen = max(b[0].shape[-1] for b in batch)
+    padded_batch = torch.empty((len(batch), batch[0][0].shape[0], mxlen))
+    masks = torch.empty((len(batch), 1, mxlen), dtype=torch.bool)
+    padded_labels = torch.empty((len(batch), mxlen), dtype=torch.int64)
+    _pad_into(batch, padded_batch, masks, padded_labels, mask_flag)
+    return padded_batch, masks, padded_labels
+
+
+class PadCollate:
+    """
+    Collate function padding (features, labels) examples to a batch (features, masks, labels) like pad_batch, but
+    straight to the next multiple of :param divisible_by: so that UNet1D doesn't pad the batch again. Masks are
+    (batch x 1 x length) and True over padding, as UNet1D._masked_forward takes them, and padded labels are
+    :param mask_flag:.
+
+    By default every batch gets new tensors. With :param n_buffers: > 0 batches are written into a ring of that many
+    preallocated buffers that grow as needed, so a batch returned by a collate function is overwritten once it has
+    collated n_buffers more. That's only safe for a loop that is done with each batch before the DataLoader gets
+    n_buffers - 2 batches per worker ahead of it, like the Trainer's (see make_dataloader); batches kept any longer,
+    as by list(dataloader), change under their holder.
+
+    :param mask_flag: int. Label of padded frames.
+    :param divisible_by: int. Should match the model's divisible_by.
+    :param n_buffers: int.
+    """
 
-    mxlen = np.max([f.shape[-1] for f in features])
-    padded_batch = torch.zeros((len(batch), features[0].shape[0], mxlen))
-    masks = torch.zeros((len(batch), 1, mxlen))
-    padded_labels = torch.zeros((len(batch), mxlen), dtype=torch.int64) + mask_flag
+    def __init__(self, mask_flag=-1, divisible_by=16, n_buffers=0):
+        self.mask_flag = mask_flag
+        self.divisible_by = divisible_by
+        self.n_buffers = n_buffers
+        self._buffers = []
+        self._next = 0
 
-    for i, (f, l) in enumerate(zip(features, labels)):
-        padded_batch[i, :, : f.shape[-1]] = f
-        masks[i, :, f.shape[-1] :] = True
-        padded_labels[i, : l.shape[-1]] = l
+    def padded_length(self, lengths):
+        """
+        :return: int. Length a batch of examples with :param lengths: is padded to.
+        """
+        return -(-max(lengths) // self.divisible_by) * self.divisible_by
+
+    def _allocate(self, batch_size, rows, length):
+        shapes = {
+            "features": ((batch_size, rows, length), torch.float32),
+            "masks": ((batch_size, 1, length), torch.bool),
+            "labels": ((batch_size, length), torch.int64),
+        }
+        if not self.n_buffers:
+            return [torch.empty(shape, dtype=dtype) for shape, dtype in shapes.values()]
+
+        if len(self._buffers) < self.n_buffers:
+            self._buffers.append({})
+        buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % self.n_buffers
+
+        tensors = []
+        for name, (shape, dtype) in shapes.items():
+            numel = int(np.prod(shape))
+            if name not in buffer or buffer[name].numel() < numel:
+                # grow geometrically so a run of slightly longer batches doesn't reallocate each time
+                capacity = max(numel, 2 * buffer[name].numel() if name in buffer else 0)
+                buffer[name] = torch.empty(capacity, dtype=dtype)
+            tensors.append(buffer[name][:numel].view(shape))
+        return tensors
+
+    def __call__(self, batch):
+        length = self.padded_length([b[0].shape[-1] for b in batch])
+        features, masks, labels = self._allocate(
+            len(batch), batch[0][0].shape[0], length
+        )
+        _pad_into(batch, features, masks, labels, self.mask_flag)
+        return features, masks, labels
 
-    return padded_batch, masks.to(bool), padded_labels
+    def __getstate__(self):
+        # each process (ex: DataLoader worker) allocates its own buffers
+        state = self.__dict__.copy()
+        state["_buffers"] = []
+        state["_next"] = 0
+        return state
 
 
 def _load_pickle(f):
@@ -44,10 +130,18 @@ class SpectrogramDatasetMultiLabel(DataModule):
     Handles potentially multiple labels per example.
     This class takes into account labels next to each other and therefore helps the neural network learn
     transitions between classes in training.
+
+    By default every example is loaded into RAM up front. With :param lazy: examples are read from disk when they're
+    needed and kept in a per-worker LRU cache of :param cache_bytes: bytes. If :param read_ahead: is > 0 the training
+    DataLoader announces upcoming indices (see disco_sound.util.samplers.ReadAheadSampler) and they're loaded by
+    :param io_threads: background threads. Cache hits, misses and time spent waiting on reads are in cache_stats.
+
+    :param augmentations: Spectrogram augmentations applied to each example as it's served (see
+    disco_sound.util.augment.Augmentations), seeded by :param augment_seed:, the epoch and the example's index.
     """
 
     def collate_fn(self):
-        return pad_batch
+        return PadCollate(mask_flag=self.mask_flag)
 
     def __init__(
         self,
@@ -59,6 +153,12 @@ class SpectrogramDatasetMultiLabel(DataModule):
         mask_beginning_and_end=False,
         begin_mask=None,
         end_mask=None,
+        lazy=False,
+        cache_bytes=2**30,
+        read_ahead=0,
+        io_threads=4,
+        augmentations=None,
+        augment_seed=0,
     ):
 
         self.mask_beginning_and_end = mask_beginning_and_end
@@ -79,38 +179,170 @@ class SpectrogramDatasetMultiLabel(DataModule):
             if self.bootstrap_sample
             else files
         )
-        # load all data into RAM before training
-        self.examples = [_load_pickle(f) for f in self.files]
-
-    def __getitem__(self, idx):
+        self.lazy = lazy
+        self.read_ahead = read_ahead if lazy else 0
+        self.io_threads = io_threads
+        self.augmentations = (
+            Augmentations(augmentations, seed=augment_seed, log2=apply_log)
+            if augmentations
+            else None
+        )
 
-        spect_slice, labels = self.examples[idx]
-        spect_slice = spect_slice[self.vertical_trim :]
+        if self.lazy:
+            self.examples = None
+            self.cache = LRUCache(cache_bytes)
+            self.cache_stats = CacheStats()
+            self._pending = {}
+            self._executor = None
+            self._executor_pid = None
+            self._lengths = None
+        else:
+            # load all data into RAM before training. Files drawn more than once by the bootstrap share one copy.
+            prepared = {}
+            self.examples = []
+            for f in self.files:
+                if f not in prepared:
+                    prepared[f] = self._prepare(*_load_pickle(f))
+                self.examples.append(prepared[f])
+
+    def _prepare(self, spect_slice, labels):
+        """
+        Apply the feature transforms and label masking to an example once, when it's loaded.
+        :return: tuple (torch.Tensor, torch.Tensor). float32 features and int64 labels.
+        """
+        # one contiguous float32 copy, so the transforms below don't touch the loaded array
+        spect_slice = np.array(
+            np.asarray(spect_slice)[self.vertical_trim :], dtype=np.float32, order="C"
+        )
 
         if self.apply_log:
             # take care of NaNs after taking the log.
             spect_slice[spect_slice == 0] = 1
-            spect_slice = np.log2(spect_slice)
+            np.log2(spect_slice, out=spect_slice)
+
+        labels = np.array(labels, dtype=np.int64)
 
         if self.mask_beginning_and_end:
             if len(np.unique(labels)) == 1:
                 # if there's only one class
                 if labels.shape[0] > (self.begin_mask + self.end_mask):
                     # and if the label vector is longer than where we're supposed to mask
-                    labels[self.begin_mask] = self.mask_flag
+                    labels[: self.begin_mask] = self.mask_flag
                     labels[-self.end_mask :] = self.mask_flag
                 else:
                     # if it's not, throw it out. We don't want any possibility of bad data
                     # when training the model so we'll waste some compute.
                     labels[:] = self.mask_flag
 
-        return torch.tensor(spect_slice), torch.tensor(labels)
+        return torch.from_numpy(spect_slice), torch.from_numpy(labels)
+
+    def _load(self, idx):
+        f = self.files[idx]
+        example = self._prepare(*_load_pickle(f))
+        nbytes = sum(x.numel() * x.element_size() for x in example)
+        self.cache.put(f, example, nbytes)
+        self.cache_stats.add("bytes_read", os.path.getsize(f))
+        return example
+
+    def prefetch(self, indices):
+        """
+        Start loading :param indices: in the background (lazy mode only).
+        """
+        if self._executor is None or self._executor_pid != os.getpid():
+            # threads don't survive a fork into a DataLoader worker: start this process's own
+            self._executor = ThreadPoolExecutor(max_workers=self.io_threads)
+            self._executor_pid = os.getpid()
+            self._pending = {}
+
+        for idx in indices:
+            if idx not in self._pending and self.files[idx] not in self.cache:
+                self._pending[idx] = self._executor.submit(self._load, idx)
+
+    def _example(self, idx):
+        if not self.lazy:
+            return self.examples[idx]
+
+        example = self.cache.get(self.files[idx])
+        # reads started by the parent process (before a fork) never finish here
+        pending = (
+            self._pending.pop(idx, None) if self._executor_pid == os.getpid() else None
+        )
+        if example is not None:
+            self.cache_stats.add("hits")
+            return example
+
+        begin = time.perf_counter()
+        example = pending.result() if pending is not None else self._load(idx)
+        self.cache_stats.add("io_wait_s", time.perf_counter() - begin)
+        self.cache_stats.add("misses")
+        return example
+
+    def __getitem__(self, idx):
+        """
+        :return: tuple (torch.Tensor, torch.Tensor). The stored features and labels, not copies: don't modify them.
+        Augmented features are new tensors.
+        """
+
+        if isinstance(idx, tuple):
+            # (index, upcoming indices) from a ReadAheadSampler
+            idx, upcoming = idx
+            if self.read_ahead and upcoming:
+                self.prefetch(upcoming)
+
+        spect_slice, labels = self._example(idx)
+        if self.augmentations is not None:
+            spect_slice = self.augmentations(spect_slice, idx)
+        return spect_slice, labels
+
+    def set_epoch(self, epoch):
+        """
+        Reseed the augmentations for :param epoch:.
+        """
+        if self.augmentations is not None:
+            self.augmentations.set_epoch(epoch)
+
+    def bootstrap_copy(self):
+        """
+        :return: A copy of the dataset serving a bootstrap sample of its examples, sharing their loaded data (ex: for
+        several ensemble members trained in one process). Only for datasets loaded into RAM.
+        """
+        if self.lazy:
+            raise ValueError("Lazily loaded datasets can't be copied.")
+        draw = np.random.choice(len(self.files), size=len(self.files), replace=True)
+        sample = copy.copy(self)
+        sample.files = [self.files[i] for i in draw]
+        sample.examples = [self.examples[i] for i in draw]
+        sample.bootstrap_sample = True
+        return sample
 
     def __len__(self):
         """
         :return: The number of examples in the dataset.
         """
-        return len(self.examples)
+        return len(self.files)
+
+    def lengths(self):
+        """
+        :return: np.array of the number of frames in each example. In lazy mode the first call reads every file.
+        """
+        if self.lazy:
+            if self._lengths is None:
+                frames = {}
+                for f in self.files:
+                    if f not in frames:
+                        frames[f] = np.shape(_load_pickle(f)[1])[-1]
+                self._lengths = np.array([frames[f] for f in self.files])
+            return self._lengths
+        return np.array([features.shape[-1] for features, _ in self.examples])
+
+    def __getstate__(self):
+        # the thread pool and its futures stay in the process that made them
+        state = self.__dict__.copy()
+        if self.lazy:
+            state["_executor"] = None
+            state["_executor_pid"] = None
+            state["_pending"] = {}
+        return state
 
     def get_unique_labels(self):
         """
@@ -119,6 +351,140 @@ class SpectrogramDatasetMultiLabel(DataModule):
         return self.unique_labels.keys()
 
 
+class ShardedSpectrogramDataset(DataModule):
+    """
+    Serves the examples of one or more shards written by disco extract/shuffle (see disco_sound.util.shards).
+    Only the shards' indices are read up front; each example is a view into the memory-mapped feature and label
+    arrays, so startup is instant and memory use doesn't grow with the size of the corpus.
+    Takes the same arguments as SpectrogramDatasetMultiLabel, with :param shards: in place of files, except for the
+    lazy loading ones.
+
+    :param examples: Optional indices of the examples to serve, in order and possibly repeated (ex: a bootstrap draw
+    made elsewhere); they replace bootstrap_sample. Indices count across the shards in the order given.
+    """
+
+    def collate_fn(self):
+        return PadCollate(mask_flag=self.mask_flag)
+
+    def __init__(
+        self,
+        shards,
+        apply_log=True,
+        vertical_trim=0,
+        bootstrap_sample=False,
+        mask_flag=-1,
+        mask_beginning_and_end=False,
+        begin_mask=None,
+        end_mask=None,
+        augmentations=None,
+        augment_seed=0,
+        examples=None,
+    ):
+
+        self.mask_beginning_and_end = mask_beginning_and_end
+        if mask_beginning_and_end and (begin_mask is None or end_mask is None):
+            raise ValueError(
+                "If mask_beginning_and_end is true begin_mask and end_mask must"
+                " not be None"
+            )
+
+        self.apply_log = apply_log
+        self.mask_flag = mask_flag
+        self.vertical_trim = vertical_trim
+        self.bootstrap_sample = bootstrap_sample and examples is None
+        self.begin_mask = begin_mask
+        self.end_mask = end_mask
+        self.augmentations = (
+            Augmentations(augmentations, seed=augment_seed, log2=apply_log)
+            if augmentations
+            else None
+        )
+
+        if isinstance(shards, str):
+            shards = [shards]
+        self.shards = [Shard(directory) for directory in shards]
+
+        for shard in self.shards:
+            if shard.log2 and not self.apply_log:
+                raise ValueError(
+                    f"{shard.directory} stores log2 features but apply_log is False."
+                )
+
+        # (shard, example) pairs in global index order
+        self.index = np.concatenate(
+            [
+                np.stack((np.full(len(shard), i), np.arange(len(shard))), axis=1)
+                for i, shard in enumerate(self.shards)
+            ]
+        )
+        if examples is not None:
+            self.index = self.index[np.asarray(examples, dtype=np.int64)]
+        elif self.bootstrap_sample:
+            self.index = self.index[
+                np.random.choice(len(self.index), size=len(self.index), replace=True)
+            ]
+
+    def __getitem__(self, idx):
+
+        shard_idx, example_idx = self.index[idx]
+        shard = self.shards[shard_idx]
+        spect_slice, labels = shard[example_idx]
+        spect_slice = spect_slice[self.vertical_trim :]
+        # shards store int16 labels; nll_loss (and the other datasets) use int64. astype also copies the read-only view
+        labels = labels.astype(np.int64)
+
+        if self.apply_log and not shard.log2:
+            spect_slice = np.log2(np.where(spect_slice == 0, 1, spect_slice))
+
+        if self.mask_beginning_and_end:
+            if len(np.unique(labels)) == 1:
+                # if there's only one class
+                if labels.shape[0] > (self.begin_mask + self.end_mask):
+                    # and if the label vector is longer than where we're supposed to mask
+                    labels[: self.begin_mask] = self.mask_flag
+                    labels[-self.end_mask :] = self.mask_flag
+                else:
+                    # if it's not, throw it out. We don't want any possibility of bad data
+                    # when training the model so we'll waste some compute.
+                    labels[:] = self.mask_flag
+
+        if self.augmentations is not None:
+            return self.augmentations(spect_slice, idx), torch.from_numpy(labels)
+        return torch.from_numpy(spect_slice), torch.from_numpy(labels)
+
+    def __len__(self):
+        """
+        :return: The number of examples in the dataset.
+        """
+        return len(self.index)
+
+    def set_epoch(self, epoch):
+        """
+        Reseed the augmentations for :param epoch:.
+        """
+        if self.augmentations is not None:
+            self.augmentations.set_epoch(epoch)
+
+    def bootstrap_copy(self):
+        """
+        :return: A copy of the dataset serving a bootstrap sample of its examples.
+        """
+        sample = copy.copy(self)
+        sample.index = self.index[
+            np.random.choice(len(self.index), size=len(self.index), replace=True)
+        ]
+        sample.bootstrap_sample = True
+        return sample
+
+    def lengths(self):
+        """
+        :return: np.array of the number of frames in each example, in index order.
+        """
+        lengths = np.concatenate([shard.lengths() for shard in self.shards])
+        first_example = np.cumsum([0] + [len(shard) for shard in self.shards[:-1]])
+        return lengths[first_example[self.index[:, 0]] + self.index[:, 1]]
+
+
 class SpectrogramIterator(DataModule):
     def collate_fn(self):
         return None
@@ -134,14 +500,17 @@ class SpectrogramIterator(DataModule):
         mel_transform,
         wav_file=None,
         spectrogram=None,
+        sample_rate=None,
     ):
+        """
+        :param tile_overlap: int, or "auto" to leave the spectrogram untiled until retile is called with the overlap
+        the models need (see disco_sound.util.receptive_field).
+        """
         super().__init__()
 
         self.tile_size = tile_size
         self.tile_overlap = tile_overlap
-
-        if self.tile_size <= tile_overlap:
-            raise ValueError()
+        self.indices = None
 
         self.wav_file = wav_file
         self.spectrogram = spectrogram
@@ -154,9 +523,10 @@ class SpectrogramIterator(DataModule):
         self.hop_length = hop_length
         self.log_spect = log_spect
         self.mel_transform = mel_transform
+        self.sample_rate = sample_rate
 
         if self.spectrogram is None:
-            waveform, self.sample_rate = load_wav_file(wav_file)
+            waveform, self.sample_rate = load_wav_file(wav_file, sample_rate)
             self.spectrogram = self.create_spectrogram(waveform, self.sample_rate)
 
         self.spectrogram = self.spectrogram[vertical_trim:]
@@ -171,6 +541,21 @@ class SpectrogramIterator(DataModule):
         self.original_spectrogram = self.spectrogram.clone()
         self.original_shape = self.spectrogram.shape
 
+        if tile_overlap != "auto":
+            self.retile(tile_size, tile_overlap)
+
+    def retile(self, tile_size, tile_overlap):
+        """
+        Cut the spectrogram into tiles of :param tile_size: columns overlapping their neighbours' kept centers by
+        :param tile_overlap: columns on each side.
+        """
+        if tile_size <= tile_overlap:
+            raise ValueError()
+
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.spectrogram = self.original_spectrogram
+
         step_size = self.tile_size - 2 * self.tile_overlap
         leftover = self.spectrogram.shape[-1] % step_size
         # Since the length of our spectrogram % step_size isn't always 0, we will have a little
@@ -178,7 +563,7 @@ class SpectrogramIterator(DataModule):
         # are multiple ways to do this, but I decided to mirror pad the end of the spectrogram with
         # the correct amount of columns from the spectrogram so that padded_spectrogram % step_size == 0.
         # I cut off the predictions on the mirrored data after stitching the predictions together.
-        to_pad = step_size - leftover + tile_size // 2
+        to_pad = step_size - leftover + self.tile_size // 2
 
         if to_pad != 0:
             self.spectrogram = torch.cat(
@@ -213,6 +598,8 @@ class SpectrogramIterator(DataModule):
         return spectrogram.squeeze()
 
     def __len__(self):
+        if self.indices is None:
+            raise ValueError("The spectrogram isn't tiled yet: call retile first.")
         return len(self.indices)
 
     def __getitem__(self, idx):
@@ -1,20 +1,39 @@
-import os
 from typing import Any
 
-import pandas as pd
-import torchaudio
+import torch
 
+import disco_sound.cfg as cfg
 from disco_sound.datasets import DataModule
+from disco_sound.util.feature_store import MelSpectrograms, clip_labels, feature_store
 from disco_sound.util.inference_utils import load_wav_file
 
 
 class WhaleDataset(DataModule):
-    def __init__(self, files, label_csv, n_fft, hop_length):
+    """
+    Mel spectrograms of .wav clips with one label each, read from :param label_csv:.
+    The spectrograms are computed once into a feature store in :param cache_directory: (see
+    disco_sound.util.feature_store) and served from it; with cache_directory=None they're computed on every access.
+    """
+
+    def __init__(
+        self,
+        files,
+        label_csv,
+        n_fft,
+        hop_length,
+        cache_directory=cfg.default_feature_cache_directory,
+    ):
 
         self.files = list(files)
-        self.label_mapping = pd.read_csv(label_csv, index_col=0)
+        self.labels = clip_labels(label_csv, self.files)
         self.n_fft = n_fft
         self.hop_length = hop_length
+        self.spectrograms = MelSpectrograms(n_fft, hop_length)
+        self.store = (
+            feature_store(self.files, self.spectrograms, cache_directory)
+            if cache_directory is not None
+            else None
+        )
 
     def collate_fn(self):
         return None
@@ -23,12 +42,8 @@ class WhaleDataset(DataModule):
         return len(self.files)
 
     def __getitem__(self, index: int) -> Any:
-        # compute spectrogram
-        example = self.files[index]
-        wav, sample_rate = load_wav_file(example)
-        bs = os.path.basename(example)
-        label = self.label_mapping.loc[bs]["label"]
-        spectrogram = torchaudio.transforms.MelSpectrogram(
-            sample_rate=sample_rate, n_fft=self.n_fft, hop_length=self.hop_length
-        )(wav).squeeze()
-        return spectrogram, label
+        if self.store is not None:
+            spectrogram = torch.from_numpy(self.store[index][0])
+        else:
+            spectrogram = self.spectrograms(*load_wav_file(self.files[index]))
+        return spectrogram, self.labels[index]
@@ -0,0 +1,352 @@
+"""
+Distill an ensemble into one (optionally narrower) UNet1D.
+
+The ensemble labels every example once: extracted examples (their labels are ignored) and tiles of unlabeled
+recordings get the ensemble's median softmax - the statistic `disco infer` takes its predictions from - as soft
+targets. The student then trains to match them by minimizing the cross-entropy to the targets, keeping the weights that
+agree best with the ensemble on held-out examples. It's saved as a checkpoint in a directory of its own, so
+`disco infer with saved_model_directory=<that directory>` runs it in place of the ensemble.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+
+import disco_sound.cfg as cfg
+import disco_sound.util.inference_utils as infer
+from disco_sound.datasets.beetles_data import (
+    SpectrogramDatasetMultiLabel,
+    SpectrogramIterator,
+)
+from disco_sound.util.receptive_field import retile_for_models
+
+logger = logging.getLogger(__name__)
+
+STUDENT_FILE = "student.pt"
+REPORT_FILE = "distill_report.json"
+
+
+@torch.no_grad()
+def soft_targets(models, batches, device):
+    """
+    :param batches: iterable of (features, masks) batches; masks (batch x 1 x length, True over padding) may be None.
+    :return: list of (features, targets) tuples, one per example, with padding removed. targets are the ensemble's
+    median softmax (classes x length), normalized to sum to 1 over classes.
+    """
+    examples = []
+    for features, masks in batches:
+        features = features.to(device)
+        if masks is None:
+            preds = torch.stack(
+                [torch.softmax(model(features), dim=1) for model in models]
+            )
+            lengths = [features.shape[-1]] * features.shape[0]
+        else:
+            masks = masks.to(device)
+            preds = torch.stack(
+                [torch.softmax(model(features, masks), dim=1) for model in models]
+            )
+            lengths = (~masks).sum(dim=(1, 2)).tolist()
+        medians = infer.calculate_ensemble_statistics(preds)[1]
+        medians = medians / medians.sum(dim=1, keepdim=True)
+        for x, target, length in zip(features.cpu(), medians.cpu(), lengths):
+            examples.append((x[:, :length].clone(), target[:, :length].clone()))
+    return examples
+
+
+def _extracted_batches(files, vertical_trim, batch_size):
+    dataset = SpectrogramDatasetMultiLabel(files, vertical_trim=vertical_trim)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, collate_fn=dataset.collate_fn()
+    )
+    for features, masks, _ in loader:
+        yield features, masks
+
+
+def _recording_batches(wav_files, dataloader_args, batch_size, models):
+    for wav_file in wav_files:
+        tiles = SpectrogramIterator(**dataloader_args, wav_file=wav_file)
+        retile_for_models(tiles, models)
+        for features in torch.utils.data.DataLoader(tiles, batch_size=batch_size):
+            yield features, None
+
+
+def _pad(examples, divisible_by):
+    """
+    Batch (features, targets) examples, padded to the next multiple of :param divisible_by:.
+    :return: tuple (features, masks, targets). masks are True over padding.
+    """
+    length = -(-max(x.shape[-1] for x, _ in examples) // divisible_by) * divisible_by
+    features = torch.zeros(len(examples), examples[0][0].shape[0], length)
+    targets = torch.zeros(len(examples), examples[0][1].shape[0], length)
+    masks = torch.ones(len(examples), 1, length, dtype=torch.bool)
+    for i, (x, target) in enumerate(examples):
+        features[i, :, : x.shape[-1]] = x
+        targets[i, :, : x.shape[-1]] = target
+        masks[i, :, : x.shape[-1]] = False
+    return features, masks, targets
+
+
+def _batches(examples, batch_size, divisible_by, rng=None):
+    order = np.arange(len(examples)) if rng is None else rng.permutation(len(examples))
+    for begin in range(0, len(order), batch_size):
+        yield _pad(
+            [examples[i] for i in order[begin : begin + batch_size]], divisible_by
+        )
+
+
+def distillation_loss(logits, masks, targets):
+    """
+    :return: torch.Tensor. Cross-entropy of the student's :param logits: to the soft :param targets:, averaged over
+    the frames that aren't padding.
+    """
+    log_probs = torch.log_softmax(logits.float(), dim=1)
+    frame_loss = -(targets * log_probs).sum(dim=1)
+    keep = ~masks[:, 0]
+    return frame_loss[keep].mean()
+
+
+@torch.no_grad()
+def frame_agreement(model, examples, batch_size, device):
+    """
+    :return: float. Fraction of frames of :param examples: where :param model:'s most likely class is the ensemble's.
+    """
+    model.eval()
+    agree = frames = 0
+    for features, masks, targets in _batches(examples, batch_size, model.divisible_by):
+        logits = model(features.to(device), masks.to(device)).cpu()
+        keep = ~masks[:, 0]
+        agree += (logits.argmax(dim=1) == targets.argmax(dim=1))[keep].sum().item()
+        frames += keep.sum().item()
+    return agree / max(frames, 1)
+
+
+def save_model_checkpoint(model, path):
+    """
+    Save :param model: as a checkpoint that model_class.load_from_checkpoint (and so assemble_ensemble) loads.
+    """
+    torch.save(
+        {
+            "state_dict": model.state_dict(),
+            "hyper_parameters": dict(model.hparams),
+            "pytorch-lightning_version": pl.__version__,
+        },
+        path,
+    )
+
+
+def _timed_predictions(models, wav_file, dataloader_args, batch_size, device):
+    """
+    Run :param models: over :param wav_file: as `disco infer` does.
+    :return: tuple (np.array, float). Predicted class of each frame and seconds taken by the models.
+    """
+    dataset = SpectrogramIterator(**dataloader_args, wav_file=wav_file)
+    retile_for_models(dataset, models)
+    loader = torch.utils.data.DataLoader(dataset, shuffle=False, batch_size=batch_size)
+    begin = time.perf_counter()
+    medians = infer.evaluate_spectrogram(
+        loader,
+        models,
+        dataset.tile_overlap,
+        dataset.original_spectrogram,
+        dataset.original_shape,
+        device=device,
+    )[1]
+    seconds = time.perf_counter() - begin
+    return np.argmax(medians, axis=0).squeeze(), seconds
+
+
+def compare_on_recordings(
+    student, models, wav_files, dataloader_args, batch_size, device
+):
+    """
+    Predict :param wav_files: with the student and with the ensemble.
+    :return: dict per recording: frame agreement of their predictions before and after HMM smoothing, and each one's
+    seconds and frames per second.
+    """
+    comparison = {}
+    for wav_file in wav_files:
+        ensemble_predictions, ensemble_s = _timed_predictions(
+            models, wav_file, dataloader_args, batch_size, device
+        )
+        student_predictions, student_s = _timed_predictions(
+            [student], wav_file, dataloader_args, batch_size, device
+        )
+        smoothed = [
+            infer.smooth_predictions_with_hmm(
+                predictions,
+                cfg.hmm_transition_probabilities,
+                cfg.hmm_emission_probabilities,
+                cfg.hmm_start_probabilities,
+            )
+            for predictions in (ensemble_predictions, student_predictions)
+        ]
+        n_frames = len(ensemble_predictions)
+        comparison[wav_file] = {
+            "frames": n_frames,
+            "frame_agreement": float(
+                np.mean(ensemble_predictions == student_predictions)
+            ),
+            "hmm_frame_agreement": float(np.mean(smoothed[0] == smoothed[1])),
+            "ensemble_s": ensemble_s,
+            "student_s": student_s,
+            "ensemble_frames_per_s": n_frames / ensemble_s,
+            "student_frames_per_s": n_frames / student_s,
+            "speedup": ensemble_s / student_s,
+        }
+        logger.info(
+            f"{wav_file}: student agrees with the ensemble on {comparison[wav_file]['frame_agreement']:.2%} of "
+            f"frames and runs {comparison[wav_file]['speedup']:.1f}x faster."
+        )
+    return comparison
+
+
+def student_hparams(teacher, student_widths, learning_rate):
+    """
+    :return: dict. The hyperparameters of :param teacher: with :param student_widths: (None keeps the teacher's,
+    pruned block widths included) and :param learning_rate:.
+    """
+    hparams = dict(teacher.hparams)
+    if student_widths is not None:
+        # a pruned teacher's block widths would override them
+        hparams.pop("block_widths", None)
+        # a plain list, as sacred's read-only one can't be loaded back from the checkpoint
+        hparams["widths"] = [int(width) for width in student_widths]
+    hparams["learning_rate"] = learning_rate
+    return hparams
+
+
+def distill(
+    model_class,
+    saved_model_directory,
+    output_directory,
+    train_files=(),
+    wav_files=(),
+    eval_wav_files=(),
+    student_widths=None,
+    vertical_trim=20,
+    dataloader_args=None,
+    epochs=30,
+    batch_size=32,
+    learning_rate=1e-3,
+    validation_fraction=0.1,
+    seed=0,
+    num_threads=4,
+):
+    """
+    Train a student on the soft targets of the ensemble in :param saved_model_directory: and save it to
+    output_directory/student.pt, with a report (output_directory/distill_report.json) comparing the two.
+
+    :param train_files: list of str. Extracted .pkl examples.
+    :param wav_files: list of str. Unlabeled recordings, cut into tiles as `disco infer` does with
+    :param dataloader_args: (a SpectrogramIterator's arguments, as in the infer config).
+    :param eval_wav_files: list of str. Recordings the report compares the student and the ensemble on.
+    :param student_widths: list of 4 ints. The student's widths (see UNet1D); None keeps the ensemble's, including
+    the block widths of a pruned ensemble.
+    :param validation_fraction: float. Fraction of the examples held out to pick the best epoch and measure frame
+    agreement on.
+    :return: dict. The report.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu":
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+
+    models = infer.assemble_ensemble(
+        model_class,
+        saved_model_directory,
+        device,
+        default_model_directory=cfg.default_model_directory,
+        aws_download_link=cfg.aws_download_link,
+        manifest=cfg.model_manifest,
+    )
+    for model in models:
+        model.eval()
+    logger.info(f"Distilling an ensemble of {len(models)} models.")
+
+    begin = time.perf_counter()
+    examples = soft_targets(
+        models, _extracted_batches(train_files, vertical_trim, batch_size), device
+    )
+    examples += soft_targets(
+        models,
+        _recording_batches(wav_files, dataloader_args, batch_size, models),
+        device,
+    )
+    if not examples:
+        raise ValueError("No examples to distill on: give train_files or wav_files.")
+    logger.info(
+        f"Labeled {len(examples)} examples with the ensemble in {time.perf_counter() - begin:.1f}s."
+    )
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(examples))
+    n_validation = int(round(validation_fraction * len(examples)))
+    validation = [examples[i] for i in order[:n_validation]]
+    train = [examples[i] for i in order[n_validation:]]
+
+    student = model_class(
+        **student_hparams(models[0], student_widths, learning_rate)
+    ).to(device)
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+
+    os.makedirs(output_directory, exist_ok=True)
+    student_path = os.path.join(output_directory, STUDENT_FILE)
+    history = []
+    best_agreement = -1.0
+    for epoch in range(epochs):
+        student.train()
+        losses = []
+        for features, masks, targets in _batches(
+            train, batch_size, student.divisible_by, rng
+        ):
+            logits = student(features.to(device), masks.to(device))
+            loss = distillation_loss(logits, masks.to(device), targets.to(device))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+
+        agreement = frame_agreement(student, validation or train, batch_size, device)
+        history.append(
+            {"epoch": epoch, "loss": float(np.mean(losses)), "agreement": agreement}
+        )
+        logger.info(
+            f"Epoch {epoch}: loss {history[-1]['loss']:.4f}, held-out frame agreement {agreement:.2%}."
+        )
+        if agreement >= best_agreement:
+            best_agreement = agreement
+            save_model_checkpoint(student, student_path)
+
+    student = model_class.load_from_checkpoint(
+        student_path, map_location=torch.device(device)
+    ).to(device)
+    student.eval()
+
+    report = {
+        "student_path": student_path,
+        "ensemble_size": len(models),
+        "ensemble_parameters": sum(
+            p.numel() for model in models for p in model.parameters()
+        ),
+        "student_parameters": sum(p.numel() for p in student.parameters()),
+        "student_widths": student.widths,
+        "student_block_widths": student.block_widths,
+        "train_examples": len(train),
+        "validation_examples": len(validation),
+        "validation_frame_agreement": best_agreement,
+        "history": history,
+        "recordings": compare_on_recordings(
+            student, models, eval_wav_files, dataloader_args, batch_size, device
+        ),
+    }
+    with open(os.path.join(output_directory, REPORT_FILE), "w") as dst:
+        json.dump(report, dst, indent=2)
+    logger.info(
+        f"Saved the student to {student_path}; held-out frame agreement {best_agreement:.2%}."
+    )
+    return report
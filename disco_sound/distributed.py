@@ -0,0 +1,129 @@
+"""
+Data-parallel training over several CPU processes and machines (DDP on gloo).
+
+Each process loads only its own share of the training and validation examples: one list of example indices - the
+whole dataset, or a bootstrap draw made with the same seed on every process - is padded to a multiple of the number of
+processes and dealt out round-robin, so every process gets as many examples as the others and runs the same number of
+steps per epoch. Samplers then work within a process' share as they do on one device (including length bucketing), and
+Lightning is told not to replace them with a DistributedSampler.
+"""
+import inspect
+import logging
+import os
+
+import numpy as np
+from pytorch_lightning import Trainer
+
+from disco_sound.util.shards import Shard
+
+logger = logging.getLogger(__name__)
+
+
+def _devices(trainer_args):
+    devices = trainer_args.get("devices", 1)
+    return len(devices) if isinstance(devices, (list, tuple)) else int(devices)
+
+
+def rank_and_world_size(trainer_args):
+    """
+    :return: tuple (int, int). Rank of this process and number of processes, from the environment Lightning (or
+    torchrun, or SLURM) launches processes with, or else from :param trainer_args:' devices and num_nodes. The
+    process `disco train` is started in has rank NODE_RANK * devices.
+    """
+    devices = _devices(trainer_args)
+    world_size = int(
+        os.environ.get("WORLD_SIZE", devices * int(trainer_args.get("num_nodes", 1)))
+    )
+    for variable in ("RANK", "SLURM_PROCID"):
+        if variable in os.environ:
+            return int(os.environ[variable]), world_size
+    rank = int(os.environ.get("NODE_RANK", 0)) * devices + int(
+        os.environ.get("LOCAL_RANK", 0)
+    )
+    return rank, world_size
+
+
+def is_distributed(trainer_args):
+    """
+    :return: bool. Whether :param trainer_args: train with strategy "ddp" over more than one process.
+    :raises ValueError: for the other DDP strategies over more than one process. "ddp_spawn", "ddp_fork" and
+    "ddp_notebook" start their processes from the one datasets are built in, so every process would train on that
+    process' share.
+    """
+    strategy = str(trainer_args.get("strategy") or "")
+    if not strategy.startswith("ddp") or rank_and_world_size(trainer_args)[1] <= 1:
+        return False
+    if strategy != "ddp":
+        raise ValueError(
+            f'Distributed training shares out the data with strategy "ddp", not "{strategy}".'
+        )
+    return True
+
+
+def rank_share(indices, rank, world_size):
+    """
+    :return: np.array. The share of :param indices: of process :param rank:, after padding them (cyclically, as
+    DistributedSampler does) to a multiple of :param world_size:.
+    """
+    indices = np.asarray(indices)
+    padded = np.resize(indices, -(-len(indices) // world_size) * world_size)
+    return padded[rank::world_size]
+
+
+def shard_dataset_args(dataset_name, dataset_args, rank, world_size, seed=0):
+    """
+    Arguments for the share of the dataset of process :param rank: of :param world_size:.
+    With bootstrap_sample the bootstrap is drawn over the whole dataset, seeded with :param seed: so that every process
+    draws the same sample, and then shared out.
+
+    :param dataset_name: str. "SpectrogramDatasetMultiLabel" (whose files are shared out) or
+    "ShardedSpectrogramDataset" (whose example indices are).
+    :return: dict.
+    """
+    dataset_args = dict(dataset_args)
+    bootstrap_sample = dataset_args.pop("bootstrap_sample", False)
+    rng = np.random.default_rng(seed)
+
+    if dataset_name == "SpectrogramDatasetMultiLabel":
+        files = np.asarray(dataset_args["files"])
+        if bootstrap_sample:
+            files = rng.choice(files, size=len(files), replace=True)
+        dataset_args["files"] = [str(f) for f in rank_share(files, rank, world_size)]
+    elif dataset_name == "ShardedSpectrogramDataset":
+        examples = dataset_args.get("examples")
+        if examples is None:
+            shards = dataset_args["shards"]
+            shards = [shards] if isinstance(shards, str) else shards
+            n_examples = sum(len(Shard(directory)) for directory in shards)
+            examples = (
+                rng.integers(0, n_examples, n_examples)
+                if bootstrap_sample
+                else np.arange(n_examples)
+            )
+        dataset_args["examples"] = rank_share(examples, rank, world_size)
+    else:
+        raise ValueError(
+            "Distributed training shares out SpectrogramDatasetMultiLabel or ShardedSpectrogramDataset, "
+            f"not {dataset_name}."
+        )
+    n_examples = len(dataset_args.get("examples", dataset_args.get("files")))
+    logger.info(f"Process {rank} of {world_size} serves {n_examples} examples.")
+    return dataset_args
+
+
+def distributed_trainer_args(trainer_args):
+    """
+    :return: dict. :param trainer_args: with Lightning's replacement of samplers by DistributedSamplers turned off,
+    as each process' dataset is already its share.
+    """
+    # the argument was renamed in Lightning 2.0
+    if "use_distributed_sampler" in inspect.signature(Trainer.__init__).parameters:
+        return dict(trainer_args, use_distributed_sampler=False)
+    return dict(trainer_args, replace_sampler_ddp=False)
+
+
+def threads_per_process(trainer_args):
+    """
+    :return: int. Threads for each of the processes sharing this machine's cores.
+    """
+    return max(1, (os.cpu_count() or 1) // _devices(trainer_args))
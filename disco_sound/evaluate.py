@@ -0,0 +1,551 @@
+"""
+Evaluate an ensemble against labeled data.
+
+Predictions are compared with the labels one batch (or one recording) at a time and only running counts are kept, so
+memory doesn't grow with the size of the evaluation set. Work items can be spread over several processes, each of
+which loads its own copy of the ensemble; their partial counts are merged as they finish.
+"""
+import json
+import logging
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import torch
+
+import disco_sound.cfg as cfg
+import disco_sound.util.inference_utils as infer
+from disco_sound.datasets.beetles_data import (
+    SpectrogramDatasetMultiLabel,
+    SpectrogramIterator,
+    pad_batch,
+)
+from disco_sound.util.heuristics import DEFAULT_HEURISTICS, apply_heuristics
+from disco_sound.util.intervals import Intervals
+from disco_sound.util.receptive_field import retile_for_models
+
+# removes torchaudio warning that spectrogram calculation needs different parameters
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logger = logging.getLogger(__name__)
+
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros_like(numerator),
+        where=denominator != 0,
+    )
+
+
+def _f1(precision, recall):
+    return _safe_divide(2 * precision * recall, precision + recall)
+
+
+class ConfusionMatrix:
+    """
+    Frame-level confusion matrix accumulated over batches.
+    Rows are labels and columns are predictions.
+
+    :param n_classes: int. Number of classes.
+    :param mask_flag: int. Frames labeled with this value are ignored.
+    """
+
+    def __init__(self, n_classes, mask_flag=-1):
+        self.n_classes = n_classes
+        self.mask_flag = mask_flag
+        self.matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+
+    def update(self, predictions, labels):
+        """
+        :param predictions: np.array of point-wise class predictions.
+        :param labels: np.array of point-wise labels, the same shape as :param predictions:.
+        """
+        predictions = np.asarray(predictions, dtype=np.int64).ravel()
+        labels = np.asarray(labels, dtype=np.int64).ravel()
+        keep = labels != self.mask_flag
+        self.matrix += np.bincount(
+            labels[keep] * self.n_classes + predictions[keep],
+            minlength=self.n_classes**2,
+        ).reshape(self.n_classes, self.n_classes)
+
+    def merge(self, other):
+        self.matrix += other.matrix
+        return self
+
+    def precision(self):
+        return _safe_divide(np.diag(self.matrix), self.matrix.sum(axis=0))
+
+    def recall(self):
+        return _safe_divide(np.diag(self.matrix), self.matrix.sum(axis=1))
+
+    def accuracy(self):
+        return float(_safe_divide(np.trace(self.matrix), self.matrix.sum()))
+
+
+def match_events(reference, estimated, onset_tolerance, offset_tolerance=None):
+    """
+    Greedily pair reference and estimated events of a single class, each event used at most once.
+    A pair matches when the onsets are at most :param onset_tolerance: frames apart and, unless
+    :param offset_tolerance: is None, the offsets are at most :param offset_tolerance: frames apart.
+    :param reference: Intervals sorted by start.
+    :param estimated: Intervals sorted by start.
+    :return: int. The number of matched pairs.
+    """
+    # candidates for each reference event are the estimated events whose onset is within tolerance of its onset
+    lower = np.searchsorted(
+        estimated.starts, reference.starts - onset_tolerance, "left"
+    )
+    upper = np.searchsorted(
+        estimated.starts, reference.starts + onset_tolerance, "right"
+    )
+    used = np.zeros(len(estimated), dtype=bool)
+    matches = 0
+
+    for i in np.nonzero(upper > lower)[0]:
+        candidates = np.arange(lower[i], upper[i])
+        candidates = candidates[~used[candidates]]
+        if offset_tolerance is not None:
+            candidates = candidates[
+                np.abs(estimated.ends[candidates] - reference.ends[i])
+                <= offset_tolerance
+            ]
+        if len(candidates):
+            best = candidates[
+                np.argmin(np.abs(estimated.starts[candidates] - reference.starts[i]))
+            ]
+            used[best] = True
+            matches += 1
+
+    return matches
+
+
+class EventMetrics:
+    """
+    Event-level counts accumulated over sequences. An event is a maximal run of frames of one class.
+    Events are matched on onset alone and on onset and offset.
+
+    :param n_classes: int. Number of classes.
+    :param onset_tolerance: int. Frames an estimated onset may be from the reference onset.
+    :param offset_tolerance: int. Frames an estimated offset may be from the reference offset.
+    :param ignore_classes: Iterable of class codes with no events, such as background.
+    :param mask_flag: int. Frames labeled with this value are ignored.
+    """
+
+    def __init__(
+        self,
+        n_classes,
+        onset_tolerance,
+        offset_tolerance,
+        ignore_classes=(),
+        mask_flag=-1,
+    ):
+        self.n_classes = n_classes
+        self.onset_tolerance = onset_tolerance
+        self.offset_tolerance = offset_tolerance
+        self.ignore_classes = tuple(ignore_classes)
+        self.mask_flag = mask_flag
+        self.n_reference = np.zeros(n_classes, dtype=np.int64)
+        self.n_estimated = np.zeros(n_classes, dtype=np.int64)
+        self.onset_matches = np.zeros(n_classes, dtype=np.int64)
+        self.onset_offset_matches = np.zeros(n_classes, dtype=np.int64)
+
+    def update(self, predictions, labels):
+        """
+        :param predictions: np.array (size N) of point-wise class predictions.
+        :param labels: np.array (size N) of point-wise labels. Events are cut at masked frames.
+        """
+        predictions = np.asarray(predictions, dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.int64)
+        predictions = np.where(labels == self.mask_flag, self.mask_flag, predictions)
+
+        reference = Intervals.from_predictions(labels)
+        estimated = Intervals.from_predictions(predictions)
+
+        for class_code in range(self.n_classes):
+            if class_code in self.ignore_classes:
+                continue
+            class_reference = reference[reference.classes == class_code]
+            class_estimated = estimated[estimated.classes == class_code]
+            self.n_reference[class_code] += len(class_reference)
+            self.n_estimated[class_code] += len(class_estimated)
+            if len(class_reference) and len(class_estimated):
+                self.onset_matches[class_code] += match_events(
+                    class_reference, class_estimated, self.onset_tolerance
+                )
+                self.onset_offset_matches[class_code] += match_events(
+                    class_reference,
+                    class_estimated,
+                    self.onset_tolerance,
+                    self.offset_tolerance,
+                )
+
+    def merge(self, other):
+        self.n_reference += other.n_reference
+        self.n_estimated += other.n_estimated
+        self.onset_matches += other.onset_matches
+        self.onset_offset_matches += other.onset_offset_matches
+        return self
+
+
+class EvaluationResult:
+    """
+    Frame- and event-level counts for one part of an evaluation set. Results for different parts are combined with
+    merge().
+    """
+
+    def __init__(
+        self,
+        n_classes,
+        onset_tolerance,
+        offset_tolerance,
+        ignore_classes=(),
+        mask_flag=-1,
+    ):
+        self.frames = ConfusionMatrix(n_classes, mask_flag)
+        self.events = EventMetrics(
+            n_classes, onset_tolerance, offset_tolerance, ignore_classes, mask_flag
+        )
+        self.n_sequences = 0
+
+    def update(self, predictions, labels):
+        self.frames.update(predictions, labels)
+        self.events.update(predictions, labels)
+        self.n_sequences += 1
+
+    def merge(self, other):
+        self.frames.merge(other.frames)
+        self.events.merge(other.events)
+        self.n_sequences += other.n_sequences
+        return self
+
+    def summary(self, class_code_to_name):
+        """
+        :param class_code_to_name: Mapping from class code to class name.
+        :return: dict of metrics, json-serializable.
+        """
+        frame_precision = self.frames.precision()
+        frame_recall = self.frames.recall()
+        events = self.events
+        onset_precision = _safe_divide(events.onset_matches, events.n_estimated)
+        onset_recall = _safe_divide(events.onset_matches, events.n_reference)
+        onset_offset_precision = _safe_divide(
+            events.onset_offset_matches, events.n_estimated
+        )
+        onset_offset_recall = _safe_divide(
+            events.onset_offset_matches, events.n_reference
+        )
+
+        classes = {}
+        for code in range(self.frames.n_classes):
+            name = class_code_to_name.get(code, str(code))
+            classes[name] = {
+                "frames": int(self.frames.matrix[code].sum()),
+                "frame_precision": float(frame_precision[code]),
+                "frame_recall": float(frame_recall[code]),
+                "frame_f1": float(_f1(frame_precision[code], frame_recall[code])),
+            }
+            if code in events.ignore_classes:
+                continue
+            classes[name].update(
+                {
+                    "reference_events": int(events.n_reference[code]),
+                    "estimated_events": int(events.n_estimated[code]),
+                    "onset_precision": float(onset_precision[code]),
+                    "onset_recall": float(onset_recall[code]),
+                    "onset_f1": float(_f1(onset_precision[code], onset_recall[code])),
+                    "onset_offset_precision": float(onset_offset_precision[code]),
+                    "onset_offset_recall": float(onset_offset_recall[code]),
+                    "onset_offset_f1": float(
+                        _f1(onset_offset_precision[code], onset_offset_recall[code])
+                    ),
+                }
+            )
+
+        return {
+            "sequences": self.n_sequences,
+            "frame_accuracy": self.frames.accuracy(),
+            "onset_tolerance": events.onset_tolerance,
+            "offset_tolerance": events.offset_tolerance,
+            "confusion_matrix": self.frames.matrix.tolist(),
+            "classes": classes,
+        }
+
+
+def labels_from_csv(
+    csv_file,
+    length,
+    sample_rate,
+    hop_length,
+    name_to_class_code,
+    excluded_classes=(),
+    unlabeled_class="BACKGROUND",
+    mask_flag=-1,
+):
+    """
+    Build a point-wise label vector for a recording from its Raven .csv.
+    :param length: int. Number of spectrogram frames in the recording.
+    :param excluded_classes: Iterable of class names whose regions are masked.
+    :param unlabeled_class: str or None. Class given to frames no row covers. They're masked if None.
+    :return: np.array (size :param length:) of class codes, :param mask_flag: where masked.
+    """
+    df = infer.load_prediction_csv(csv_file, hop_length, sample_rate)
+    fill_value = (
+        mask_flag if unlabeled_class is None else name_to_class_code[unlabeled_class]
+    )
+    labels = np.full(length, fill_value, dtype=np.int64)
+
+    for begin, end, sound_type in zip(
+        df["Begin Spect Index"], df["End Spect Index"], df["Sound_Type"]
+    ):
+        if sound_type in excluded_classes:
+            labels[begin:end] = mask_flag
+        else:
+            labels[begin:end] = name_to_class_code[sound_type]
+
+    return labels
+
+
+def post_process(medians, iqrs, smooth_with_hmm, heuristics):
+    """
+    Turn the ensemble's median softmax for one sequence into point-wise predictions, the same way `disco infer`
+    does.
+    :param medians: np.array (classes x N).
+    :param iqrs: np.array (classes x N).
+    :return: np.array (size N) of class codes.
+    """
+    predictions = np.argmax(medians, axis=0)
+
+    if smooth_with_hmm:
+        predictions = infer.smooth_predictions_with_hmm(
+            predictions,
+            cfg.hmm_transition_probabilities,
+            cfg.hmm_emission_probabilities,
+            cfg.hmm_start_probabilities,
+        )
+
+    if heuristics:
+        intervals, _ = apply_heuristics(
+            predictions, heuristics, cfg.name_to_class_code, iqr=iqrs
+        )
+        predictions = intervals.to_predictions(
+            predictions.shape[-1], fill_value=cfg.name_to_class_code["BACKGROUND"]
+        )
+
+    return predictions
+
+
+# the ensemble and settings of this process, set by _init_worker.
+_worker = {}
+
+
+def _init_worker(model_class, saved_model_directory, num_threads, options):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cpu":
+        torch.set_num_threads(num_threads)
+
+    models = infer.assemble_ensemble(
+        model_class,
+        saved_model_directory,
+        device,
+        default_model_directory=cfg.default_model_directory,
+        aws_download_link=cfg.aws_download_link,
+        manifest=cfg.model_manifest,
+    )
+    _worker["models"] = [model.eval() for model in models]
+    _worker["device"] = device
+    _worker["options"] = options
+
+
+def _new_result(options):
+    return EvaluationResult(
+        n_classes=len(options["class_code_to_name"]),
+        onset_tolerance=options["onset_tolerance"],
+        offset_tolerance=options["offset_tolerance"],
+        ignore_classes=(options["name_to_class_code"]["BACKGROUND"],),
+        mask_flag=options["mask_flag"],
+    )
+
+
+@torch.no_grad()
+def _evaluate_examples(files):
+    """
+    Evaluate a batch of pickled (features, labels) examples.
+    """
+    options = _worker["options"]
+    result = _new_result(options)
+    dataset = SpectrogramDatasetMultiLabel(
+        files, mask_flag=options["mask_flag"], **options["dataset_args"]
+    )
+    features, masks, labels = pad_batch(
+        [dataset[i] for i in range(len(dataset))], mask_flag=options["mask_flag"]
+    )
+    features = features.to(_worker["device"])
+    ensemble_preds = infer.predict_with_ensemble(_worker["models"], features)
+    iqrs, medians, _, _ = infer.calculate_ensemble_statistics(ensemble_preds)
+    iqrs, medians = iqrs.to("cpu").numpy(), medians.to("cpu").numpy()
+    lengths = (~masks[:, 0]).sum(dim=-1).numpy()
+
+    for i, length in enumerate(lengths):
+        predictions = post_process(
+            medians[i, :, :length],
+            iqrs[i, :, :length],
+            options["smooth_with_hmm"],
+            options["heuristics"],
+        )
+        result.update(predictions, labels[i, :length].numpy())
+
+    return result
+
+
+@torch.no_grad()
+def _evaluate_recording(wav_and_csv):
+    """
+    Evaluate one labeled recording with the overlap-tile strategy used by `disco infer`.
+    """
+    wav_file, csv_file = wav_and_csv
+    options = _worker["options"]
+    result = _new_result(options)
+    spectrogram_args = options["spectrogram_args"]
+    dataset = SpectrogramIterator(wav_file=wav_file, **spectrogram_args)
+    retile_for_models(dataset, _worker["models"])
+    dataloader = torch.utils.data.DataLoader(
+        dataset, shuffle=False, batch_size=options["batch_size"], drop_last=False
+    )
+    iqrs, medians, _, _, _ = infer.evaluate_spectrogram(
+        dataloader,
+        _worker["models"],
+        dataset.tile_overlap,
+        dataset.original_spectrogram,
+        dataset.original_shape,
+        device=_worker["device"],
+    )
+    labels = labels_from_csv(
+        csv_file,
+        length=medians.shape[-1],
+        sample_rate=dataset.sample_rate,
+        hop_length=spectrogram_args["hop_length"],
+        name_to_class_code=options["name_to_class_code"],
+        excluded_classes=options["excluded_classes"],
+        unlabeled_class=options["unlabeled_class"],
+        mask_flag=options["mask_flag"],
+    )
+    predictions = post_process(
+        medians, iqrs, options["smooth_with_hmm"], options["heuristics"]
+    )
+    result.update(predictions, labels)
+    logger.info(f"Evaluated {os.path.basename(wav_file)}.")
+    return result
+
+
+def _run(job):
+    kind, item = job
+    return _evaluate_examples(item) if kind == "examples" else _evaluate_recording(item)
+
+
+def evaluate_ensemble(
+    model_class,
+    saved_model_directory,
+    test_files,
+    wav_csv_pairs,
+    dataset_args,
+    spectrogram_args,
+    batch_size,
+    num_workers,
+    num_threads,
+    onset_tolerance,
+    offset_tolerance,
+    smooth_with_hmm,
+    heuristics,
+    unlabeled_class,
+    name_to_class_code,
+    class_code_to_name,
+    excluded_classes,
+    mask_flag,
+    output_path=None,
+):
+    """
+    Evaluate the ensemble in :param saved_model_directory: on pickled examples and/or labeled recordings.
+    :param test_files: List of pickled (features, labels) examples, e.g. the test split written by `disco shuffle`.
+    :param wav_csv_pairs: List of (wav file, Raven csv) pairs.
+    :param dataset_args: Arguments of SpectrogramDatasetMultiLabel used to load :param test_files:.
+    :param spectrogram_args: Arguments of SpectrogramIterator used to load :param wav_csv_pairs:.
+    :param batch_size: int. Examples or tiles evaluated at once.
+    :param num_workers: int. Processes that evaluate in parallel, each with its own copy of the ensemble.
+    :param num_threads: int. Torch threads per process.
+    :param onset_tolerance: int. Frames an estimated event's onset may be off by and still match.
+    :param offset_tolerance: int. Frames an estimated event's offset may be off by and still match.
+    :param smooth_with_hmm: bool. Smooth predictions with the hmm before scoring them.
+    :param heuristics: List of heuristics applied after smoothing, as in the infer config.
+    :param unlabeled_class: str or None. Class of recording frames the csv doesn't cover. Masked if None.
+    :param output_path: str or None. Where to write the metrics as json.
+    :return: dict of metrics.
+    """
+    if heuristics is None:
+        heuristics = DEFAULT_HEURISTICS
+
+    jobs = [
+        ("examples", test_files[i : i + batch_size])
+        for i in range(0, len(test_files), batch_size)
+    ]
+    jobs += [("recording", tuple(pair)) for pair in wav_csv_pairs]
+    if not jobs:
+        raise ValueError("Nothing to evaluate: test_files and wav_csv_pairs are empty.")
+
+    options = dict(
+        dataset_args=dataset_args,
+        spectrogram_args=spectrogram_args,
+        batch_size=batch_size,
+        onset_tolerance=onset_tolerance,
+        offset_tolerance=offset_tolerance,
+        smooth_with_hmm=smooth_with_hmm,
+        heuristics=heuristics,
+        unlabeled_class=unlabeled_class,
+        name_to_class_code=name_to_class_code,
+        class_code_to_name=class_code_to_name,
+        excluded_classes=tuple(excluded_classes),
+        mask_flag=mask_flag,
+    )
+    init_args = (model_class, saved_model_directory, num_threads, options)
+    result = _new_result(options)
+
+    logger.info(
+        f"Evaluating {len(test_files)} examples and {len(wav_csv_pairs)} recordings "
+        f"with {num_workers} worker(s)."
+    )
+
+    if num_workers <= 1:
+        _init_worker(*init_args)
+        for job in jobs:
+            result.merge(_run(job))
+    else:
+        # spawn so that no worker inherits the parent's torch thread pool
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=init_args,
+        ) as executor:
+            for future in as_completed([executor.submit(_run, job) for job in jobs]):
+                result.merge(future.result())
+
+    summary = result.summary(class_code_to_name)
+    table = pd.DataFrame.from_dict(summary["classes"], orient="index")
+    logger.info(
+        f"Frame accuracy {summary['frame_accuracy']:.4f} over {summary['sequences']} sequences.\n"
+        f"{table.to_string(float_format='{:.4f}'.format)}"
+    )
+
+    if output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, "w") as dst:
+            json.dump(summary, dst, indent=2)
+        logger.info(f"Saved metrics to {output_path}.")
+
+    return summary
@@ -7,6 +7,9 @@ import torch
 
 import disco_sound.cfg as cfg
 import disco_sound.util.inference_utils as infer
+from disco_sound.util.compiled_inference import compile_ensemble
+from disco_sound.util.heuristics import DEFAULT_HEURISTICS, apply_heuristics
+from disco_sound.util.receptive_field import retile_for_models
 
 # removes torchaudio warning that spectrogram calculation needs different parameters
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -20,16 +23,22 @@ def predict_wav_file(
     model_class,
     saved_model_directory,
     output_directory=None,
-    tile_overlap=128,
-    tile_size=1024,
+    tile_overlap=None,
+    tile_size=None,
     batch_size=32,
     hop_length=200,
     num_threads=4,
     seed=None,
+    heuristics=None,
+    compile_backend=None,
+    compile_cache_directory=None,
 ):
-    if tile_size % 2 != 0:
-        raise ValueError("tile_size must be even, got {}".format(tile_size))
-
+    """
+    :param dataset: SpectrogramIterator over :param wav_file:. With tile_overlap="auto" it's tiled with the smallest
+    overlap that gives the ensemble's whole-recording predictions (see disco_sound.util.receptive_field).
+    :param tile_overlap: int or None. The dataset owns the tiling; if given, it must match the dataset's.
+    :param tile_size: int or None. The dataset owns the tiling; if given, it must match the dataset's.
+    """
     device = "cuda" if torch.cuda.is_available() else "cpu"
     if device == "cpu":
         torch.set_num_threads(num_threads)
@@ -40,10 +49,11 @@ def predict_wav_file(
         device,
         default_model_directory=cfg.default_model_directory,
         aws_download_link=cfg.aws_download_link,
+        manifest=cfg.model_manifest,
     )
 
     if saved_model_directory is not None:
-        log.info(f"Using {len(models)} models from {saved_model_directory}.")
+        logger.info(f"Using {len(models)} models from {saved_model_directory}.")
 
     if len(models) < 1:
         raise ValueError(
@@ -52,6 +62,30 @@ def predict_wav_file(
             )
         )
 
+    retile_for_models(dataset, models)
+    for name, value in (("tile_overlap", tile_overlap), ("tile_size", tile_size)):
+        if value is not None and value != getattr(dataset, name):
+            raise ValueError(
+                f"{name}={value} doesn't match the dataset's {name}={getattr(dataset, name)}; set it in the "
+                "dataset's arguments instead."
+            )
+    if dataset.tile_size % 2 != 0:
+        raise ValueError("tile_size must be even, got {}".format(dataset.tile_size))
+
+    if compile_backend is not None:
+        if device != "cpu":
+            logger.info(f"Compiled inference is CPU-only, running eagerly on {device}.")
+        else:
+            if compile_cache_directory is None:
+                compile_cache_directory = cfg.default_compile_cache_directory
+            tile_shape = (batch_size, dataset.spectrogram.shape[0], dataset.tile_size)
+            models = compile_ensemble(
+                models,
+                tile_shape,
+                backend=compile_backend,
+                cache_directory=compile_cache_directory,
+            )
+
     spectrogram_dataloader = torch.utils.data.DataLoader(
         dataset, shuffle=False, batch_size=batch_size, drop_last=False
     )
@@ -62,7 +96,7 @@ def predict_wav_file(
     iqr, medians, means, votes, preds = infer.evaluate_spectrogram(
         spectrogram_dataloader,
         models,
-        tile_overlap,
+        dataset.tile_overlap,
         original_spectrogram,
         original_shape,
         device=device,
@@ -77,6 +111,19 @@ def predict_wav_file(
         cfg.hmm_start_probabilities,
     )
 
+    if heuristics is None:
+        heuristics = DEFAULT_HEURISTICS
+
+    intervals, timings = apply_heuristics(
+        hmm_predictions, heuristics, cfg.name_to_class_code, iqr=iqr
+    )
+    for name, seconds in timings.items():
+        logger.info(f"Heuristic {name} took {seconds:.4f}s.")
+
+    post_processed_predictions = intervals.to_predictions(
+        hmm_predictions.shape[-1], fill_value=cfg.name_to_class_code["BACKGROUND"]
+    )
+
     # auto-generate a directory
     if output_directory is None:
         wav_root = os.path.dirname(wav_file)
@@ -87,9 +134,9 @@ def predict_wav_file(
         wav_root, os.path.splitext(os.path.basename(wav_file))[0] + "-detected.csv"
     )
 
-    infer.save_csv_from_predictions(
+    infer.save_csv_from_intervals(
         output_csv_path,
-        hmm_predictions,
+        intervals,
         sample_rate=dataset.sample_rate,
         hop_length=hop_length,
         name_to_class_code=cfg.name_to_class_code,
@@ -119,16 +166,16 @@ def predict_wav_file(
     iqr_path = os.path.join(viz_path, "iqrs.pkl")
     csv_path = os.path.join(viz_path, "classifications.csv")
 
-    infer.save_csv_from_predictions(
+    infer.save_csv_from_intervals(
         csv_path,
-        hmm_predictions,
+        intervals,
         sample_rate=dataset.sample_rate,
         hop_length=hop_length,
         name_to_class_code=cfg.name_to_class_code,
     )
 
     infer.pickle_tensor(dataset.original_spectrogram, spectrogram_path)
-    infer.pickle_tensor(hmm_predictions, hmm_prediction_path)
+    infer.pickle_tensor(post_processed_predictions, hmm_prediction_path)
     infer.pickle_tensor(predictions, median_prediction_path)
     infer.pickle_tensor(iqr, iqr_path)
     infer.pickle_tensor(means, mean_prediction_path)
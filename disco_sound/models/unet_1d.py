@@ -1,13 +1,17 @@
-import matplotlib.pyplot as plt
 import pytorch_lightning as pl
 import torch
-import torchmetrics
+from matplotlib.figure import Figure
 from torch import nn
 
+from disco_sound.util.background import shared_worker
+from disco_sound.util.metrics import EpochSums
+
 
 class ConvBlock(nn.Module):
-    def __init__(self, in_channels, out_channels, filter_width):
+    def __init__(self, in_channels, out_channels, filter_width, mid_channels=None):
         super(ConvBlock, self).__init__()
+        # channels between the two convolutions (structured pruning can narrow them)
+        mid_channels = mid_channels or out_channels
 
         if filter_width % 2 == 1:
             pad_width = (filter_width - 1) // 2
@@ -15,10 +19,10 @@ class ConvBlock(nn.Module):
             pad_width = filter_width // 2
 
         self.conv1 = nn.Conv1d(
-            in_channels, out_channels, kernel_size=filter_width, padding=pad_width
+            in_channels, mid_channels, kernel_size=filter_width, padding=pad_width
         )
         self.conv2 = nn.Conv1d(
-            out_channels, out_channels, kernel_size=filter_width, padding=pad_width
+            mid_channels, out_channels, kernel_size=filter_width, padding=pad_width
         )
 
         self.act = nn.ReLU()
@@ -29,6 +33,14 @@ class ConvBlock(nn.Module):
         return x
 
 
+# channels at each depth of the original model, whose checkpoints don't record widths
+DEFAULT_WIDTHS = (32, 64, 128, 256)
+
+
+# (encoder, decoder) blocks whose outputs are summed, as indices of conv1 ... conv9
+SKIP_CONNECTIONS = ((0, 7), (1, 6), (2, 5), (3, 4))
+
+
 class UNet1D(pl.LightningModule):
     def __init__(
         self,
@@ -37,57 +49,65 @@ class UNet1D(pl.LightningModule):
         learning_rate,
         mask_character,
         divisible_by=16,
+        widths=None,
+        block_widths=None,
     ):
+        """
+        :param widths: list of 4 ints. Channels of the convolutions at each depth, from the input down to the
+        bottleneck. Defaults to DEFAULT_WIDTHS; narrower models (ex: distilled students) are cheaper to run.
+        :param block_widths: list of 9 [mid, out] pairs, overriding widths: the channels between the two convolutions
+        of conv1 ... conv9 and at their outputs (see disco_sound.prune). Blocks joined by a skip connection (conv1 and
+        conv8, conv2 and conv7, conv3 and conv6, conv4 and conv5) need the same out.
+        """
 
         super(UNet1D, self).__init__()
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.learning_rate = learning_rate
         self.filter_width = 3
+        self.widths = list(widths or DEFAULT_WIDTHS)
+        if len(self.widths) != 4:
+            raise ValueError(f"Expected 4 widths, got {self.widths}.")
+        self.block_widths = [
+            list(pair) for pair in block_widths or self._block_widths()
+        ]
+        self._check_block_widths()
         self._setup_layers()
         self.divisible_by = divisible_by
-        self.accuracy = torchmetrics.Accuracy(
-            task="multiclass", num_classes=out_channels, top_k=1
-        )
+        self.train_sums = EpochSums("loss", "batches", "correct", "labels")
+        self.val_sums = EpochSums("loss", "batches", "correct", "labels")
         self.mask_character = mask_character
         self.final_activation = torch.nn.functional.log_softmax
 
         self.save_hyperparameters()
 
+    def _block_widths(self):
+        w1, w2, w3, w4 = self.widths
+        return [[w, w] for w in (w1, w2, w3, w4, w4, w3, w2, w1, w1)]
+
+    def _check_block_widths(self):
+        if len(self.block_widths) != 9:
+            raise ValueError(f"Expected 9 block widths, got {self.block_widths}.")
+        outs = [out for _, out in self.block_widths]
+        for first, second in SKIP_CONNECTIONS:
+            if outs[first] != outs[second]:
+                raise ValueError(
+                    f"conv{first + 1} and conv{second + 1} are joined by a skip connection but have "
+                    f"{outs[first]} and {outs[second]} output channels."
+                )
+
     def _setup_layers(self):
-        base = 2
-        power = 5
-        self.conv1 = ConvBlock(self.in_channels, base**power, self.filter_width)
-        self.conv2 = ConvBlock(
-            base ** (power + 0), base ** (power + 1), self.filter_width
-        )
-        self.conv3 = ConvBlock(
-            base ** (power + 1), base ** (power + 2), self.filter_width
-        )
-        self.conv4 = ConvBlock(
-            base ** (power + 2), base ** (power + 3), self.filter_width
-        )
-        self.conv5 = ConvBlock(
-            base ** (power + 3), base ** (power + 3), self.filter_width
-        )
-        self.conv6 = ConvBlock(
-            base ** (power + 3), base ** (power + 2), self.filter_width
-        )
-        self.conv7 = ConvBlock(
-            base ** (power + 2), base ** (power + 1), self.filter_width
-        )
-        self.conv8 = ConvBlock(
-            base ** (power + 1), base ** (power + 0), self.filter_width
-        )
-        self.conv9 = ConvBlock(
-            base ** (power + 0), base ** (power + 0), self.filter_width
-        )
+        in_channels = self.in_channels
+        for i, (mid, out) in enumerate(self.block_widths):
+            block = ConvBlock(in_channels, out, self.filter_width, mid_channels=mid)
+            setattr(self, f"conv{i + 1}", block)
+            in_channels = out
 
         self.conv_out = nn.Conv1d(
-            base**power, self.out_channels, kernel_size=1, padding=0
+            in_channels, self.out_channels, kernel_size=1, padding=0
         )
         self.act = nn.ReLU()
-        self.downsample = nn.MaxPool2d(kernel_size=(1, 2))
+        self.downsample = nn.MaxPool1d(kernel_size=2)
         self.upsample = nn.Upsample(scale_factor=2)
 
     def _masked_forward(self, x, x_mask):
@@ -117,8 +137,7 @@ class UNet1D(pl.LightningModule):
 
         x9 = self.conv9(u4)
         x = self.conv_out(x9)
-        x[x_mask.expand(-1, self.out_channels, -1)] = 0
-        return x
+        return x.masked_fill(x_mask, 0)
 
     def _forward(self, x):
         x1 = self.conv1(x)
@@ -167,11 +186,7 @@ class UNet1D(pl.LightningModule):
         if pad_len == 0:
             return x, 0
         else:
-            x_out = torch.zeros((x.shape[0], x.shape[1], x.shape[2] + pad_len))
-            x_out = x_out.type_as(x)
-            x_out[:, :, :-pad_len] = x
-
-            return x_out, pad_len
+            return torch.nn.functional.pad(x, (0, pad_len)), pad_len
 
     def _shared_step(self, batch):
 
@@ -182,22 +197,23 @@ class UNet1D(pl.LightningModule):
             x, y = batch
             logits = self.forward(x)
 
-        logits = self.final_activation(logits, dim=1)
+        # under bf16 autocast the convolutions run in bfloat16; the loss is computed in float32
+        logits = self.final_activation(logits.float(), dim=1)
 
         loss = torch.nn.functional.nll_loss(logits, y, ignore_index=self.mask_character)
         preds = logits.argmax(dim=1)
         preds = preds[y != self.mask_character]
         labels = y[y != self.mask_character]
-        acc = self.accuracy(preds, labels)
-        return loss, acc
+        return loss, (preds == labels).sum(), labels.numel()
 
     def training_step(self, batch, batch_nb):
-        loss, acc = self._shared_step(batch)
-        return {"loss": loss, "train_acc": acc}
+        loss, correct, labels = self._shared_step(batch)
+        self.train_sums.add(loss=loss, batches=1, correct=correct, labels=labels)
+        return loss
 
     def validation_step(self, batch, batch_nb):
-        loss, acc = self._shared_step(batch)
-        return {"val_loss": loss, "val_acc": acc}
+        loss, correct, labels = self._shared_step(batch)
+        self.val_sums.add(loss=loss, batches=1, correct=correct, labels=labels)
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.learning_rate)
@@ -208,28 +224,38 @@ class UNet1D(pl.LightningModule):
             ),
         }
 
-    def training_epoch_end(self, outputs):
-        train_loss = self.all_gather([x["loss"] for x in outputs])
-        train_acc = self.all_gather([x["train_acc"] for x in outputs])
-        loss = torch.mean(torch.stack(train_loss))
-        acc = torch.mean(torch.stack(train_acc))
-        self.log("train_loss", loss)
-        self.log("train_acc", acc)
+    def _log_epoch(self, sums, stage):
+        # one all-reduce of every process' sums; the logged values are then equal on every process
+        totals = sums.compute(self.trainer.strategy, self.device)
+        self.log(f"{stage}_loss", (totals["loss"] / totals["batches"]).float())
+        self.log(f"{stage}_acc", (totals["correct"] / totals["labels"]).float())
+
+    def on_train_epoch_end(self):
+        self._log_epoch(self.train_sums, "train")
         self.log("learning_rate", self.learning_rate)
 
     def on_train_start(self):
         self.log("hp_metric", self.learning_rate)
 
-    def validation_epoch_end(self, outputs):
-        val_loss = self.all_gather([x["val_loss"] for x in outputs])
-        val_acc = self.all_gather([x["val_acc"] for x in outputs])
-        val_loss = torch.mean(torch.stack(val_loss))
-        val_acc = torch.mean(torch.stack(val_acc))
-        self.log("val_loss", val_loss)
-        self.log("val_acc", val_acc)
+    def on_validation_epoch_end(self):
+        self._log_epoch(self.val_sums, "val")
+
+
+def _log_image(experiment, image, label, global_step):
+    # matplotlib's object-oriented API, as pyplot's global state isn't thread-safe
+    fig = Figure(figsize=(10, 10))
+    ax = fig.add_subplot()
+    ax.set_title(label)
+    fig.colorbar(ax.imshow(image))
+    experiment.add_figure("image", fig, global_step=global_step)
 
 
 class WhaleUNet(UNet1D):
+
+    # render the figures logged every 500 steps on a background thread (one at a time, dropping any requested while
+    # one is pending) instead of in the training step
+    background_figures = True
+
     def _shared_step(self, batch):
 
         if len(batch) == 3:
@@ -241,20 +267,27 @@ class WhaleUNet(UNet1D):
 
         # duplicate labels so we can do fully-convolutional predictions
         y = y.unsqueeze(-1).repeat(1, logits.shape[-1])
-        loss = torch.nn.functional.binary_cross_entropy(
-            torch.sigmoid(logits.ravel()).float(), y.ravel().float()
+        logits = logits.float()
+        # with logits, so the sigmoid can't saturate to exactly 0 or 1 in reduced precision
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(
+            logits.ravel(), y.ravel().float()
         )
 
-        acc = self.accuracy(torch.round(torch.sigmoid(logits)).ravel(), y.ravel())
-
-        if self.global_step % 500 == 0:
-            with torch.no_grad():
-                fig = plt.figure(figsize=(10, 10))
-                plt.imshow(x[0].detach().to("cpu").numpy())
-                plt.title(y[0][0].detach().to("cpu").numpy())
-                plt.colorbar()
-                self.logger.experiment.add_figure(
-                    f"image", plt.gcf(), global_step=self.global_step
-                )
-
-        return loss, acc
+        correct = ((logits.ravel() > 0).long() == y.ravel()).sum()
+
+        if self.training and self.global_step % 500 == 0 and self.logger is not None:
+            # copies, as batch buffers are reused
+            args = (
+                self.logger.experiment,
+                x[0].detach().to("cpu", torch.float32, copy=True).numpy(),
+                int(y[0][0]),
+                self.global_step,
+            )
+            if self.background_figures:
+                shared_worker(
+                    "disco-figures", max_pending=1, drop_when_full=True
+                ).submit(_log_image, *args)
+            else:
+                _log_image(*args)
+
+        return loss, correct, y.numel()
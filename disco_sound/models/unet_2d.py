@@ -1,8 +1,9 @@
 import pytorch_lightning as pl
 import torch
-import torchmetrics
 from torch import nn
 
+from disco_sound.util.metrics import EpochSums
+
 
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels, filter_width):
@@ -43,7 +44,8 @@ class UNet2D(pl.LightningModule):
         self.filter_width = 3
         self._setup_layers()
         self.divisible_by = divisible_by
-        self.accuracy = torchmetrics.Accuracy(task="multiclass", num_classes=3, top_k=3)
+        self.train_sums = EpochSums("loss", "batches", "correct", "labels")
+        self.val_sums = EpochSums("loss", "batches", "correct", "labels")
         self.mask_character = mask_character
         self.final_activation = torch.nn.functional.log_softmax
 
@@ -177,22 +179,23 @@ class UNet2D(pl.LightningModule):
             x, y = batch
             logits = self.forward(x)
 
-        logits = self.final_activation(logits, dim=1)
+        # under bf16 autocast the convolutions run in bfloat16; the loss is computed in float32
+        logits = self.final_activation(logits.float(), dim=1)
 
         loss = torch.nn.functional.nll_loss(logits, y, ignore_index=self.mask_character)
         preds = logits.argmax(dim=1)
         preds = preds[y != self.mask_character]
         labels = y[y != self.mask_character]
-        acc = self.accuracy(preds, labels)
-        return loss, acc
+        return loss, (preds == labels).sum(), labels.numel()
 
     def training_step(self, batch, batch_nb):
-        loss, acc = self._shared_step(batch)
-        return {"loss": loss, "train_acc": acc}
+        loss, correct, labels = self._shared_step(batch)
+        self.train_sums.add(loss=loss, batches=1, correct=correct, labels=labels)
+        return loss
 
     def validation_step(self, batch, batch_nb):
-        loss, acc = self._shared_step(batch)
-        return {"val_loss": loss, "val_acc": acc}
+        loss, correct, labels = self._shared_step(batch)
+        self.val_sums.add(loss=loss, batches=1, correct=correct, labels=labels)
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.learning_rate)
@@ -203,22 +206,18 @@ class UNet2D(pl.LightningModule):
             ),
         }
 
-    def training_epoch_end(self, outputs):
-        train_loss = self.all_gather([x["loss"] for x in outputs])
-        train_acc = self.all_gather([x["train_acc"] for x in outputs])
-        loss = torch.mean(torch.stack(train_loss))
-        acc = torch.mean(torch.stack(train_acc))
-        self.log("train_loss", loss)
-        self.log("train_acc", acc)
+    def _log_epoch(self, sums, stage):
+        # one all-reduce of every process' sums; the logged values are then equal on every process
+        totals = sums.compute(self.trainer.strategy, self.device)
+        self.log(f"{stage}_loss", (totals["loss"] / totals["batches"]).float())
+        self.log(f"{stage}_acc", (totals["correct"] / totals["labels"]).float())
+
+    def on_train_epoch_end(self):
+        self._log_epoch(self.train_sums, "train")
         self.log("learning_rate", self.learning_rate)
 
     def on_train_start(self):
         self.log("hp_metric", self.learning_rate + self.n_fft)
 
-    def validation_epoch_end(self, outputs):
-        val_loss = self.all_gather([x["val_loss"] for x in outputs])
-        val_acc = self.all_gather([x["val_acc"] for x in outputs])
-        val_loss = torch.mean(torch.stack(val_loss))
-        val_acc = torch.mean(torch.stack(val_acc))
-        self.log("val_loss", val_loss)
-        self.log("val_acc", val_acc)
+    def on_validation_epoch_end(self):
+        self._log_epoch(self.val_sums, "val")
@@ -0,0 +1,243 @@
+"""
+Structured channel pruning of UNet1D.
+
+Channels are ranked by the L1 norm of the filters producing them (divided by the mean norm of their layer) and the
+least important are cut out of the weights, giving a smaller dense UNet1D (see its block_widths) rather than a sparse
+mask. Each prunable group of channels loses the same fraction:
+
+- the channels between the two convolutions of each of the 9 ConvBlocks, and
+- the output channels of each block, where blocks joined by a skip connection (whose outputs are summed) are pruned
+  together and rank channels by the sum of both producers' norms.
+
+The pruned models can be fine-tuned on labeled examples, and the report gives the accuracy and throughput of every
+sparsity level.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from disco_sound.datasets.beetles_data import PadCollate, SpectrogramDatasetMultiLabel
+from disco_sound.distill import save_model_checkpoint
+from disco_sound.models.unet_1d import SKIP_CONNECTIONS
+from disco_sound.util.samplers import BucketBatchSampler
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILE = "model.pt"
+REPORT_FILE = "prune_report.json"
+CURVE_FILE = "prune_curve.csv"
+
+
+def _filter_norms(conv):
+    norms = conv.weight.detach().abs().sum(dim=(1, 2))
+    return norms / norms.mean()
+
+
+def channel_importance(model):
+    """
+    :return: tuple (list, list). Importance of the mid channels of each of the 9 blocks, and of the output channels of
+    each block (shared by blocks joined by a skip connection); 1-d tensors.
+    """
+    blocks = [getattr(model, f"conv{i + 1}") for i in range(9)]
+    mid = [_filter_norms(block.conv1) for block in blocks]
+    out = [_filter_norms(block.conv2) for block in blocks]
+    for first, second in SKIP_CONNECTIONS:
+        out[first] = out[second] = out[first] + out[second]
+    return mid, out
+
+
+def _keep(importance, sparsity):
+    n_keep = max(1, int(round(len(importance) * (1 - sparsity))))
+    return importance.argsort(descending=True)[:n_keep].sort().values
+
+
+def prune(model, sparsity):
+    """
+    :param model: UNet1D.
+    :param sparsity: float in [0, 1). Fraction of the channels of each group to remove.
+    :return: A new UNet1D of the same class with the remaining channels and their weights.
+    """
+    mid_importance, out_importance = channel_importance(model)
+    mid_keep = [_keep(importance, sparsity) for importance in mid_importance]
+    out_keep = [_keep(importance, sparsity) for importance in out_importance]
+    # both blocks of a skip connection keep the same channels
+    for first, second in SKIP_CONNECTIONS:
+        out_keep[second] = out_keep[first]
+
+    block_widths = [[len(m), len(o)] for m, o in zip(mid_keep, out_keep)]
+    pruned = type(model)(**dict(model.hparams, block_widths=block_widths))
+
+    with torch.no_grad():
+        in_keep = torch.arange(model.in_channels)
+        for i in range(9):
+            block = getattr(model, f"conv{i + 1}")
+            pruned_block = getattr(pruned, f"conv{i + 1}")
+            pruned_block.conv1.weight.copy_(block.conv1.weight[mid_keep[i]][:, in_keep])
+            pruned_block.conv1.bias.copy_(block.conv1.bias[mid_keep[i]])
+            pruned_block.conv2.weight.copy_(
+                block.conv2.weight[out_keep[i]][:, mid_keep[i]]
+            )
+            pruned_block.conv2.bias.copy_(block.conv2.bias[out_keep[i]])
+            in_keep = out_keep[i]
+        pruned.conv_out.weight.copy_(model.conv_out.weight[:, in_keep])
+        pruned.conv_out.bias.copy_(model.conv_out.bias)
+    return pruned
+
+
+def _batches(files, vertical_trim, mask_flag, batch_size, shuffle, seed):
+    dataset = SpectrogramDatasetMultiLabel(
+        files, vertical_trim=vertical_trim, mask_flag=mask_flag
+    )
+    collate_fn = PadCollate(mask_flag=mask_flag, n_buffers=0)
+    sampler = BucketBatchSampler(
+        dataset.lengths(), batch_size, shuffle=shuffle, seed=seed
+    )
+    return [collate_fn([dataset[i] for i in batch]) for batch in sampler]
+
+
+@torch.no_grad()
+def evaluate(model, batches, repeats=3):
+    """
+    :return: dict. Mean loss and frame accuracy of :param model: over :param batches:, and labeled frames per second
+    of its forward passes (the fastest of :param repeats: timed passes, after a warmup pass).
+    """
+    model.eval()
+    losses, correct, labels = [], 0, 0
+    for batch in batches:
+        loss, batch_correct, batch_labels = model._shared_step(batch)
+        losses.append(loss.item())
+        correct += int(batch_correct)
+        labels += int(batch_labels)
+
+    seconds = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        for features, masks, _ in batches:
+            model(features, masks)
+        seconds.append(time.perf_counter() - begin)
+    frames = sum(int((~masks).sum()) for _, masks, _ in batches)
+    return {
+        "loss": float(np.mean(losses)),
+        "accuracy": correct / max(labels, 1),
+        "frames_per_s": frames / min(seconds),
+    }
+
+
+def finetune(model, batches, epochs, learning_rate, seed=0):
+    """
+    Train :param model: on :param batches: (shuffled every epoch) for :param epochs: epochs.
+    """
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    rng = np.random.default_rng(seed)
+    model.train()
+    for epoch in range(epochs):
+        losses = []
+        for i in rng.permutation(len(batches)):
+            optimizer.zero_grad()
+            loss = model._shared_step(batches[i])[0]
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        logger.info(f"Fine-tuning epoch {epoch}: loss {np.mean(losses):.4f}.")
+
+
+def prune_model(
+    model_class,
+    saved_model_path,
+    output_directory,
+    validation_files,
+    train_files=(),
+    sparsities=(0.25, 0.5, 0.75),
+    finetune_epochs=0,
+    batch_size=32,
+    learning_rate=1e-3,
+    vertical_trim=20,
+    num_threads=4,
+    seed=0,
+):
+    """
+    Prune the model saved at :param saved_model_path: to each of :param sparsities:, fine-tune it for
+    :param finetune_epochs: epochs on :param train_files: (if > 0) and save it to
+    output_directory/sparsity_<sparsity>/model.pt - a directory `disco infer` can take as saved_model_directory.
+    Writes the accuracy/throughput curve measured on :param validation_files: to output_directory/prune_curve.csv
+    (one row per sparsity, the unpruned model first) and output_directory/prune_report.json.
+
+    :param validation_files: list of str. Labeled .pkl examples to measure accuracy and throughput on.
+    :param train_files: list of str. Labeled .pkl examples to fine-tune on.
+    :return: pd.DataFrame. The curve.
+    """
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+    model = model_class.load_from_checkpoint(
+        saved_model_path, map_location=torch.device("cpu")
+    )
+    mask_flag = model.mask_character
+    validation_batches = _batches(
+        validation_files, vertical_trim, mask_flag, batch_size, False, seed
+    )
+    if not validation_batches:
+        raise ValueError("No validation examples to measure pruned models on.")
+    train_batches = []
+    if finetune_epochs > 0:
+        train_batches = _batches(
+            train_files, vertical_trim, mask_flag, batch_size, True, seed
+        )
+        if not train_batches:
+            raise ValueError("Fine-tuning needs train_files.")
+
+    def parameters(m):
+        return sum(p.numel() for p in m.parameters())
+
+    rows = [
+        {
+            "sparsity": 0.0,
+            "parameters": parameters(model),
+            **evaluate(model, validation_batches),
+        }
+    ]
+    logger.info(f"Unpruned: {rows[0]}")
+    block_widths = {0.0: model.block_widths}
+    for sparsity in sparsities:
+        pruned = prune(model, sparsity)
+        row = {"sparsity": sparsity, "parameters": parameters(pruned)}
+        metrics = evaluate(pruned, validation_batches)
+        if finetune_epochs > 0:
+            # before fine-tuning; the throughput doesn't change
+            row.update({f"pruned_{k}": metrics[k] for k in ("loss", "accuracy")})
+            finetune(pruned, train_batches, finetune_epochs, learning_rate, seed)
+            metrics = evaluate(pruned, validation_batches)
+        row.update(metrics)
+
+        directory = os.path.join(output_directory, f"sparsity_{sparsity:.2f}")
+        os.makedirs(directory, exist_ok=True)
+        save_model_checkpoint(pruned, os.path.join(directory, MODEL_FILE))
+        row["model_path"] = os.path.join(directory, MODEL_FILE)
+        block_widths[sparsity] = pruned.block_widths
+        rows.append(row)
+        logger.info(
+            f"Sparsity {sparsity:.2f}: {row['parameters']} parameters, accuracy {row['accuracy']:.4f}, "
+            f"{row['frames_per_s'] / rows[0]['frames_per_s']:.2f}x the unpruned throughput."
+        )
+
+    curve = pd.DataFrame(rows)
+    curve["speedup"] = curve["frames_per_s"] / rows[0]["frames_per_s"]
+    os.makedirs(output_directory, exist_ok=True)
+    curve.to_csv(os.path.join(output_directory, CURVE_FILE), index=False)
+    with open(os.path.join(output_directory, REPORT_FILE), "w") as dst:
+        json.dump(
+            {
+                "saved_model_path": saved_model_path,
+                "finetune_epochs": finetune_epochs,
+                "validation_examples": len(validation_files),
+                "curve": curve.to_dict(orient="records"),
+                "block_widths": {str(k): v for k, v in block_widths.items()},
+            },
+            dst,
+            indent=2,
+        )
+    return curve
@@ -0,0 +1,279 @@
+"""
+Run `disco train` over a grid or random search of train config entries, several runs at a time.
+
+Runs are named by a hash of their config and live in sweep_directory/runs/<name>. A run is done once its
+result.json records success, so rerunning an interrupted sweep with the same spec skips finished runs and restarts the
+rest from scratch. Each worker process trains its runs one after another with a limited number of threads and keeps
+the datasets it loaded for later runs with the same dataset arguments.
+"""
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+RESULT_FILE = "result.json"
+DISTRIBUTIONS = ("uniform", "log_uniform", "int_uniform", "choice")
+
+
+def _is_distribution(value):
+    return (
+        isinstance(value, dict)
+        and len(value) == 1
+        and next(iter(value)) in DISTRIBUTIONS
+    )
+
+
+def flatten(spec, is_leaf=lambda value: not isinstance(value, dict), prefix=""):
+    """
+    :param spec: dict of train config entries, nested as in the config (ex: {"model_args": {"learning_rate": v}}).
+    :return: dict mapping dotted config entries (ex: "model_args.learning_rate") to the leaves of :param spec:.
+    """
+    entries = {}
+    for key, value in (spec or {}).items():
+        if is_leaf(value):
+            entries[prefix + key] = value
+        else:
+            entries.update(flatten(value, is_leaf, prefix=f"{prefix}{key}."))
+    return entries
+
+
+def _sample(distribution, rng):
+    """
+    :param distribution: dict with one key: "uniform" or "log_uniform" ([low, high]), "int_uniform" ([low, high],
+    inclusive) or "choice" (a list of values).
+    """
+    ((kind, values),) = distribution.items()
+    if kind == "uniform":
+        return float(rng.uniform(*values))
+    if kind == "log_uniform":
+        return float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+    if kind == "int_uniform":
+        return int(rng.integers(values[0], values[1] + 1))
+    if kind == "choice":
+        value = values[rng.integers(len(values))]
+        return value.item() if isinstance(value, np.generic) else value
+
+
+def run_name(updates, base_updates=None, named_configs=()):
+    """
+    :return: str. Name of the run with :param updates:, which changes with anything that changes its config.
+    """
+    description = [updates, base_updates or {}, list(named_configs)]
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[
+        :12
+    ]
+
+
+def expand_sweep(grid=None, random=None, n_random=0, repeats=1, seed=0):
+    """
+    List the config updates of every run: each combination of :param grid: values, with each of :param n_random:
+    draws from :param random:'s distributions (if any), :param repeats: times with the sacred seeds seed, seed + 1, ...
+
+    :param grid: dict of train config entries (nested as in the config) with lists of values.
+    :param random: dict of train config entries with distributions (see _sample).
+    :return: list of dicts mapping dotted config entries to values.
+    """
+    grid = flatten(grid)
+    random = flatten(random, _is_distribution)
+    for key, values in grid.items():
+        if not isinstance(values, (list, tuple)):
+            raise ValueError(f"Grid entry {key} should be a list of values.")
+    keys = list(grid)
+    grid_points = [
+        dict(zip(keys, values)) for values in itertools.product(*grid.values())
+    ]
+
+    rng = np.random.default_rng(seed)
+    draws = [
+        {key: _sample(distribution, rng) for key, distribution in random.items()}
+        for _ in range(n_random if random else 1)
+    ]
+
+    return [
+        dict(point, **draw, seed=seed + repeat)
+        for point in grid_points
+        for draw in draws
+        for repeat in range(repeats)
+    ]
+
+
+def _train_run(job):
+    import torch
+
+    import disco_sound
+    from disco_sound.callbacks import CallbackSet
+    from disco_sound.cfg import train_experiment
+
+    torch.set_num_threads(job["num_threads"])
+    if disco_sound.dataset_cache is None:
+        disco_sound.dataset_cache = {}
+
+    run_directory = job["run_directory"]
+    shutil.rmtree(run_directory, ignore_errors=True)
+    os.makedirs(run_directory)
+
+    result = {"run": job["name"], "updates": job["updates"]}
+    begin = time.perf_counter()
+    try:
+        # _observer appends this run's observer; train() logs to the first one
+        train_experiment.observers.clear()
+        CallbackSet.reset()
+        run = train_experiment.run(
+            config_updates=dict(
+                flatten(job["base_updates"]), **job["updates"], log_dir=run_directory
+            ),
+            named_configs=job["named_configs"],
+        )
+        result["status"] = "done"
+        result["metrics"] = run.result or {}
+    except Exception:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    result["wall_s"] = time.perf_counter() - begin
+    result["finished_at"] = time.time()
+
+    with open(os.path.join(run_directory, f"{RESULT_FILE}.partial"), "w") as dst:
+        json.dump(result, dst, indent=2)
+    os.replace(
+        os.path.join(run_directory, f"{RESULT_FILE}.partial"),
+        os.path.join(run_directory, RESULT_FILE),
+    )
+    return result
+
+
+def load_result(run_directory):
+    """
+    :return: dict. The result recorded in :param run_directory:, or None.
+    """
+    try:
+        with open(os.path.join(run_directory, RESULT_FILE)) as src:
+            return json.load(src)
+    except (OSError, ValueError):
+        return None
+
+
+def results_table(sweep_directory):
+    """
+    One row per finished or failed run: the swept config entries, status, wall time and final metrics (logged
+    metrics of the last epoch, and best_val_loss and best_model_path of the best checkpoint).
+    :return: pd.DataFrame, sorted by best_val_loss.
+    """
+    runs_directory = os.path.join(sweep_directory, "runs")
+    rows = []
+    for name in (
+        sorted(os.listdir(runs_directory)) if os.path.isdir(runs_directory) else []
+    ):
+        result = load_result(os.path.join(runs_directory, name))
+        if result is None:
+            continue
+        rows.append(
+            {
+                "run": result["run"],
+                **result["updates"],
+                "status": result["status"],
+                "wall_s": result["wall_s"],
+                "finished_at": pd.Timestamp(result["finished_at"], unit="s"),
+                **result.get("metrics", {}),
+            }
+        )
+    table = pd.DataFrame(rows)
+    if "best_val_loss" in table:
+        table = table.sort_values("best_val_loss")
+    return table
+
+
+def run_sweep(
+    sweep_directory,
+    grid=None,
+    random=None,
+    n_random=0,
+    repeats=1,
+    seed=0,
+    base_updates=None,
+    named_configs=(),
+    max_concurrent=1,
+    threads_per_run=None,
+):
+    """
+    Train every run of the sweep (see expand_sweep) that isn't done yet, :param max_concurrent: at a time, and write
+    sweep_directory/results.csv (see results_table) as runs finish.
+
+    :param base_updates: dict. Train config updates shared by every run (ex: {"trainer_args": {"max_epochs": 20}}).
+    :param named_configs: list of str. Named train configs to apply before the updates.
+    :param threads_per_run: int. Torch threads of each run. Defaults to the CPU count divided by max_concurrent.
+    DataLoader workers (dataloader_args.num_workers) come on top.
+    :return: pd.DataFrame. The results table.
+    """
+    runs = expand_sweep(grid, random, n_random, repeats, seed)
+    os.makedirs(sweep_directory, exist_ok=True)
+    with open(os.path.join(sweep_directory, "sweep.json"), "w") as dst:
+        json.dump(
+            {
+                "grid": grid,
+                "random": random,
+                "n_random": n_random,
+                "repeats": repeats,
+                "seed": seed,
+                "base_updates": base_updates,
+                "named_configs": list(named_configs),
+            },
+            dst,
+            indent=2,
+        )
+
+    threads_per_run = threads_per_run or max(1, (os.cpu_count() or 1) // max_concurrent)
+    jobs = []
+    for updates in runs:
+        name = run_name(updates, base_updates, named_configs)
+        run_directory = os.path.join(sweep_directory, "runs", name)
+        result = load_result(run_directory)
+        if result is not None and result["status"] == "done":
+            continue
+        jobs.append(
+            {
+                "name": name,
+                "updates": updates,
+                "base_updates": base_updates or {},
+                "named_configs": list(named_configs),
+                "run_directory": run_directory,
+                "num_threads": threads_per_run,
+            }
+        )
+    logger.info(
+        f"{len(runs) - len(jobs)} of {len(runs)} runs already done; training {len(jobs)}, "
+        f"{max_concurrent} at a time with {threads_per_run} threads each."
+    )
+
+    results_csv = os.path.join(sweep_directory, "results.csv")
+    if jobs:
+        with ProcessPoolExecutor(
+            max_workers=max_concurrent, mp_context=get_context("spawn")
+        ) as executor:
+            for future in as_completed([executor.submit(_train_run, j) for j in jobs]):
+                result = future.result()
+                if result["status"] == "done":
+                    logger.info(
+                        f"Run {result['run']} {result['updates']} finished in {result['wall_s']:.1f}s: "
+                        f"{result['metrics']}"
+                    )
+                else:
+                    logger.error(
+                        f"Run {result['run']} {result['updates']} failed:\n{result['error']}"
+                    )
+                results_table(sweep_directory).to_csv(results_csv, index=False)
+
+    table = results_table(sweep_directory)
+    table.to_csv(results_csv, index=False)
+    logger.info(f"Results of {len(table)} runs are in {results_csv}.")
+    return table
@@ -0,0 +1,210 @@
+"""
+Spectrogram augmentations applied to training examples as they're loaded, so every epoch sees a differently
+augmented corpus without extracting it more than once.
+
+Each transform acts on one (rows x frames) float32 feature array and draws its randomness from the np.random.Generator
+it's given. Augmentations seeds a generator per example from (seed, epoch, index), so an example's augmentation
+doesn't depend on which DataLoader worker loads it, and runs the transforms on a copy of the features.
+"""
+import numpy as np
+import torch
+
+
+class Transform:
+    """
+    :param p: float. Probability of applying the transform to an example.
+    """
+
+    def __init__(self, p=1.0):
+        self.p = p
+
+    def __call__(self, features, rng, log2):
+        """
+        :param features: np.array (rows x frames). May be modified in place.
+        :param rng: np.random.Generator.
+        :param log2: bool. Whether :param features: are log2 power rather than power.
+        :return: np.array. The augmented features.
+        """
+        if self.p < 1 and rng.random() >= self.p:
+            return features
+        return self.apply(features, rng, log2)
+
+    def apply(self, features, rng, log2):
+        raise NotImplementedError()
+
+
+def _power(features, log2):
+    return np.exp2(features) if log2 else features
+
+
+def _from_power(power, log2):
+    return np.log2(power, out=power) if log2 else power
+
+
+class AddNoise(Transform):
+    """
+    Add white noise in the power domain: each bin gets exponentially distributed noise power (the distribution of a
+    white noise spectrum's power) with a mean set by a signal to noise ratio drawn from :param snr:.
+
+    :param snr: tuple (min, max). Range of the signal to noise ratio in dB.
+    """
+
+    def __init__(self, snr=(10, 40), p=1.0):
+        super().__init__(p)
+        self.snr = snr
+
+    def apply(self, features, rng, log2):
+        power = _power(features, log2)
+        snr = rng.uniform(*self.snr)
+        noise_power = power.mean() / 10 ** (snr / 10)
+        power += noise_power * rng.standard_exponential(power.shape, dtype=np.float32)
+        return _from_power(power, log2)
+
+
+def _gaussians(length, n, spread, rng):
+    """
+    :return: np.array (n x length). Gaussians centered uniformly over the length, with standard deviations drawn
+    from :param spread:.
+    """
+    centers = rng.uniform(0, length, n)[:, None]
+    deviations = rng.uniform(*spread, n)[:, None]
+    return np.exp(-(((np.arange(length) - centers) / deviations) ** 2) / 2)
+
+
+class AddBeeps(Transform):
+    """
+    Add distractor beeps: blobs that are gaussian in both time and frequency, as add_gaussian_beeps adds to
+    waveforms at extraction time.
+
+    :param n_beeps: tuple (min, max). Range of the number of beeps per example.
+    :param width: tuple (min, max). Range of the beeps' standard deviation in frames.
+    :param height: tuple (min, max). Range of the beeps' standard deviation in rows.
+    :param strength: tuple (min, max). Range of the beeps' peak power in dB relative to the example's mean power.
+    """
+
+    def __init__(
+        self, n_beeps=(1, 5), width=(2, 20), height=(1, 4), strength=(0, 20), p=1.0
+    ):
+        super().__init__(p)
+        self.n_beeps = n_beeps
+        self.width = width
+        self.height = height
+        self.strength = strength
+
+    def apply(self, features, rng, log2):
+        rows, frames = features.shape
+        n = rng.integers(self.n_beeps[0], self.n_beeps[1] + 1)
+        if n == 0:
+            return features
+
+        power = _power(features, log2)
+        amplitude = power.mean() * 10 ** (rng.uniform(*self.strength, n) / 10)
+        in_time = _gaussians(frames, n, self.width, rng)
+        in_frequency = _gaussians(rows, n, self.height, rng)
+        # (rows x n) @ (n x frames) sums every beep in one product
+        power += ((in_frequency * amplitude[:, None]).T @ in_time).astype(np.float32)
+        return _from_power(power, log2)
+
+
+def _spans(length, n_masks, max_width, rng):
+    """
+    :return: np.array (length) of bool. True within :param n_masks: random spans of up to :param max_width:.
+    """
+    widths = rng.integers(0, max_width + 1, n_masks)
+    starts = rng.integers(0, np.maximum(length - widths, 0) + 1)
+    positions = np.arange(length)
+    return (
+        (positions >= starts[:, None]) & (positions < (starts + widths)[:, None])
+    ).any(axis=0)
+
+
+class TimeMask(Transform):
+    """
+    Replace :param n_masks: spans of up to :param max_width: frames with the example's mean (SpecAugment time
+    masking). Labels are left as they are.
+    """
+
+    def __init__(self, max_width=20, n_masks=1, p=1.0):
+        super().__init__(p)
+        self.max_width = max_width
+        self.n_masks = n_masks
+
+    def apply(self, features, rng, log2):
+        features[
+            :, _spans(features.shape[1], self.n_masks, self.max_width, rng)
+        ] = features.mean()
+        return features
+
+
+class FrequencyMask(Transform):
+    """
+    Replace :param n_masks: spans of up to :param max_width: rows with the example's mean (SpecAugment frequency
+    masking).
+    """
+
+    def __init__(self, max_width=8, n_masks=1, p=1.0):
+        super().__init__(p)
+        self.max_width = max_width
+        self.n_masks = n_masks
+
+    def apply(self, features, rng, log2):
+        features[
+            _spans(features.shape[0], self.n_masks, self.max_width, rng)
+        ] = features.mean()
+        return features
+
+
+TRANSFORMS = {
+    "AddNoise": AddNoise,
+    "AddBeeps": AddBeeps,
+    "TimeMask": TimeMask,
+    "FrequencyMask": FrequencyMask,
+}
+
+
+class Augmentations:
+    """
+    Apply :param transforms: in order to training examples.
+    Call set_epoch at the start of each epoch (disco train's callbacks do); the epoch is kept in shared memory so
+    persistent DataLoader workers see it too.
+
+    :param transforms: list of Transforms, or a dict mapping names in TRANSFORMS to their keyword arguments as
+    written in the train config (ex: {"AddNoise": {"snr": (10, 30), "p": 0.5}, "TimeMask": {}}).
+    :param seed: int. Equal seeds give equal augmentations for each (epoch, example index).
+    :param log2: bool. Whether the features are log2 power, as datasets with apply_log serve them.
+    """
+
+    def __init__(self, transforms, seed=0, log2=True):
+        if isinstance(transforms, dict):
+            unknown = set(transforms) - set(TRANSFORMS)
+            if unknown:
+                raise ValueError(
+                    f"Unknown augmentations {sorted(unknown)}, choose from {list(TRANSFORMS)}."
+                )
+            transforms = [
+                TRANSFORMS[name](**(kwargs or {}))
+                for name, kwargs in transforms.items()
+            ]
+        self.transforms = list(transforms)
+        self.seed = seed
+        self.log2 = log2
+        self._epoch = torch.zeros(1, dtype=torch.int64)
+        self._epoch.share_memory_()
+
+    def set_epoch(self, epoch):
+        self._epoch[0] = epoch
+
+    def __call__(self, features, idx):
+        """
+        :param features: (rows x frames) array or tensor. Not modified.
+        :param idx: int. Index of the example in its dataset.
+        :return: torch.Tensor. Augmented float32 copy of :param features:.
+        """
+        rng = np.random.default_rng((self.seed, int(self._epoch[0]), int(idx)))
+        features = np.array(features, dtype=np.float32)
+        for transform in self.transforms:
+            features = transform(features, rng, self.log2)
+        return torch.from_numpy(features)
+
+    def __len__(self):
+        return len(self.transforms)
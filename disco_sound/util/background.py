@@ -0,0 +1,153 @@
+"""
+Work moved off the training loop: checkpoint serialization and diagnostic figures.
+
+Jobs run in order on one background thread per BackgroundWorker, from snapshots taken on the training thread (tensors
+copied to the CPU), so training can carry on modifying the originals. A worker holds at most max_pending jobs; past
+that, submitting either waits for the oldest to finish (checkpoints) or drops the job (figures).
+"""
+import logging
+import queue
+import threading
+import weakref
+
+import torch
+from pytorch_lightning.plugins.io import TorchCheckpointIO
+
+logger = logging.getLogger(__name__)
+
+_workers = weakref.WeakSet()
+_shared_workers = {}
+_shared_lock = threading.Lock()
+
+
+class BackgroundWorker:
+    """
+    Runs submitted functions in order on a daemon thread.
+
+    :param max_pending: int. Most jobs queued or running at once.
+    :param drop_when_full: bool. Whether to drop jobs submitted while max_pending are pending, instead of waiting.
+    """
+
+    def __init__(self, max_pending=2, drop_when_full=False, name="disco-background"):
+        self.max_pending = max_pending
+        self.drop_when_full = drop_when_full
+        self.dropped = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        _workers.add(self)
+
+    def _run(self):
+        while True:
+            fn, args = self._jobs.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception(f"Background job {fn.__name__} failed.")
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._slots.release()
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("A background job failed.") from error
+
+    def submit(self, fn, *args):
+        """
+        Run fn(*args) in the background. Raises the error of a job that failed since the last call.
+        :return: bool. False if the job was dropped.
+        """
+        self._raise_error()
+        if not self._slots.acquire(blocking=not self.drop_when_full):
+            self.dropped += 1
+            return False
+        self._jobs.put((fn, args))
+        return True
+
+    def wait(self):
+        """
+        Block until every submitted job has run. Raises the error of a job that failed since the last call.
+        """
+        self._jobs.join()
+        self._raise_error()
+
+
+def shared_worker(name, **kwargs):
+    """
+    :return: BackgroundWorker. The process' worker called :param name:, created with :param kwargs: on first use.
+    """
+    with _shared_lock:
+        if name not in _shared_workers:
+            _shared_workers[name] = BackgroundWorker(name=name, **kwargs)
+        return _shared_workers[name]
+
+
+def wait_all():
+    """
+    Block until the jobs of every BackgroundWorker of the process have run.
+    """
+    for worker in list(_workers):
+        worker.wait()
+
+
+def snapshot(obj):
+    """
+    :return: A copy of :param obj: (nested dicts, lists and tuples) whose tensors are detached CPU copies.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, "_fields"):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointIO(TorchCheckpointIO):
+    """
+    Saves and removes checkpoints on a background thread (pass it to the Trainer in plugins). The training thread
+    only copies the checkpoint's tensors to the CPU; serializing and writing happen in the background, in order with
+    removals of older checkpoints. Saves wait once :param max_pending: are pending.
+    Loading a checkpoint, and teardown, wait for pending saves first.
+    """
+
+    def __init__(self, max_pending=2):
+        super().__init__()
+        self.max_pending = max_pending
+        self._worker = None
+
+    @property
+    def worker(self):
+        if self._worker is None:
+            self._worker = BackgroundWorker(self.max_pending, name="disco-checkpoints")
+        return self._worker
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None):
+        self.worker.submit(
+            super().save_checkpoint, snapshot(checkpoint), path, storage_options
+        )
+
+    def remove_checkpoint(self, path):
+        self.worker.submit(super().remove_checkpoint, path)
+
+    def load_checkpoint(self, *args, **kwargs):
+        self.wait()
+        return super().load_checkpoint(*args, **kwargs)
+
+    def wait(self):
+        if self._worker is not None:
+            self._worker.wait()
+
+    def teardown(self):
+        self.wait()
+
+    def __getstate__(self):
+        # threads can't be pickled (ex: by ddp_spawn); a copy starts its own worker
+        state = self.__dict__.copy()
+        state["_worker"] = None
+        return state
@@ -0,0 +1,102 @@
+"""
+Caching for datasets that load examples on demand.
+"""
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.utils.data
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the total size of its values in bytes.
+
+    :param max_bytes: int. Values are evicted, oldest use first, once their total size exceeds this.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: The value cached under :param key:, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        """
+        Cache :param value: under :param key:. Values larger than the whole cache aren't stored.
+        :param nbytes: int. Size of :param value: in bytes.
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # locks can't be pickled; a copy sent to another process starts empty with its own lock
+        state = self.__dict__.copy()
+        state["_entries"] = OrderedDict()
+        state["nbytes"] = 0
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class CacheStats:
+    """
+    Cache counters shared by the main process and every DataLoader worker. Each worker only writes its own row of a
+    shared-memory tensor, so no locking is needed, and totals() sums the rows.
+
+    :param max_workers: int. Workers with ids past this share rows (their counts are still totalled correctly, but
+    concurrent updates from them may race).
+    """
+
+    FIELDS = ("hits", "misses", "io_wait_s", "bytes_read")
+
+    def __init__(self, max_workers=64):
+        self.counts = torch.zeros(
+            (max_workers + 1, len(self.FIELDS)), dtype=torch.float64
+        )
+        self.counts.share_memory_()
+
+    def _row(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return 0
+        return 1 + worker_info.id % (self.counts.shape[0] - 1)
+
+    def add(self, field, value=1):
+        self.counts[self._row(), self.FIELDS.index(field)] += value
+
+    def totals(self):
+        return dict(zip(self.FIELDS, self.counts.sum(dim=0).tolist()))
+
+    def reset(self):
+        self.counts.zero_()
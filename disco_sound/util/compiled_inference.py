@@ -0,0 +1,118 @@
+"""
+Compiled CPU inference for ensemble members.
+
+Models are traced (including their padding logic) for one fixed tile shape, frozen and optimized for inference so
+convolutions can run on oneDNN (MKLDNN) kernels. Compiled TorchScript modules are cached on disk, keyed by the
+model weights, the tile shape and the torch version, so the compile cost is only paid the first time.
+"""
+import hashlib
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+COMPILE_BACKENDS = ("torchscript", "compile")
+
+
+class CompiledModel(torch.nn.Module):
+    """
+    Runs a compiled model on tiles of a fixed shape. The traced graph doesn't depend on the batch size, so smaller
+    batches (ex: the last batch of a recording) run as they are; larger ones are split.
+    """
+
+    def __init__(self, compiled, tile_shape):
+        super(CompiledModel, self).__init__()
+        self.compiled = compiled
+        self.tile_shape = tuple(tile_shape)
+
+    def forward(self, x):
+        if tuple(x.shape[1:]) != self.tile_shape[1:]:
+            raise ValueError(
+                f"Model was compiled for tiles of shape {self.tile_shape[1:]}, got {tuple(x.shape[1:])}."
+            )
+
+        if x.shape[0] > self.tile_shape[0]:
+            return torch.cat([self.compiled(b) for b in x.split(self.tile_shape[0])])
+
+        return self.compiled(x)
+
+
+def _cache_key(model, tile_shape, backend):
+    digest = hashlib.sha256()
+    digest.update(type(model).__name__.encode())
+    digest.update(repr(tuple(tile_shape)).encode())
+    digest.update(backend.encode())
+    digest.update(torch.__version__.encode())
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:32]
+
+
+def _trace(model, tile_shape):
+    example = torch.zeros(tile_shape)
+    with torch.no_grad():
+        traced = model.to_torchscript(method="trace", example_inputs=example)
+        frozen = torch.jit.freeze(traced.eval())
+        return torch.jit.optimize_for_inference(frozen)
+
+
+def compile_model(model, tile_shape, backend="torchscript", cache_directory=None):
+    """
+    Compile a model for CPU inference on inputs of shape :param tile_shape:.
+    :param model: pl.LightningModule (ex: UNet1D) in eval mode.
+    :param tile_shape: tuple (batch size, channels, tile length) the model will be run on.
+    :param backend: "torchscript" (trace + freeze + optimize_for_inference, cached on disk) or "compile"
+    (torch.compile, when the installed torch provides it; its own on-disk cache lives under :param cache_directory:).
+    :param cache_directory: str. Where compiled models are cached. No caching if None.
+    :return: CompiledModel.
+    """
+    if backend not in COMPILE_BACKENDS:
+        raise ValueError(f"backend must be one of {COMPILE_BACKENDS}, got {backend}")
+
+    model = model.to("cpu").eval()
+
+    if backend == "compile":
+        if not hasattr(torch, "compile"):
+            raise ValueError(
+                f"torch.compile is not available in torch {torch.__version__}, use backend='torchscript'."
+            )
+        if cache_directory is not None:
+            os.environ.setdefault(
+                "TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_directory, "inductor")
+            )
+        return CompiledModel(torch.compile(model, dynamic=False), tile_shape)
+
+    if cache_directory is None:
+        return CompiledModel(_trace(model, tile_shape), tile_shape)
+
+    os.makedirs(cache_directory, exist_ok=True)
+    cache_path = os.path.join(
+        cache_directory, _cache_key(model, tile_shape, backend) + ".torchscript"
+    )
+
+    if os.path.isfile(cache_path):
+        logger.info(f"Loading compiled model from {cache_path}.")
+        compiled = torch.jit.load(cache_path, map_location="cpu")
+    else:
+        logger.info(f"Compiling model for tiles of shape {tuple(tile_shape)}.")
+        compiled = _trace(model, tile_shape)
+        # write to a temporary file first so an interrupted save never leaves a corrupt cache entry.
+        tmp_path = cache_path + f".{os.getpid()}.tmp"
+        torch.jit.save(compiled, tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    return CompiledModel(compiled, tile_shape)
+
+
+def compile_ensemble(models, tile_shape, backend="torchscript", cache_directory=None):
+    """
+    Compile every model of an ensemble. See compile_model.
+    :return: List of CompiledModels.
+    """
+    return [
+        compile_model(m, tile_shape, backend=backend, cache_directory=cache_directory)
+        for m in models
+    ]
@@ -0,0 +1,233 @@
+"""
+Concurrent, resumable downloads of the pretrained model checkpoints.
+
+Files are streamed to a ".part" file next to their destination over a pooled requests.Session. An interrupted
+download is resumed with an HTTP range request the next time it's attempted. Each finished file is checked against
+the expected size (from the manifest, or the server's Content-Length) and, when the manifest has one, its sha256
+digest before being renamed into place, so a partial or corrupted checkpoint is never picked up by
+assemble_ensemble.
+"""
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+import tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 2**20
+PART_SUFFIX = ".part"
+
+
+class DownloadError(requests.RequestException):
+    pass
+
+
+def make_session(pool_size=8, retries=3, backoff_factor=0.5):
+    """
+    Create a requests.Session whose connection pool is large enough for :param pool_size: concurrent downloads.
+    Connection errors and 5xx responses are retried :param retries: times with exponential backoff.
+    :return: requests.Session.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def sha256sum(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    :return: str. The hex sha256 digest of the file at :param path:.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_file(path, size=None, sha256=None):
+    """
+    Check the file at :param path: against an expected :param size: in bytes and :param sha256: hex digest.
+    Either may be None to skip that check.
+    :return: None. Raises DownloadError on a mismatch.
+    """
+    actual_size = os.path.getsize(path)
+    if size is not None and actual_size != size:
+        raise DownloadError(f"{path} is {actual_size} bytes, expected {size}.")
+    if sha256 is not None:
+        actual_sha256 = sha256sum(path)
+        if actual_sha256 != sha256.lower():
+            raise DownloadError(
+                f"{path} has sha256 {actual_sha256}, expected {sha256.lower()}."
+            )
+
+
+def _content_range_total(response):
+    """
+    :return: int or None. The complete size reported by a "Content-Range: bytes a-b/total" header.
+    """
+    match = re.match(
+        r"bytes\s+(?:\d+-\d+|\*)/(\d+)", response.headers.get("Content-Range", "")
+    )
+    return int(match.group(1)) if match else None
+
+
+def download_file(
+    url,
+    destination,
+    session=None,
+    size=None,
+    sha256=None,
+    chunk_size=DOWNLOAD_CHUNK_SIZE,
+    timeout=60,
+    progress=None,
+):
+    """
+    Download :param url: to :param destination:, resuming from an existing partial download if there is one.
+    An existing :param destination: is kept if it passes verification and re-downloaded otherwise.
+    :param session: requests.Session to download with. A new one is created if None.
+    :param size: int. Expected size of the file in bytes. Taken from the response headers if None.
+    :param sha256: str. Expected hex sha256 digest of the file. Not checked if None.
+    :param chunk_size: int. Bytes read from the response and written to disk at a time.
+    :param timeout: float. Seconds to wait for the server to connect or send data.
+    :param progress: callable or None. Called with the number of bytes written after each chunk.
+    :return: str. The destination.
+    """
+    if os.path.isfile(destination):
+        try:
+            verify_file(destination, size, sha256)
+            return destination
+        except DownloadError as e:
+            logger.warning(f"{e} Downloading it again.")
+            os.remove(destination)
+
+    if session is None:
+        session = make_session(pool_size=1)
+
+    part = destination + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    if size is not None and offset > size:
+        os.remove(part)
+        offset = 0
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # the server has nothing past the end of the partial file: it was already complete
+            total = _content_range_total(response)
+            if total is None or total != offset:
+                os.remove(part)
+                raise DownloadError(
+                    f"Couldn't resume {url} from byte {offset} (code 416)."
+                )
+        elif response.status_code in (200, 206):
+            if response.status_code == 206:
+                mode = "ab"
+                total = _content_range_total(response)
+            else:
+                # the server ignored the range request: start over
+                mode = "wb"
+                offset = 0
+                total = response.headers.get("Content-Length")
+                total = int(total) if total is not None else None
+
+            with open(part, mode) as dst:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    dst.write(chunk)
+                    if progress is not None:
+                        progress(len(chunk))
+        else:
+            raise DownloadError(
+                f"Couldn't download {url} with code {response.status_code}"
+            )
+
+    try:
+        verify_file(part, size if size is not None else total, sha256)
+    except DownloadError:
+        # a corrupted partial download can't be resumed, so start from scratch next time
+        os.remove(part)
+        raise
+
+    os.replace(part, destination)
+    return destination
+
+
+def download_models(
+    directory,
+    aws_download_link,
+    model_ids=range(10),
+    manifest=None,
+    max_workers=4,
+    session=None,
+):
+    """
+    Download models from an AWS bucket.
+    :param directory: Where to save the models.
+    :param aws_download_link: The AWS link to download from. Formatted with each model id.
+    :param model_ids: Iterable of model ids to download. Model i is saved as model_{i}.pt.
+    :param manifest: dict or None. Maps model filenames to a dict with optional "size" and "sha256" keys that each
+    downloaded file is checked against.
+    :param max_workers: int. Number of files downloaded at once.
+    :param session: requests.Session to download with. A pooled session is created if None.
+    :return: list of str. Paths to the downloaded models. Raises DownloadError if any download failed; the others
+    are kept.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest = manifest if manifest is not None else {}
+    if session is None:
+        session = make_session(pool_size=max_workers)
+
+    jobs = {}
+    for model_id in model_ids:
+        filename = "model_{}.pt".format(model_id)
+        expected = manifest.get(filename, {})
+        jobs[filename] = dict(
+            url=aws_download_link.format(model_id),
+            destination=os.path.join(directory, filename),
+            size=expected.get("size"),
+            sha256=expected.get("sha256"),
+        )
+
+    paths = []
+    failures = []
+    with tqdm.tqdm(
+        unit="B", unit_scale=True, unit_divisor=1024, desc="download status"
+    ) as bar, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                download_file, session=session, progress=bar.update, **job
+            ): filename
+            for filename, job in jobs.items()
+        }
+        for future in as_completed(futures):
+            try:
+                paths.append(future.result())
+            except requests.RequestException as e:
+                failures.append(f"{futures[future]}: {e}")
+
+    if failures:
+        raise DownloadError(
+            "Couldn't download {} of {} models:\n{}".format(
+                len(failures), len(jobs), "\n".join(failures)
+            )
+        )
+
+    return sorted(paths)
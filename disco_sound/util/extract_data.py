@@ -9,6 +9,8 @@ import numpy as np
 import pandas as pd
 import torchaudio
 
+from disco_sound.util.inference_utils import load_wav_file
+from disco_sound.util.shards import Shard, ShardWriter, is_shard
 from disco_sound.util.util import add_gaussian_beeps, add_white_noise
 
 logger = logging.getLogger(__name__)
@@ -51,8 +53,8 @@ def create_label_to_spectrogram(
     :return: list: List of lists. Each sublist contains a feature tensor and the corresponding vector of labels.
     """
 
-    labels["begin spect idx"] = [w2s_idx(x, hop_length) for x in labels["begin idx"]]
-    labels["end spect idx"] = [w2s_idx(x, hop_length) for x in labels["end idx"]]
+    labels["begin spect idx"] = w2s_idx(labels["begin idx"], hop_length)
+    labels["end spect idx"] = w2s_idx(labels["end idx"], hop_length)
 
     contiguous_indices = []
     if labels.shape[0] == 1:
@@ -110,7 +112,7 @@ def convert_time_to_index(time, sample_rate):
     :param sample_rate: int. The sample rate of the .wav file.
     :return: int. converted index.
     """
-    return np.round(time * sample_rate).astype(np.int)
+    return np.round(time * sample_rate).astype(int)
 
 
 def extract_wav_and_csv_pair(
@@ -124,6 +126,7 @@ def extract_wav_and_csv_pair(
     name_to_class_code=None,
     excluded_classes=None,
     extract_context=None,
+    sample_rate=None,
 ):
 
     labels = pd.read_csv(csv_filename)
@@ -138,7 +141,7 @@ def extract_wav_and_csv_pair(
                 f" or that the .wav file has the name filename as the csv but with the .wav extension."
             )
 
-    waveform, sample_rate = torchaudio.load(wav_filename)
+    waveform, sample_rate = load_wav_file(wav_filename, sample_rate)
 
     if snr > 0:
         waveform = add_white_noise(waveform, snr=snr)
@@ -221,6 +224,28 @@ def save_data(out_path, data_list, filename_prefix, index_to_label, overwrite):
         fcount += 1
 
 
+def save_shard(out_path, data_list, overwrite, dtype="float32"):
+    """
+    Saves features and labels as a single shard (see disco_sound.util.shards) with log2 features.
+    Throws away labels > 10000 records, like save_data.
+    :param out_path: str. Directory of the shard.
+    :param data_list: List of 2-element lists, where the first element are the features and the second the point-wise
+    label vector.
+    :param overwrite: bool. Whether to replace an existing shard at :param out_path:.
+    :param dtype: str. "float32" or "float16".
+    :return: None.
+    """
+    if is_shard(out_path) and not overwrite:
+        logger.info(f"Found shard already at {out_path}. Not overwriting.")
+        return
+
+    with ShardWriter(out_path, dtype=dtype) as writer:
+        for features, label_vector in data_list:
+            if label_vector.shape[0] > 10000:
+                continue
+            writer.append(features, label_vector)
+
+
 def extract_single_file(
     csv_file,
     wav_file,
@@ -235,9 +260,15 @@ def extract_single_file(
     name_to_class_code,
     excluded_classes,
     extract_context=None,
+    sample_rate=None,
+    output_format="pickle",
+    shard_dtype="float32",
 ):
     """
     Extract data from a single .wav and .csv pair.
+    If :param sample_rate: is given the recording is resampled to it before the spectrogram is computed.
+    With :param output_format: "pickle" each example is saved to its own pickle file; with "shard" all of them are
+    packed into one shard named after the .csv, stored as :param shard_dtype:.
     """
     logger.info(f"Setting seed to {seed}")
     random.seed(seed)
@@ -254,30 +285,69 @@ def extract_single_file(
         name_to_class_code=name_to_class_code,
         excluded_classes=excluded_classes,
         extract_context=extract_context,
+        sample_rate=sample_rate,
     )
-    save_data(
-        output_data_path,
-        features_and_labels,
-        filename_prefix=os.path.basename(os.path.splitext(csv_file)[0]),
-        index_to_label=class_code_to_name,
-        overwrite=overwrite,
-    )
-
-
-def shuffle_data(data_directory, train_pct, extension, move, seed):
-    data_files = glob(os.path.join(data_directory, f"*{extension}"))
+    filename_prefix = os.path.basename(os.path.splitext(csv_file)[0])
+
+    if output_format == "shard":
+        save_shard(
+            os.path.join(output_data_path, filename_prefix + ".shard"),
+            features_and_labels,
+            overwrite=overwrite,
+            dtype=shard_dtype,
+        )
+    elif output_format == "pickle":
+        save_data(
+            output_data_path,
+            features_and_labels,
+            filename_prefix=filename_prefix,
+            index_to_label=class_code_to_name,
+            overwrite=overwrite,
+        )
+    else:
+        raise ValueError(
+            f"output_format must be 'pickle' or 'shard', got {output_format}."
+        )
 
-    logger.info(f"Setting seed for shuffling to {seed}.")
 
-    np.random.seed(seed)
-    indices = np.random.permutation(len(data_files))
+def split_indices(n, train_pct):
+    """
+    Randomly split range(:param n:) into train, validation and test indices. :param train_pct: of the indices go to
+    train and the rest is split evenly between test and validation.
+    """
+    indices = np.random.permutation(n)
     train_idx = indices[: int(len(indices) * train_pct)]
     the_rest = indices[int(len(indices) * train_pct) :]
     test_idx = the_rest[: len(the_rest) // 2]
     val_idx = the_rest[len(the_rest) // 2 :]
-    assert np.all(train_idx != test_idx)
-    assert np.all(train_idx != val_idx)
-    assert np.all(test_idx != val_idx)
+    assert not np.intersect1d(train_idx, test_idx).size
+    assert not np.intersect1d(train_idx, val_idx).size
+    assert not np.intersect1d(test_idx, val_idx).size
+    return train_idx, val_idx, test_idx
+
+
+def shuffle_data(
+    data_directory,
+    train_pct,
+    extension,
+    move,
+    seed,
+    output_format="pickle",
+    shard_dtype="float32",
+):
+    logger.info(f"Setting seed for shuffling to {seed}.")
+    np.random.seed(seed)
+
+    if output_format == "shard":
+        shuffle_into_shards(data_directory, train_pct, extension, shard_dtype)
+        return
+    elif output_format != "pickle":
+        raise ValueError(
+            f"output_format must be 'pickle' or 'shard', got {output_format}."
+        )
+
+    data_files = glob(os.path.join(data_directory, f"*{extension}"))
+    train_idx, val_idx, test_idx = split_indices(len(data_files), train_pct)
 
     train_split = [data_files[idx] for idx in train_idx]
     test_split = [data_files[idx] for idx in test_idx]
@@ -296,6 +366,45 @@ def shuffle_data(data_directory, train_pct, extension, move, seed):
     copy_or_move_files(test_path, test_split, move)
 
 
+def shuffle_into_shards(data_directory, train_pct, extension, dtype="float32"):
+    """
+    Split every example in :param data_directory: into train, validation and test shards, written to
+    data_directory/shards/{train,validation,test}. Examples can come from pickle files (with :param extension:) and
+    from shards written by disco extract (*.shard), so this also converts existing pickle directories.
+    Sources are left in place.
+    """
+    pickle_files = sorted(glob(os.path.join(data_directory, f"*{extension}")))
+    shards = [
+        Shard(d)
+        for d in sorted(glob(os.path.join(data_directory, "*.shard")))
+        if is_shard(d)
+    ]
+    # each example is (source, index in source); index is None for pickle files
+    examples = [(f, None) for f in pickle_files]
+    examples += [(shard, i) for shard in shards for i in range(len(shard))]
+    logger.info(
+        f"Found {len(examples)} examples in {len(pickle_files)} pickle files and {len(shards)} shards."
+    )
+
+    splits = dict(
+        zip(("train", "validation", "test"), split_indices(len(examples), train_pct))
+    )
+
+    for split, indices in splits.items():
+        out_path = os.path.join(data_directory, "shards", split)
+        logger.info(f"Saving {len(indices)} {split} examples to {out_path}.")
+        with ShardWriter(out_path, dtype=dtype) as writer:
+            for idx in indices:
+                source, example_idx = examples[idx]
+                if example_idx is None:
+                    with open(source, "rb") as src:
+                        features, labels = pickle.load(src)
+                    writer.append(features, labels)
+                else:
+                    features, labels = source[example_idx]
+                    writer.append(features, labels, log2_applied=source.log2)
+
+
 def copy_or_move_files(out_path, files, move):
     os.makedirs(out_path, exist_ok=True)
     # instead of a conditional
@@ -0,0 +1,102 @@
+"""
+Features of clip-level datasets (one label per .wav file), computed once and kept in a shard.
+
+The store for a list of files lives in a directory named after a hash of the files (paths, sizes and modification
+times) and the feature parameters, so changing n_fft or hop_length, or editing a file, selects a new store instead of
+serving stale features.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import torchaudio
+
+from disco_sound.util.inference_utils import load_wav_file
+from disco_sound.util.shards import Shard, ShardWriter, is_shard
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+
+
+class MelSpectrograms:
+    """
+    Mel spectrograms of waveforms, reusing one torchaudio transform per sample rate (and per process, as each
+    DataLoader worker gets its own copy).
+    """
+
+    def __init__(self, n_fft, hop_length):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self._transforms = {}
+
+    def __call__(self, waveform, sample_rate):
+        """
+        :return: torch.Tensor (mels x frames).
+        """
+        transform = self._transforms.get(sample_rate)
+        if transform is None:
+            transform = torchaudio.transforms.MelSpectrogram(
+                sample_rate=sample_rate, n_fft=self.n_fft, hop_length=self.hop_length
+            )
+            self._transforms[sample_rate] = transform
+        return transform(waveform).squeeze()
+
+
+def clip_labels(label_csv, files):
+    """
+    :param label_csv: str. csv indexed by file name (without directory), with a label column.
+    :return: np.array of the label of each of :param files:.
+    """
+    mapping = pd.read_csv(label_csv, index_col=0)["label"].to_dict()
+    names = [os.path.basename(f) for f in files]
+    missing = [name for name in names if name not in mapping]
+    if missing:
+        raise ValueError(
+            f"{len(missing)} files have no label in {label_csv} (ex: {missing[0]})."
+        )
+    return np.array([mapping[name] for name in names])
+
+
+def _store_key(files, spectrograms):
+    description = {
+        "version": STORE_VERSION,
+        "n_fft": spectrograms.n_fft,
+        "hop_length": spectrograms.hop_length,
+        "files": [
+            (os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns)
+            for f in files
+        ],
+    }
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()[:16]
+
+
+def feature_store(files, spectrograms, cache_directory):
+    """
+    Open the store of :param files:' features in :param cache_directory:, computing it first if it doesn't exist.
+    :param spectrograms: MelSpectrograms.
+    :return: Shard. Example i holds the features of files[i].
+    """
+    directory = os.path.join(cache_directory, _store_key(files, spectrograms))
+    if is_shard(directory):
+        return Shard(directory)
+
+    logger.info(f"Computing features of {len(files)} files into {directory}.")
+    # build beside the final location and rename it into place, so concurrent builders (ex: DDP ranks) never see a
+    # partial store
+    partial = f"{directory}.{os.getpid()}.partial"
+    with ShardWriter(partial, dtype="float32", log2=False) as writer:
+        for f in files:
+            features = spectrograms(*load_wav_file(f)).numpy()
+            # labels come from the label csv; the store only keeps features
+            writer.append(features, np.zeros(features.shape[-1], dtype=np.int16))
+    try:
+        os.rename(partial, directory)
+    except OSError:
+        # another process finished the same store first
+        shutil.rmtree(partial, ignore_errors=True)
+    return Shard(directory)
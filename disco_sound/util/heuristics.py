@@ -1,55 +1,179 @@
+"""
+Post-processing heuristics applied to smoothed predictions before they're written to a .csv.
+
+Each heuristic takes the run-length encoded predictions (an Intervals object), the class name mapping and the ensemble
+iqr, plus its own keyword parameters, and returns new Intervals. apply_heuristics runs an ordered list of them given as
+{"name": <key of HEURISTIC_FNS>, <parameters>} dicts; DEFAULT_HEURISTICS is the list `disco infer` and `disco evaluate`
+use unless configured otherwise.
+"""
 import logging
+import time
+
+import numpy as np
 
-import disco_sound.util.inference_utils as infer
+from disco_sound.util.intervals import Intervals
 
 log = logging.getLogger(__name__)
 
 
-def remove_a_chirps_in_between_b_chirps(
-    predictions, iqr, name_to_class_code, return_preds=True
+def min_duration(
+    intervals,
+    name_to_class_code,
+    iqr,
+    min_length=22,
+    relabel_as="BACKGROUND",
+):
+    """
+    Relabel runs shorter than :param min_length: spectrogram columns.
+    :param min_length: int. Shortest run that's kept.
+    :param relabel_as: str. Class given to the short runs. Runs of this class are never relabeled.
+    :return: Intervals.
+    """
+    new_class = name_to_class_code[relabel_as]
+    short = (intervals.lengths < min_length) & (intervals.classes != new_class)
+    return intervals.relabel(short, new_class).merge_adjacent()
+
+
+def remove_sandwiched(
+    intervals,
+    name_to_class_code,
+    iqr,
+    inner="A",
+    outer="B",
+    relabel_as="BACKGROUND",
+):
+    """
+    Relabel runs of class :param inner: directly in between two runs of class :param outer:.
+    :param inner: str. Class of the sandwiched runs.
+    :param outer: str. Class of the runs on either side.
+    :param relabel_as: str. Class given to the sandwiched runs.
+    :return: Intervals.
+    """
+    classes = intervals.classes
+    sandwiched = np.zeros(len(intervals), dtype=bool)
+    sandwiched[1:-1] = (
+        (classes[1:-1] == name_to_class_code[inner])
+        & (classes[:-2] == name_to_class_code[outer])
+        & (classes[2:] == name_to_class_code[outer])
+        & (intervals.starts[1:-1] == intervals.ends[:-2])
+        & (intervals.ends[1:-1] == intervals.starts[2:])
+    )
+    if np.any(sandwiched):
+        log.info(
+            f"found {np.count_nonzero(sandwiched)} {inner}(s) directly in between two {outer}s. "
+            f"Changing to {relabel_as}."
+        )
+    return intervals.relabel(
+        sandwiched, name_to_class_code[relabel_as]
+    ).merge_adjacent()
+
+
+def merge_gaps(
+    intervals,
+    name_to_class_code,
+    iqr,
+    max_gap=10,
+    gap_class="BACKGROUND",
+):
+    """
+    Merge runs of the same class separated by a short gap. A gap is either a run of :param gap_class: or a stretch
+    not covered by any run (ex: one dropped by another heuristic).
+    :param max_gap: int. Longest gap, in spectrogram columns, that's merged over.
+    :param gap_class: str. Class treated as a gap.
+    :return: Intervals.
+    """
+    gap_code = name_to_class_code[gap_class]
+    classes = intervals.classes
+    fill = np.zeros(len(intervals), dtype=bool)
+    fill[1:-1] = (
+        (classes[1:-1] == gap_code)
+        & (classes[:-2] == classes[2:])
+        & (classes[:-2] != gap_code)
+        & (intervals.lengths[1:-1] <= max_gap)
+    )
+    # the runs to fill take the class of their (identical) neighbors
+    filled_classes = classes.copy()
+    filled_classes[1:-1][fill[1:-1]] = classes[:-2][fill[1:-1]]
+    intervals = Intervals(intervals.starts, intervals.ends, filled_classes)
+    return intervals.merge_adjacent(max_gap=max_gap)
+
+
+def drop_high_iqr(
+    intervals,
+    name_to_class_code,
+    iqr,
+    max_iqr=0.5,
+    exclude=("BACKGROUND",),
 ):
     """
-    :param predictions: np.array (size 1xN) containing point-wise class predictions.
-    :param iqr: inter-quartile range of model ensemble.
+    Drop runs whose predicted class has a mean ensemble iqr above :param max_iqr:. Dropped runs are left out of the
+    .csv entirely.
+    :param iqr: np.array (classes x N) of the ensemble's inter-quartile range for each class.
+    :param max_iqr: float. Largest mean iqr of a run that's kept.
+    :param exclude: Classes that are never dropped.
+    :return: Intervals.
+    """
+    if iqr is None:
+        raise ValueError("drop_high_iqr requires the ensemble iqr.")
+
+    if len(intervals) == 0:
+        return intervals
+
+    iqr = np.asarray(iqr)
+    cumulative = np.concatenate(
+        (np.zeros((iqr.shape[0], 1)), np.cumsum(iqr, axis=1)), axis=1
+    )
+    classes = intervals.classes.astype(np.int64)
+    mean_iqr = (
+        cumulative[classes, intervals.ends] - cumulative[classes, intervals.starts]
+    ) / intervals.lengths
+
+    excluded = np.isin(classes, [name_to_class_code[c] for c in exclude])
+    drop = (mean_iqr > max_iqr) & ~excluded
+    if np.any(drop):
+        log.info(f"Dropping {np.count_nonzero(drop)} run(s) with mean iqr > {max_iqr}.")
+    return intervals[~drop]
+
+
+HEURISTIC_FNS = {
+    "min_duration": min_duration,
+    "remove_sandwiched": remove_sandwiched,
+    "merge_gaps": merge_gaps,
+    "drop_high_iqr": drop_high_iqr,
+}
+
+# the thresholds of the fixed post-processing `disco infer` used to apply (see
+# inference_utils.remove_a_chirps_in_between_b_chirps)
+DEFAULT_HEURISTICS = (
+    {"name": "min_duration", "min_length": 22},
+    {"name": "remove_sandwiched", "inner": "A", "outer": "B"},
+)
+
+
+def apply_heuristics(predictions, heuristics, name_to_class_code, iqr=None):
+    """
+    Run-length encode point-wise predictions and apply heuristics to them in order.
+    :param predictions: np.array (size N) of point-wise class predictions. Not modified.
+    :param heuristics: List of dicts, each with a "name" key from HEURISTIC_FNS and that heuristic's parameters.
     :param name_to_class_code: Mapping from name of class to the class code (ex: {"A":2}).
-    :param return_preds: bool, default True. Whether or not to return prediction array or a pd.DataFrame containing
-    records of begin, end, and sound type.
-    :return: prediction array or pd.DataFrame.
-    """
-
-    transitions = infer.aggregate_predictions(predictions)
-    new_list = []
-    for t in transitions:
-        x = t.copy()
-        if (
-            t["end"] - t["start"] <= 20
-            and t["class"] != name_to_class_code["BACKGROUND"]
-        ):
-            predictions[t["start"] : t["end"] + 1] = name_to_class_code["BACKGROUND"]
-            x["class"] = name_to_class_code["BACKGROUND"]
-            new_list.append(x)
-
-    for i in range(1, len(transitions) - 1):
-        current_dct = transitions[i]
-        current_class = current_dct["class"]
-        if (
-            current_class == name_to_class_code["A"]
-            and transitions[i - 1]["class"] == name_to_class_code["B"]
-            and transitions[i + 1]["class"] == name_to_class_code["B"]
-        ):
-            log.info(
-                f"found an A directly in between two Bs at position {current_dct['start']}. Changing to background."
-            )
-            current_dct["class"] == name_to_class_code["BACKGROUND"]
-            predictions[current_dct["start"] : current_dct["end"]] = name_to_class_code[
-                "BACKGROUND"
-            ]
-        new_list.append(current_dct)
+    :param iqr: np.array (classes x N). inter-quartile range of the model ensemble. Only needed by drop_high_iqr.
+    :return: tuple (Intervals, dict). The post-processed runs and the time in seconds spent in each heuristic.
+    """
+    intervals = Intervals.from_predictions(predictions)
+    timings = {}
 
-    if return_preds:
-        return predictions
-    else:
-        return new_list
+    for i, heuristic in enumerate(heuristics):
+        params = dict(heuristic)
+        name = params.pop("name")
+        if name not in HEURISTIC_FNS:
+            raise ValueError(
+                f"Unknown heuristic {name}, choose from {list(HEURISTIC_FNS)}."
+            )
 
+        begin = time.perf_counter()
+        intervals = HEURISTIC_FNS[name](intervals, name_to_class_code, iqr, **params)
+        # the same heuristic may appear more than once.
+        key = name if name not in timings else f"{name}_{i}"
+        timings[key] = time.perf_counter() - begin
 
-HEURISTIC_FNS = [remove_a_chirps_in_between_b_chirps]
+    return intervals, timings
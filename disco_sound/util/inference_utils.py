@@ -6,12 +6,17 @@ from glob import glob
 import numpy as np
 import pandas as pd
 import pomegranate as pom
-import requests
 import torch
 import torchaudio
-import tqdm
 
-import disco_sound.util.heuristics as heuristics
+from disco_sound.util.download import download_models
+from disco_sound.util.heuristics import (
+    DEFAULT_HEURISTICS,
+    apply_heuristics,
+    remove_sandwiched,
+)
+from disco_sound.util.intervals import Intervals
+from disco_sound.util.resample import Resampler
 
 logger = logging.getLogger(__name__)
 
@@ -39,76 +44,94 @@ def create_hmm(transition_matrix, emission_probs, start_probs):
     return hmm_model
 
 
-def download_models(directory, aws_download_link):
+def aggregate_predictions(predictions):
     """
-    Download models from an AWS bucket.
-    :param directory: Where to save the models.
-    :param aws_download_link: The AWS link to download from.
-    :return: None. Models are saved locally.
+    Converts an array of predictions into a list of dictionaries, each with keys "class", "start" and "end" giving
+    the class of a run of predictions, its first index and the index of its last element.
+    The final run is only reported when the array holds a single class, in which case its end is the array length.
+    Use disco_sound.util.intervals.Intervals.from_predictions for the array-based equivalent.
+
+    :param predictions: np.array, Nx1, containing pointwise predictions.
+    :return: List of dicts describing the prediction start and end of each class.
     """
+    intervals = Intervals.from_predictions(predictions)
 
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    if len(intervals) == 1:
+        logger.info(
+            "Only one class found after heuristics, csv will only contain one row"
+        )
 
-    for model_id in tqdm.tqdm(range(0, 10), desc="download status"):
-        download_url = aws_download_link.format(model_id)
-        download_destination = os.path.join(directory, "model_{}.pt".format(model_id))
-        if not os.path.isfile(download_destination):
-            f = requests.get(download_url)
-            if f.status_code == 200:
-                with open(download_destination, "wb") as dst:
-                    dst.write(f.content)
-            else:
-                raise requests.RequestException(
-                    f"Couldn't download model with code {f.status_code}"
-                )
+    return _as_dicts(_aggregated(intervals))
 
 
-def aggregate_predictions(predictions):
-    """
-    Converts an array of predictions into a dictionary containing as keys the class index
-    and as values 2-element lists containing the start of a predicted class and the end of the predicted class.
+def _aggregated(intervals):
+    # aggregate_predictions' convention: inclusive ends, and the final run dropped unless it's the only one
+    if len(intervals) == 1:
+        return intervals
+    return Intervals(
+        intervals.starts[:-1], intervals.ends[:-1] - 1, intervals.classes[:-1]
+    )
 
-    :param predictions: np.array, Nx1, containing pointwise predictions.
-    :return: Dict mapping class index to prediction start and end.
+
+def _as_dicts(intervals):
+    return [
+        {"class": c, "start": s, "end": e}
+        for c, s, e in zip(intervals.classes, intervals.starts, intervals.ends)
+    ]
+
+
+def remove_a_chirps_in_between_b_chirps(
+    predictions, iqr, name_to_class_code, return_preds=True
+):
+    """
+    The post-processing `disco infer` applied before the heuristics became configurable, kept for existing callers;
+    disco_sound.util.heuristics.apply_heuristics with DEFAULT_HEURISTICS is its replacement.
+    Sets non-background runs of at most 21 elements (20 if they're the only run) and A runs directly in between two B
+    runs to background. As before, the final run is never changed and the last element of an A run in between two B
+    runs is left alone.
+
+    :param predictions: np.array (size N) containing point-wise class predictions. Modified in place.
+    :param iqr: Unused.
+    :param name_to_class_code: Mapping from name of class to the class code (ex: {"A":2}).
+    :param return_preds: bool, default True. Whether to return the prediction array or a list of dicts (see
+    aggregate_predictions) of the relabeled short runs followed by every run but the first and last, unchanged.
+    :return: prediction array or list of dicts.
     """
-    if predictions.ndim != 1:
-        raise ValueError("expected array of size N, got {}".format(predictions.shape))
+    background = name_to_class_code["BACKGROUND"]
+    runs = Intervals.from_predictions(predictions)
+    transitions = _aggregated(runs)
+    n = len(transitions)
 
-    diff = np.diff(predictions)  # transition regions will be nonzero
-    (idx,) = diff.nonzero()
-    current_class = predictions[0]
-    current_idx = 0
-    class_idx_to_prediction_start_and_end = []
+    short = (transitions.ends - transitions.starts <= 20) & (
+        transitions.classes != background
+    )
+    # runs from from_predictions are maximal, so relabeling a sandwiched run merges nothing and the runs stay aligned
+    sandwiched = (
+        remove_sandwiched(runs[:n], name_to_class_code, iqr).classes != runs.classes[:n]
+    )
 
-    if len(idx) == 0:
-        logger.info(
-            "Only one class found after heuristics, csv will only contain one row"
-        )
-        dct = {
-            "class": current_class,
-            "start": current_idx,
-            "end": predictions.shape[-1],
-        }
-        class_idx_to_prediction_start_and_end.append(dct)
+    # transitions holds every run but the last, so pad the per-run flags to cover all of them
+    short_frames = np.repeat(np.append(short, False)[: len(runs)], runs.lengths)
+    sandwiched_frames = np.repeat(
+        np.append(sandwiched, False)[: len(runs)], runs.lengths
+    )
+    sandwiched_frames[runs.ends - 1] = False
+    predictions[short_frames | sandwiched_frames] = background
 
-    else:
-        for i in range(len(idx)):
-            dct = {"class": current_class, "start": current_idx, "end": idx[i]}
-            class_idx_to_prediction_start_and_end.append(dct)
-            current_class = predictions[idx[i] + 1]
-            current_idx = idx[i] + 1
+    if return_preds:
+        return predictions
 
-    return class_idx_to_prediction_start_and_end
+    relabeled = transitions.relabel(short, background)[short]
+    return _as_dicts(Intervals.concatenate([relabeled, transitions[1:-1]]))
 
 
 def convert_spectrogram_index_to_seconds(spect_idx, hop_length, sample_rate):
     """
     Converts spectrogram index back to seconds.
-    :param spect_idx: Int. of spectrogram index
+    :param spect_idx: Int or np.array of spectrogram indices.
     :param hop_length: Int. of hop length
     :param sample_rate: Int. of wav file sample rate
-    :return: int of converted seconds.
+    :return: converted seconds, with the same shape as :param spect_idx:.
     """
     seconds_per_hop = hop_length / sample_rate
     return spect_idx * seconds_per_hop
@@ -152,9 +175,11 @@ def save_csv_from_predictions(
     sample_rate,
     hop_length,
     name_to_class_code,
+    heuristics=DEFAULT_HEURISTICS,
+    iqr=None,
 ):
     """
-    Ingest a Nx1 np.array of point-wise predictions and save a .csv with
+    Ingest a Nx1 np.array of point-wise predictions, apply post-processing heuristics and save a .csv with
     Selection,View,Channel,Begin Time (s),End Time (s),Low Freq (Hz),High Freq (Hz),Sound_Type
     columns.
     :param output_csv_path: str. where to save the .csv of predictions.
@@ -162,37 +187,56 @@ def save_csv_from_predictions(
     :param sample_rate: Sample rate of predicted .wav file.
     :param hop_length: Spectrogram hop length.
     :param name_to_class_code: mapping from class name to class code (ex {"A":1}).
+    :param heuristics: List of heuristics to apply (see disco_sound.util.heuristics.apply_heuristics).
+    :param iqr: classes x N numpy array of the ensemble iqr. Only needed by iqr-based heuristics.
     :return: pandas.DataFrame describing the saved csv.
     """
-    class_idx_to_prediction_start_end = heuristics.remove_a_chirps_in_between_b_chirps(
-        predictions, None, name_to_class_code, return_preds=False
+    intervals, timings = apply_heuristics(
+        predictions, heuristics, name_to_class_code, iqr=iqr
+    )
+    logger.debug(f"Heuristic timings (s): {timings}")
+    return save_csv_from_intervals(
+        output_csv_path, intervals, sample_rate, hop_length, name_to_class_code
     )
-    class_code_to_name = {v: k for k, v in name_to_class_code.items()}
-    list_of_dicts_for_dataframe = []
-    i = 1
-    for class_to_start_and_end in class_idx_to_prediction_start_end:
-        end = class_to_start_and_end["end"]
-        start = class_to_start_and_end["start"]
-
-        dataframe_dict = {
-            "Selection": i,
-            "View": 0,
-            "Channel": 0,
-            "Begin Time (s)": convert_spectrogram_index_to_seconds(
-                start, hop_length=hop_length, sample_rate=sample_rate
-            ),
-            "End Time (s)": convert_spectrogram_index_to_seconds(
-                end, hop_length=hop_length, sample_rate=sample_rate
-            ),
-            "Low Freq (Hz)": 0,
-            "High Freq (Hz)": 0,
-            "Sound_Type": class_code_to_name[class_to_start_and_end["class"]],
-        }
 
-        list_of_dicts_for_dataframe.append(dataframe_dict)
-        i += 1
 
-    df = pd.DataFrame.from_dict(list_of_dicts_for_dataframe)
+def save_csv_from_intervals(
+    output_csv_path,
+    intervals,
+    sample_rate,
+    hop_length,
+    name_to_class_code,
+):
+    """
+    Save run-length encoded predictions as a raven-compatible .csv.
+    :param output_csv_path: str. where to save the .csv of predictions.
+    :param intervals: disco_sound.util.intervals.Intervals of predicted runs.
+    :param sample_rate: Sample rate of predicted .wav file.
+    :param hop_length: Spectrogram hop length.
+    :param name_to_class_code: mapping from class name to class code (ex {"A":1}).
+    :return: pandas.DataFrame describing the saved csv.
+    """
+    class_code_to_name = {v: k for k, v in name_to_class_code.items()}
+    begin_times = convert_spectrogram_index_to_seconds(
+        intervals.starts, hop_length=hop_length, sample_rate=sample_rate
+    )
+    end_times = convert_spectrogram_index_to_seconds(
+        intervals.ends, hop_length=hop_length, sample_rate=sample_rate
+    )
+    n_rows = len(intervals)
+
+    df = pd.DataFrame(
+        {
+            "Selection": np.arange(1, n_rows + 1),
+            "View": np.zeros(n_rows, dtype=int),
+            "Channel": np.zeros(n_rows, dtype=int),
+            "Begin Time (s)": begin_times,
+            "End Time (s)": end_times,
+            "Low Freq (Hz)": np.zeros(n_rows, dtype=int),
+            "High Freq (Hz)": np.zeros(n_rows, dtype=int),
+            "Sound_Type": pd.Series(intervals.classes).map(class_code_to_name),
+        }
+    )
 
     dirname = os.path.dirname(output_csv_path)
     if dirname == "":
@@ -243,7 +287,7 @@ def convert_time_to_spect_index(time, hop_length, sample_rate):
     :param sample_rate: Sample rate of recording.
     :return: int. Spectrogram index of the time passed in.
     """
-    return np.round(time * sample_rate).astype(np.int) // hop_length
+    return np.round(time * sample_rate).astype(int) // hop_length
 
 
 def load_prediction_csv(csv_path, hop_length, sample_rate):
@@ -255,14 +299,12 @@ def load_prediction_csv(csv_path, hop_length, sample_rate):
     :return: original dataframe but with new columns, "Begin Spect Index" and "End Spect Index".
     """
     df = pd.read_csv(csv_path)
-    df["Begin Spect Index"] = [
-        convert_time_to_spect_index(x, hop_length, sample_rate)
-        for x in df["Begin Time (s)"]
-    ]
-    df["End Spect Index"] = [
-        convert_time_to_spect_index(x, hop_length, sample_rate)
-        for x in df["End Time (s)"]
-    ]
+    df["Begin Spect Index"] = convert_time_to_spect_index(
+        df["Begin Time (s)"].to_numpy(), hop_length, sample_rate
+    )
+    df["End Spect Index"] = convert_time_to_spect_index(
+        df["End Time (s)"].to_numpy(), hop_length, sample_rate
+    )
     return df
 
 
@@ -272,6 +314,7 @@ def assemble_ensemble(
     device,
     default_model_directory,
     aws_download_link,
+    manifest=None,
 ):
 
     if model_directory is None:
@@ -284,8 +327,9 @@ def assemble_ensemble(
         logger.info(
             "no models found, downloading to {}".format(default_model_directory)
         )
-        download_models(default_model_directory, aws_download_link)
-        model_paths = glob(os.path.join(default_model_directory, f"*"))
+        model_paths = download_models(
+            default_model_directory, aws_download_link, manifest=manifest
+        )
 
     models = []
     for model_path in model_paths:
@@ -306,23 +350,52 @@ def assemble_ensemble(
     return models
 
 
-def load_wav_file(wav_filename):
+def load_wav_file(wav_filename, sample_rate=None):
     """
     Load a .wav file from disk.
     :param wav_filename: str. .wav file.
+    :param sample_rate: int, optional. If given, the recording is resampled to this rate while it's read.
     :return: tuple (torch.Tensor(), int). The .wav file's data and sample rate, respectively.
     """
-    waveform, sample_rate = torchaudio.load(wav_filename)
+    if sample_rate is None:
+        return torchaudio.load(wav_filename)
+
+    file_sample_rate = torchaudio.info(wav_filename).sample_rate
+    if file_sample_rate == sample_rate:
+        return torchaudio.load(wav_filename)
+
+    logger.info(
+        f"Resampling {wav_filename} from {file_sample_rate}Hz to {sample_rate}Hz."
+    )
+    resampler = Resampler(file_sample_rate, sample_rate)
+    chunks = stream_wav_file(wav_filename, num_frames=resampler.chunk_size)
+    waveform = torch.cat(list(resampler.stream(chunks)), dim=-1)
     return waveform, sample_rate
 
 
+def stream_wav_file(wav_filename, num_frames):
+    """
+    Read a .wav file from disk in consecutive chunks.
+    :param wav_filename: str. .wav file.
+    :param num_frames: int. Number of frames per chunk.
+    :return: Generator of torch.Tensors of shape (channels, <= num_frames).
+    """
+    total_frames = torchaudio.info(wav_filename).num_frames
+    for frame_offset in range(0, total_frames, num_frames):
+        chunk, _ = torchaudio.load(
+            wav_filename, frame_offset=frame_offset, num_frames=num_frames
+        )
+        yield chunk
+
+
 @torch.no_grad()
 def predict_with_ensemble(ensemble, features):
     """
     Predict an array of features with a model ensemble.
     :param ensemble: List of models.
     :param features: torch.Tensor.
-    :return: List of np.arrays. One for each model in the ensemble.
+    :return: torch.Tensor of shape (models, batch, classes, length) holding the softmax of each model's predictions.
+    Stays on the device the models ran on.
     """
 
     if torch.cuda.is_available():
@@ -330,54 +403,57 @@ def predict_with_ensemble(ensemble, features):
     else:
         dev = "cpu"
 
+    features = features.to(dev)
     ensemble_preds = []
 
     for model in ensemble:
         model = model.to(dev)
-        preds = torch.nn.functional.softmax((model(features.to(dev))), dim=1)
-        ensemble_preds.append(preds.to("cpu").numpy())
+        ensemble_preds.append(torch.nn.functional.softmax(model(features), dim=1))
 
-    return ensemble_preds
+    return torch.stack(ensemble_preds)
+
+
+def _quantiles(sorted_values, qs):
+    """
+    Linearly interpolated quantiles (numpy's default method) of values sorted along the first dimension.
+    :param sorted_values: torch.Tensor sorted along dim 0.
+    :param qs: Iterable of floats in [0, 1].
+    :return: List of torch.Tensors, one per quantile, each without the first dimension.
+    """
+    last = sorted_values.shape[0] - 1
+    quantiles = []
+    for q in qs:
+        position = q * last
+        lower = int(np.floor(position))
+        upper = min(lower + 1, last)
+        fraction = position - lower
+        quantiles.append(
+            torch.lerp(sorted_values[lower], sorted_values[upper], fraction)
+        )
+    return quantiles
 
 
 def calculate_ensemble_statistics(ensemble_preds):
     """
     Get the median prediction and iqr of softmax values of the predictions from each model in the ensemble.
-    :param ensemble_preds: List of np.arrays, one for each model.
-    :return: tuple (np.array, np.array) of iqrs and medians.
+    The reduction runs on whatever device :param ensemble_preds: is on.
+    :param ensemble_preds: torch.Tensor (or np.array) of shape (models, batch, classes, length).
+    :return: tuple of torch.Tensors (iqrs, medians, means, votes), each of shape (batch, classes, length). votes
+    counts the models whose most likely class at each frame is that class.
     """
 
-    number_of_models = ensemble_preds.shape[0]
-    number_of_spectrograms = ensemble_preds.shape[1]
+    ensemble_preds = torch.as_tensor(ensemble_preds)
     number_of_classes = ensemble_preds.shape[2]
-    length_per_spectrogram = ensemble_preds.shape[3]
 
-    iqrs = np.zeros((number_of_spectrograms, number_of_classes, length_per_spectrogram))
-    medians = np.zeros(
-        (number_of_spectrograms, number_of_classes, length_per_spectrogram)
-    )
-    means = np.zeros(
-        (number_of_spectrograms, number_of_classes, length_per_spectrogram)
-    )
-    votes = np.zeros(
-        (number_of_spectrograms, number_of_classes, length_per_spectrogram)
-    )
+    sorted_preds = ensemble_preds.sort(dim=0).values
+    q25, medians, q75 = _quantiles(sorted_preds, (0.25, 0.5, 0.75))
+    iqrs = q75 - q25
+    means = ensemble_preds.mean(dim=0)
 
-    for class_idx in range(number_of_classes):
-        q75, q25 = np.percentile(ensemble_preds[:, :, class_idx, :], [75, 25], axis=0)
-        median = np.median(ensemble_preds[:, :, class_idx, :], axis=0)
-        mean = np.mean(ensemble_preds[:, :, class_idx, :], axis=0)
-
-        iqrs[:, class_idx] = q75 - q25
-        medians[:, class_idx] = median
-        means[:, class_idx] = mean
-
-    for ensemble_member in range(number_of_models):
-        for spectrogram_number in range(number_of_spectrograms):
-            slice_to_analyze = ensemble_preds[ensemble_member, spectrogram_number, :, :]
-            class_votes = list(np.argmax(slice_to_analyze, axis=0))
-            for i in range(len(class_votes)):
-                votes[spectrogram_number, class_votes[i], i] += 1
+    class_votes = torch.nn.functional.one_hot(
+        ensemble_preds.argmax(dim=2), num_classes=number_of_classes
+    )
+    votes = class_votes.sum(dim=0).permute(0, 2, 1).to(ensemble_preds.dtype)
 
     return iqrs, medians, means, votes
 
@@ -398,69 +474,47 @@ def evaluate_spectrogram(
     :param original_spectrogram: Original spectrogram.
     :param original_spectrogram_shape: Shape of original spectrogram.
     :param device: 'cuda' or 'cpu'
-    :return: medians, iqrs, means, and votes, each numpy arrays that have a shape of (classes, length).
+    :return: iqrs, medians, means and votes, each numpy arrays that have a shape of (classes, length), and the
+    predictions of each model, a numpy array of shape (models, classes, length).
     """
     assert_accuracy = True
 
     with torch.no_grad():
-        iqrs_full_sequence = []
-        medians_full_sequence = []
-        means_full_sequence = []
-        preds_full_sequence = []
-        votes_full_sequence = []
+        tiles = []
         if assert_accuracy:
             all_features = []
 
         for features in spectrogram_dataset:
             features = features.to(device)
-            ensemble_preds = predict_with_ensemble(models, features)
+            keep = slice(tile_overlap, features.shape[-1] - tile_overlap)
             if assert_accuracy:
-                all_features.extend(
-                    np.stack(
-                        [
-                            seq[:, tile_overlap:-tile_overlap]
-                            for seq in features.to("cpu").numpy()
-                        ]
-                    )
-                )
-
-            ensemble_preds = np.stack(
-                [seq[:, :, tile_overlap:-tile_overlap] for seq in ensemble_preds]
-            )
-            iqrs, medians, means, votes = calculate_ensemble_statistics(ensemble_preds)
-            iqrs_full_sequence.extend(iqrs)
-            medians_full_sequence.extend(medians)
-            preds_full_sequence.extend(ensemble_preds)
-            means_full_sequence.extend(means)
-            votes_full_sequence.extend(votes)
+                all_features.append(features[..., keep].to("cpu"))
+
+            ensemble_preds = predict_with_ensemble(models, features)[..., keep]
+            statistics = torch.stack(calculate_ensemble_statistics(ensemble_preds))
+            # one device -> host copy per batch: the 4 statistics followed by each model's predictions
+            tiles.append(torch.cat((statistics, ensemble_preds)).to("cpu"))
 
     if assert_accuracy:
-        all_features = np.concatenate(all_features, axis=-1)[
+        all_features = torch.cat(all_features).permute(1, 0, 2)
+        all_features = all_features.reshape(all_features.shape[0], -1)[
             :, : original_spectrogram_shape[-1]
         ]
-        assert np.all(all_features == original_spectrogram.numpy())
+        assert torch.equal(all_features, original_spectrogram.to(all_features.dtype))
 
-    # split the predictions
-    concat = np.concatenate(preds_full_sequence, axis=0)
-    splt = np.split(concat, concat.shape[0])
-
-    preds_full_sequence = np.concatenate(splt, axis=-1).squeeze()[
-        :, : original_spectrogram_shape[-1]
-    ]
+    # (statistic, tile, class, length) -> (statistic, class, tile * length)
+    tiles = torch.cat(tiles, dim=1).permute(0, 2, 1, 3)
+    full_sequence = tiles.reshape(tiles.shape[0], tiles.shape[1], -1)[
+        ..., : original_spectrogram_shape[-1]
+    ].numpy()
 
-    iqrs_full_sequence = np.concatenate(iqrs_full_sequence, axis=-1)[
-        :, : original_spectrogram_shape[-1]
-    ]
-
-    medians_full_sequence = np.concatenate(medians_full_sequence, axis=-1)[
-        :, : original_spectrogram_shape[-1]
-    ]
-    means_full_sequence = np.concatenate(means_full_sequence, axis=-1)[
-        :, : original_spectrogram_shape[-1]
-    ]
-    votes_full_sequence = np.concatenate(votes_full_sequence, axis=-1)[
-        :, : original_spectrogram_shape[-1]
-    ]
+    (
+        iqrs_full_sequence,
+        medians_full_sequence,
+        means_full_sequence,
+        votes_full_sequence,
+    ) = full_sequence[:4]
+    preds_full_sequence = full_sequence[4:]
 
     return (
         iqrs_full_sequence,
@@ -487,8 +541,9 @@ def evaluate_test_loader(spectrogram_dataset, models, device="cpu"):
     for features, labels in spectrogram_dataset:
         features = features.to(device)
         ensemble_preds = predict_with_ensemble(models, features)
-        ensemble_preds = np.stack(ensemble_preds)
-        iqrs, medians, means, votes = calculate_ensemble_statistics(ensemble_preds)
+        iqrs, medians, means, votes = (
+            torch.stack(calculate_ensemble_statistics(ensemble_preds)).to("cpu").numpy()
+        )
         spectrograms_concat.extend(features.to("cpu").numpy())
         labels_concat.extend(labels.to("cpu").numpy())
         iqrs_full_sequence.extend(iqrs)
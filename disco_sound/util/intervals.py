@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class Intervals:
+    """
+    Run-length encoding of point-wise predictions.
+    Holds three equal-length arrays: the start index of each run, its end index and its class.
+    Runs built with Intervals.from_predictions are half-open: predictions[starts[i]:ends[i]] == classes[i].
+    """
+
+    def __init__(self, starts, ends, classes):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.classes = np.asarray(classes)
+
+        if not (self.starts.shape == self.ends.shape == self.classes.shape):
+            raise ValueError(
+                "starts, ends and classes must have the same shape, got {}, {}, {}".format(
+                    self.starts.shape, self.ends.shape, self.classes.shape
+                )
+            )
+
+    @classmethod
+    def from_predictions(cls, predictions):
+        """
+        Run-length encode an array of point-wise predictions.
+        :param predictions: np.array, Nx1, containing pointwise predictions.
+        :return: Intervals covering every element of :param predictions:.
+        """
+        predictions = np.asarray(predictions)
+        if predictions.ndim != 1:
+            raise ValueError(
+                "expected array of size N, got {}".format(predictions.shape)
+            )
+
+        # transition regions are where neighboring predictions differ
+        (transitions,) = np.nonzero(predictions[1:] != predictions[:-1])
+        starts = np.concatenate(([0], transitions + 1))
+        ends = np.concatenate((transitions + 1, [predictions.shape[0]]))
+
+        if predictions.shape[0] == 0:
+            starts, ends = starts[:0], ends[:0]
+
+        return cls(starts, ends, predictions[starts])
+
+    def __len__(self):
+        return self.starts.shape[0]
+
+    def __getitem__(self, idx):
+        """
+        Select runs with a slice, an index array or a boolean mask.
+        """
+        return Intervals(self.starts[idx], self.ends[idx], self.classes[idx])
+
+    def __repr__(self):
+        return f"Intervals(n={len(self)})"
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts
+
+    @classmethod
+    def concatenate(cls, intervals):
+        return cls(
+            np.concatenate([i.starts for i in intervals]),
+            np.concatenate([i.ends for i in intervals]),
+            np.concatenate([i.classes for i in intervals]),
+        )
+
+    def merge_adjacent(self, max_gap=0):
+        """
+        Merge consecutive runs of the same class that are at most :param max_gap: elements apart.
+        :param max_gap: int. Largest number of uncovered elements allowed between two runs that get merged.
+        :return: Intervals.
+        """
+        if len(self) == 0:
+            return self
+
+        joins_previous = (self.classes[1:] == self.classes[:-1]) & (
+            self.starts[1:] - self.ends[:-1] <= max_gap
+        )
+        first = np.concatenate(([True], ~joins_previous))
+        last = np.concatenate((~joins_previous, [True]))
+        return Intervals(self.starts[first], self.ends[last], self.classes[first])
+
+    def relabel(self, mask, new_class):
+        """
+        :param mask: boolean np.array selecting the runs to relabel.
+        :param new_class: The class given to the selected runs.
+        :return: Intervals with the selected runs relabeled.
+        """
+        classes = self.classes.copy()
+        classes[mask] = new_class
+        return Intervals(self.starts, self.ends, classes)
+
+    def to_predictions(self, length, fill_value):
+        """
+        Expand back into an array of point-wise predictions.
+        :param length: int. Length of the output array.
+        :param fill_value: Class given to elements not covered by any run.
+        :return: np.array of size :param length:.
+        """
+        positions = np.arange(length)
+        predictions = np.full(length, fill_value, dtype=self.classes.dtype)
+        # runs are sorted and don't overlap, so each element can only be covered by the last run starting before it.
+        run_index = np.searchsorted(self.starts, positions, side="right") - 1
+        covered = run_index >= 0
+        covered[covered] = positions[covered] < self.ends[run_index[covered]]
+        predictions[covered] = self.classes[run_index[covered]]
+        return predictions
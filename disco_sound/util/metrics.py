@@ -0,0 +1,43 @@
+"""
+Per-epoch metrics accumulated as running sums.
+"""
+import torch
+
+
+class EpochSums:
+    """
+    Running sums of per-step quantities, kept in one tensor on the model's device so that an epoch's totals over every
+    process take a single all-reduce, and memory doesn't grow with the number of steps.
+
+    :param names: str. Names of the summed quantities.
+    """
+
+    def __init__(self, *names):
+        self.names = names
+        self.sums = None
+
+    def add(self, **values):
+        """
+        Add :param values: (tensors or numbers, one per name) to the sums.
+        """
+        if self.sums is None:
+            device = next(v for v in values.values() if torch.is_tensor(v)).device
+            self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=device)
+        for i, name in enumerate(self.names):
+            # in-place adds of detached tensors don't synchronize with the device
+            value = values[name]
+            self.sums[i] += value.detach() if torch.is_tensor(value) else value
+
+    def compute(self, strategy=None, device=None):
+        """
+        Sum the totals over processes with :param strategy: (a Lightning strategy, ex: trainer.strategy) and reset.
+        Every process must call this, including those that added nothing (their sums are zeros on :param device:).
+        :return: dict mapping names to float64 tensors.
+        """
+        sums = self.sums
+        if sums is None:
+            sums = torch.zeros(len(self.names), dtype=torch.float64, device=device)
+        if strategy is not None:
+            sums = strategy.reduce(sums, reduce_op="sum")
+        self.sums = None
+        return dict(zip(self.names, sums))
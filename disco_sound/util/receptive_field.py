@@ -0,0 +1,155 @@
+"""
+Tile sizes and overlaps for which overlap-tile inference gives exactly the output of running the model over the whole
+spectrogram at once.
+
+A frame's prediction depends on the input columns within its receptive field. Tiles are cut from the padded spectrogram
+every tile_size - 2 * tile_overlap columns, and only their centers are kept, so a kept frame sees the same input as in
+whole-sequence inference when:
+
+- no kept frame's receptive field reaches past the tile's edges. A frame's receptive field depends on its place on the
+  pooling grid, so the overlap needed can be less than the largest radius, and
+- every tile starts on the pooling grid of the whole sequence, i.e. tile_size - 2 * tile_overlap (and tile_size, so the
+  model doesn't pad tiles) are multiples of the model's divisible_by. Otherwise a tile's max pools pair up different
+  columns than the whole sequence's.
+
+The radius is measured on the model itself: in a float64 copy with positive weights and average pools in place of
+max pools, every path from an input column to an output frame carries a positive gradient, so the input gradient of an
+output frame is nonzero exactly on the columns it depends on.
+"""
+import copy
+import logging
+
+import numpy as np
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# receptive fields of the architectures measured so far
+_fields = {}
+
+
+def _dependency_model(model):
+    model = copy.deepcopy(model).to("cpu", torch.float64).eval()
+    for name, module in list(model.named_modules()):
+        if isinstance(module, nn.MaxPool1d):
+            parent = model.get_submodule(name.rpartition(".")[0])
+            setattr(
+                parent,
+                name.rpartition(".")[2],
+                nn.AvgPool1d(module.kernel_size, module.stride, module.padding),
+            )
+        elif isinstance(module, nn.Conv1d):
+            with torch.no_grad():
+                module.weight.fill_(1 / (module.in_channels * module.kernel_size[0]))
+                module.bias.fill_(1)
+    return model
+
+
+def receptive_field(model, length=None):
+    """
+    :param model: UNet1D (or another 1-d model with a divisible_by).
+    :param length: int. Length of the probe sequence; doubled until it exceeds the receptive field. Defaults to 512.
+    :return: tuple (np.array, np.array). Most input columns to the left and to the right of an output frame that it
+    depends on, indexed by the frame's position modulo divisible_by (its place on the pooling grid).
+    """
+    length = length or 512
+    key = str(model)
+    if key not in _fields:
+        alignment = model.divisible_by
+        probe = _dependency_model(model)
+        center = length // 2 - length // 2 % alignment
+        # one example per place on the grid: examples don't interact, so one backward pass gives every gradient
+        x = torch.ones(
+            alignment,
+            model.in_channels,
+            length,
+            dtype=torch.float64,
+            requires_grad=True,
+        )
+        offsets = torch.arange(alignment)
+        # callers may be running inference under no_grad
+        with torch.enable_grad():
+            probe(x)[offsets, :, center + offsets].sum().backward()
+        depends = x.grad.abs().sum(dim=1) > 0
+        if depends[:, 0].any() or depends[:, -1].any():
+            return receptive_field(model, 2 * length)
+        columns = torch.arange(length)
+        first = torch.where(depends, columns, length).min(dim=1).values
+        last = torch.where(depends, columns, -1).max(dim=1).values
+        _fields[key] = (
+            (center + offsets - first).numpy(),
+            (last - center - offsets).numpy(),
+        )
+    return _fields[key]
+
+
+def _is_seamless(left, right, tile_size, tile_overlap):
+    # tiles start on the grid, so checking one grid period at each end of the kept center covers every frame
+    alignment = len(left)
+    first = np.arange(tile_overlap, tile_overlap + alignment)
+    last = np.arange(tile_size - tile_overlap - alignment, tile_size - tile_overlap)
+    return np.all(first >= left[first % alignment]) and np.all(
+        tile_size - 1 - last >= right[last % alignment]
+    )
+
+
+def seamless_tiling(models, max_tile_size):
+    """
+    :param models: list of models (ex: an ensemble).
+    :param max_tile_size: int. Largest tile to use, ex: as memory allows.
+    :return: tuple (int, int). The largest tile_size <= :param max_tile_size: and the smallest tile_overlap with
+    which tiled inference matches whole-sequence inference for every model.
+    """
+    alignment = int(np.lcm.reduce([model.divisible_by for model in models]))
+    tile_size = max_tile_size - max_tile_size % alignment
+    fields = [receptive_field(model) for model in models]
+
+    # the step between tiles must stay on the pooling grid: 2 * overlap is a multiple of the alignment
+    overlap_step = alignment // np.gcd(2, alignment)
+    for tile_overlap in range(0, tile_size // 2, overlap_step):
+        if tile_size - 2 * tile_overlap < alignment:
+            break
+        if all(_is_seamless(*field, tile_size, tile_overlap) for field in fields):
+            return tile_size, tile_overlap
+
+    radius = max(max(left.max(), right.max()) for left, right in fields)
+    raise ValueError(
+        f"Tiles of at most {max_tile_size} columns can't keep any frame exactly; the receptive field reaches "
+        f"{radius} columns to either side."
+    )
+
+
+def retile_for_models(dataset, models):
+    """
+    If :param dataset: (a SpectrogramIterator) has tile_overlap="auto", tile it with seamless_tiling, taking its
+    tile_size as the largest.
+    """
+    if dataset.tile_overlap != "auto":
+        return
+    tile_size, tile_overlap = seamless_tiling(models, dataset.tile_size)
+    dataset.retile(tile_size, tile_overlap)
+    logger.info(
+        f"Tiles of {tile_size} columns overlapping by {tile_overlap} give the models' whole-sequence predictions; "
+        f"{2 * tile_overlap / tile_size:.1%} of the columns of each tile are recomputed."
+    )
+
+
+@torch.no_grad()
+def seam_error(model, dataset, batch_size=32):
+    """
+    Empirical check of a tiling: the largest difference between :param model:'s logits stitched from the tiles of
+    :param dataset: (a SpectrogramIterator) and those of one pass over its whole padded spectrogram.
+    :return: float.
+    """
+    model = model.to("cpu").eval()
+    overlap = dataset.tile_overlap
+    length = dataset.original_shape[-1]
+    tiles = [
+        model(features)[..., overlap : features.shape[-1] - overlap]
+        for features in torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    ]
+    tiles = torch.cat(tiles).permute(1, 0, 2)
+    tiled = tiles.reshape(tiles.shape[0], -1)[:, :length]
+    whole = model(dataset.spectrogram[None].float())[0, :, overlap : overlap + length]
+    return float((tiled - whole).abs().max())
@@ -0,0 +1,123 @@
+"""
+Sample-rate conversion for recordings from recorders with different sample rates.
+
+Uses the same band-limited sinc interpolation as torchaudio.functional.resample, but the filter kernel for each
+(source rate, target rate) pair is built once and cached, and the waveform is processed in fixed-size chunks so
+memory use doesn't grow with the length of the recording.
+"""
+import functools
+import logging
+
+import torch
+import torchaudio
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=16)
+def resampling_kernel(orig_freq, new_freq):
+    """
+    Build (once per pair of rates) the sinc filter kernel used to resample from :param orig_freq: to
+    :param new_freq:.
+    :return: tuple (torch.Tensor, int, int). The kernel, its half-width in input samples and the gcd of the rates.
+    """
+    logger.debug(f"Building resampling kernel for {orig_freq}Hz -> {new_freq}Hz.")
+    transform = torchaudio.transforms.Resample(orig_freq, new_freq)
+    return transform.kernel, transform.width, transform.gcd
+
+
+class Resampler:
+    """
+    Resample waveforms from :param orig_freq: to :param new_freq:.
+    The output matches torchaudio.functional.resample with its default arguments to within float32 rounding: the
+    filter is the same, but its taps are summed over differently cut blocks of input.
+
+    :param orig_freq: int. Sample rate of the input.
+    :param new_freq: int. Sample rate of the output.
+    :param chunk_size: int. Approximate number of input samples processed at once.
+    """
+
+    def __init__(self, orig_freq, new_freq, chunk_size=2**20):
+        self.orig_freq = int(orig_freq)
+        self.new_freq = int(new_freq)
+        self.chunk_size = chunk_size
+
+        if self.orig_freq == self.new_freq:
+            return
+
+        self.kernel, self.width, gcd = resampling_kernel(self.orig_freq, self.new_freq)
+        # the kernel maps every block of self.orig input samples onto self.new output samples.
+        self.orig = self.orig_freq // gcd
+        self.new = self.new_freq // gcd
+        self.chunk_size = max(chunk_size, self.orig)
+
+    def __call__(self, waveform):
+        """
+        :param waveform: torch.Tensor of shape (..., time).
+        :return: torch.Tensor of shape (..., resampled time).
+        """
+        if self.orig_freq == self.new_freq:
+            return waveform
+        chunks = waveform.split(self.chunk_size, dim=-1)
+        return torch.cat(list(self.stream(chunks)), dim=-1)
+
+    def _resample_blocks(self, segment):
+        """
+        :param segment: (channels, n_blocks * self.orig + 2 * self.width) tensor of input, including the context
+        needed on either side of the blocks.
+        :return: (channels, n_blocks * self.new) tensor of output.
+        """
+        kernel = self.kernel.to(device=segment.device, dtype=segment.dtype)
+        resampled = torch.nn.functional.conv1d(
+            segment[:, None], kernel, stride=self.orig
+        )
+        return resampled.transpose(1, 2).reshape(segment.shape[0], -1)
+
+    def stream(self, chunks):
+        """
+        Resample a waveform delivered as consecutive chunks along the time axis.
+        :param chunks: Iterable of torch.Tensors of shape (..., time), e.g. blocks read from a long file.
+        :return: Generator of resampled torch.Tensors of shape (..., time). Concatenating them gives the resampled
+        waveform.
+        """
+        if self.orig_freq == self.new_freq:
+            yield from chunks
+            return
+
+        leading_shape = None
+        buffer = None
+        n_input = 0
+        n_output = 0
+        n_blocks = 0
+
+        for chunk in chunks:
+            if leading_shape is None:
+                leading_shape = chunk.shape[:-1]
+                # zeros standing in for the samples before the start of the recording
+                buffer = chunk.new_zeros((chunk[..., 0].numel(), self.width))
+
+            buffer = torch.cat((buffer, chunk.reshape(buffer.shape[0], -1)), dim=-1)
+            n_input += chunk.shape[-1]
+
+            # blocks whose input, plus context on either side, has been fully read.
+            n_ready = (buffer.shape[-1] - 2 * self.width) // self.orig
+            if n_ready > 0:
+                resampled = self._resample_blocks(
+                    buffer[:, : n_ready * self.orig + 2 * self.width]
+                )
+                buffer = buffer[:, n_ready * self.orig :]
+                n_blocks += n_ready
+                n_output += resampled.shape[-1]
+                yield resampled.reshape(leading_shape + resampled.shape[-1:])
+
+        if leading_shape is None:
+            return
+
+        # zero-pad past the end of the recording to finish the last blocks.
+        remaining = n_input // self.orig + 1 - n_blocks
+        buffer = torch.nn.functional.pad(
+            buffer, (0, remaining * self.orig + 2 * self.width - buffer.shape[-1])
+        )
+        target_length = -(-self.new * n_input // self.orig)
+        resampled = self._resample_blocks(buffer)[:, : target_length - n_output]
+        yield resampled.reshape(leading_shape + resampled.shape[-1:])
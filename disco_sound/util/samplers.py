@@ -0,0 +1,198 @@
+"""
+Samplers used by the training DataLoaders.
+"""
+import logging
+
+import numpy as np
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+def _read_ahead(batches, num_workers, read_ahead):
+    """
+    Annotate :param batches: for datasets that read ahead (see ReadAheadSampler).
+    :return: generator of batches of (index, upcoming indices) tuples.
+    """
+    stride = max(1, num_workers)
+
+    for b, batch in enumerate(batches):
+        upcoming = list(batch[1:])
+        for ahead in range(1, read_ahead + 1):
+            if b + ahead * stride < len(batches):
+                upcoming.extend(batches[b + ahead * stride])
+        yield [(batch[0], tuple(upcoming))] + [(idx, ()) for idx in batch[1:]]
+
+
+def padding_efficiency(lengths, batches, pad_to=1):
+    """
+    Fraction of the frames in padded :param batches: that are real data rather than padding.
+    :param lengths: array of the number of frames in each example.
+    :param batches: iterable of lists of example indices.
+    :param pad_to: int. Padded batch lengths are rounded up to a multiple of this.
+    :return: float.
+    """
+    lengths = np.asarray(lengths)
+    real = 0
+    total = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += batch_lengths.sum()
+        total += len(batch) * (-(-batch_lengths.max() // pad_to) * pad_to)
+    return float(real / total) if total else 1.0
+
+
+class ReadAheadSampler(Sampler):
+    """
+    Wraps a sampler so that datasets loading examples on demand know what to read next.
+    The first index of every batch is yielded as a tuple (index, upcoming indices), where the upcoming indices are
+    the rest of that batch followed by the next :param read_ahead: batches the same DataLoader worker will be given
+    (workers are handed batches in turn). Every other index is yielded as (index, ()).
+    Datasets used with it must accept those tuples in __getitem__.
+
+    :param sampler: The sampler deciding the order of examples.
+    :param batch_size: int. Batch size of the DataLoader.
+    :param num_workers: int. num_workers of the DataLoader.
+    :param read_ahead: int. Number of the worker's later batches to announce.
+    """
+
+    def __init__(self, sampler, batch_size, num_workers=0, read_ahead=1):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.read_ahead = read_ahead
+
+    def __iter__(self):
+        order = list(self.sampler)
+        batches = [
+            order[i : i + self.batch_size]
+            for i in range(0, len(order), self.batch_size)
+        ]
+        for batch in _read_ahead(batches, self.num_workers, self.read_ahead):
+            yield from batch
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+
+class ReadAheadBatchSampler(Sampler):
+    """
+    ReadAheadSampler for DataLoaders built with a batch_sampler: yields the batches of :param batch_sampler:
+    annotated the same way.
+
+    :param batch_sampler: The batch sampler deciding the batches.
+    :param num_workers: int. num_workers of the DataLoader.
+    :param read_ahead: int. Number of the worker's later batches to announce.
+    """
+
+    def __init__(self, batch_sampler, num_workers=0, read_ahead=1):
+        self.batch_sampler = batch_sampler
+        self.num_workers = num_workers
+        self.read_ahead = read_ahead
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        yield from _read_ahead(batches, self.num_workers, self.read_ahead)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    @property
+    def padding_efficiency(self):
+        return getattr(self.batch_sampler, "padding_efficiency", None)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches examples of similar length together so that less of each padded batch is padding.
+    Every epoch the examples are sorted by length (ties in random order) and split into :param n_buckets: buckets of
+    consecutive lengths. The examples of each bucket are shuffled, the buckets are cut into batches in order of
+    length - so only batches straddling two neighbouring buckets mix their lengths - and the batches are shuffled.
+    The fraction of real frames in the epoch's padded batches is logged and kept in padding_efficiency.
+
+    :param lengths: array of the number of frames in each example of the dataset.
+    :param batch_size: int.
+    :param n_buckets: int. More buckets make tighter batches but a less random order.
+    :param shuffle: bool. Shuffle within and across buckets. If False batches come in order of length.
+    :param seed: int. The order of epoch e depends only on seed and e.
+    :param drop_last: bool. Drop the one batch smaller than batch_size, if any.
+    :param pad_to: int. Multiple the collate function rounds batch lengths up to, for padding_efficiency.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        n_buckets=10,
+        shuffle=True,
+        seed=0,
+        drop_last=False,
+        pad_to=1,
+    ):
+        if n_buckets < 1:
+            raise ValueError(f"n_buckets must be at least 1, got {n_buckets}.")
+
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.n_buckets = min(n_buckets, max(1, len(self.lengths)))
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.pad_to = pad_to
+        self.epoch = 0
+        self.padding_efficiency = None
+
+    def batches(self, epoch):
+        """
+        :return: list of the batches (np.arrays of example indices) of :param epoch:.
+        """
+        rng = np.random.default_rng((self.seed, epoch))
+
+        if self.shuffle:
+            order = rng.permutation(len(self.lengths))
+            order = order[np.argsort(self.lengths[order], kind="stable")]
+        else:
+            order = np.argsort(self.lengths, kind="stable")
+
+        buckets = np.array_split(order, self.n_buckets)
+        if self.shuffle:
+            buckets = [rng.permutation(bucket) for bucket in buckets]
+        order = np.concatenate(buckets)
+
+        batches = [
+            order[i : i + self.batch_size]
+            for i in range(0, len(order), self.batch_size)
+        ]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        self.padding_efficiency = padding_efficiency(self.lengths, batches, self.pad_to)
+        logger.info(
+            f"Epoch {self.epoch}: {len(batches)} bucketed batches, padding efficiency "
+            f"{self.padding_efficiency:.3f}."
+        )
+        # without set_epoch calls (ex: plain pytorch loops) each pass over the sampler is a new epoch
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return -(-len(self.lengths) // self.batch_size)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
@@ -0,0 +1,248 @@
+"""
+Packed, memory-mapped storage for extracted training examples.
+
+A shard is a directory holding every example of a split back to back:
+
+    features.bin  (total frames x rows) feature array, frames-major so each example is one contiguous block
+    labels.bin    (total frames) label array
+    offsets.npy   (examples + 1) frame index where each example starts, then the total number of frames
+    meta.json     dtypes, shape and how the features were preprocessed
+
+The arrays are opened with np.memmap, so loading a shard reads only its index and examples are sliced straight out
+of the page cache without copying.
+"""
+import argparse
+import json
+import logging
+import os
+import pickle
+from glob import glob
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SHARD_VERSION = 1
+FEATURES_FILE = "features.bin"
+LABELS_FILE = "labels.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+LABEL_DTYPE = "int16"
+
+
+def is_shard(directory):
+    return os.path.isfile(os.path.join(directory, META_FILE))
+
+
+class ShardWriter:
+    """
+    Append examples to a new shard. Features and labels are streamed to disk as they're added, so the examples never
+    need to be in memory at once. The shard is only readable after close().
+
+    :param directory: str. Where to write the shard. Created if it doesn't exist; an existing shard is overwritten.
+    :param dtype: str. Data type the features are stored as ("float32" or "float16").
+    :param log2: bool. Store log2 of the features, with zeros replaced by ones first, as the training datasets
+    expect.
+    """
+
+    def __init__(self, directory, dtype="float32", log2=True):
+        if np.dtype(dtype) not in (np.dtype("float32"), np.dtype("float16")):
+            raise ValueError(f"dtype must be float32 or float16, got {dtype}.")
+
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.log2 = log2
+        self.n_rows = None
+        self.offsets = [0]
+
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        self._features = open(os.path.join(directory, FEATURES_FILE), "wb")
+        self._labels = open(os.path.join(directory, LABELS_FILE), "wb")
+
+    def append(self, features, labels, log2_applied=False):
+        """
+        :param features: np.array (rows x frames).
+        :param labels: np.array (frames) of class codes.
+        :param log2_applied: bool. Whether :param features: already went through the log2 transform, as examples
+        read from another log2 shard have.
+        """
+        features = np.asarray(features)
+        labels = np.asarray(labels)
+
+        if self.n_rows is None:
+            self.n_rows = features.shape[0]
+        elif features.shape[0] != self.n_rows:
+            raise ValueError(
+                f"expected features with {self.n_rows} rows, got {features.shape[0]}."
+            )
+        if features.shape[1] != labels.shape[-1]:
+            raise ValueError(
+                f"features have {features.shape[1]} frames but labels have {labels.shape[-1]}."
+            )
+
+        if log2_applied and not self.log2:
+            raise ValueError("Can't add log2 features to a shard of raw features.")
+        if self.log2 and not log2_applied:
+            features = np.log2(np.where(features == 0, 1, features))
+
+        self._features.write(np.ascontiguousarray(features.T, dtype=self.dtype))
+        self._labels.write(np.ascontiguousarray(labels, dtype=LABEL_DTYPE))
+        self.offsets.append(self.offsets[-1] + features.shape[1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def close(self):
+        self._features.close()
+        self._labels.close()
+        np.save(
+            os.path.join(self.directory, OFFSETS_FILE),
+            np.asarray(self.offsets, dtype=np.int64),
+        )
+        meta = {
+            "version": SHARD_VERSION,
+            "examples": len(self),
+            "frames": self.offsets[-1],
+            "rows": self.n_rows if self.n_rows is not None else 0,
+            "dtype": self.dtype.name,
+            "label_dtype": LABEL_DTYPE,
+            "log2": self.log2,
+        }
+        # meta.json is written last: its presence marks a complete shard.
+        with open(os.path.join(self.directory, META_FILE), "w") as dst:
+            json.dump(meta, dst, indent=2)
+        logger.info(
+            f"Wrote {len(self)} examples ({self.offsets[-1]} frames) to {self.directory}."
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._features.close()
+            self._labels.close()
+
+
+class Shard:
+    """
+    Read-only view of a shard written by ShardWriter.
+    Examples are returned as views into the memory-mapped arrays: (rows x frames) features and (frames) labels.
+    The maps are opened copy-on-write, so modifying an example never touches the file.
+
+    :param directory: str. The shard directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        meta_path = os.path.join(directory, META_FILE)
+        if not os.path.isfile(meta_path):
+            raise ValueError(f"{directory} is not a complete shard (no {META_FILE}).")
+
+        with open(meta_path) as src:
+            self.meta = json.load(src)
+        if self.meta["version"] != SHARD_VERSION:
+            raise ValueError(
+                f"{directory} has shard version {self.meta['version']}, expected {SHARD_VERSION}."
+            )
+
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE))
+        self._features = None
+        self._labels = None
+
+    def _open(self):
+        frames = self.meta["frames"]
+        if frames == 0:
+            self._features = np.zeros((0, self.meta["rows"]), dtype=self.meta["dtype"])
+            self._labels = np.zeros(0, dtype=self.meta["label_dtype"])
+            return
+        self._features = np.memmap(
+            os.path.join(self.directory, FEATURES_FILE),
+            dtype=self.meta["dtype"],
+            mode="c",
+            shape=(frames, self.meta["rows"]),
+        )
+        self._labels = np.memmap(
+            os.path.join(self.directory, LABELS_FILE),
+            dtype=self.meta["label_dtype"],
+            mode="c",
+            shape=(frames,),
+        )
+
+    @property
+    def log2(self):
+        return self.meta["log2"]
+
+    def lengths(self):
+        """
+        :return: np.array of the number of frames in each example.
+        """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if self._features is None:
+            self._open()
+        begin, end = self.offsets[idx], self.offsets[idx + 1]
+        return self._features[begin:end].T, self._labels[begin:end]
+
+    def __getstate__(self):
+        # don't pickle the maps (ex: into DataLoader workers); each process reopens them.
+        state = self.__dict__.copy()
+        state["_features"] = None
+        state["_labels"] = None
+        return state
+
+
+def _load_pickle(f):
+    with open(f, "rb") as src:
+        return pickle.load(src)
+
+
+def convert_pickles(files, directory, dtype="float32", log2=True):
+    """
+    Pack pickled [features, labels] examples, as written by disco extract, into one shard.
+    :param files: List of pickle files. Packed in this order.
+    :param directory: str. Where to write the shard.
+    :return: Shard.
+    """
+    with ShardWriter(directory, dtype=dtype, log2=log2) as writer:
+        for f in files:
+            features, labels = _load_pickle(f)
+            writer.append(features, labels)
+    return Shard(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pack a directory of pickled examples into a shard."
+    )
+    parser.add_argument("pickle_directory")
+    parser.add_argument("shard_directory")
+    parser.add_argument("--extension", default=".pkl")
+    parser.add_argument("--dtype", default="float32", choices=("float32", "float16"))
+    parser.add_argument(
+        "--no-log2",
+        action="store_true",
+        help="store the features as they are instead of their log2",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    files = sorted(glob(os.path.join(args.pickle_directory, f"*{args.extension}")))
+    if not files:
+        raise ValueError(f"No *{args.extension} files in {args.pickle_directory}.")
+    convert_pickles(
+        files, args.shard_directory, dtype=args.dtype, log2=not args.no_log2
+    )
+
+
+if __name__ == "__main__":
+    main()
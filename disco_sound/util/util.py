@@ -23,19 +23,45 @@ def add_white_noise(waveform, snr):
     return waveform
 
 
-def add_gaussian_beeps(waveform, sample_rate):
-    x = torch.arange(waveform.shape[1])
-    bep = 100 * torch.sin(2 * torch.pi * 440.0 * (x / sample_rate))
-    # center a gaussian somewhere - here at 1000 units
-    gaussian = torch.zeros_like(x).float()
-    n_beeps = 10
+def add_gaussian_beeps(waveform, sample_rate, n_beeps=10, rng=np.random):
+    """
+    Add :param n_beeps: gaussian-enveloped 440Hz tones at random places in :param waveform:, in place.
+    :param rng: np.random.Generator, or the np.random module (default) to use its global state.
+    """
+    n_samples = waveform.shape[1]
+    # (width, center) pairs, drawn in the order beeps always have been
+    draws = rng.random((n_beeps, 2))
+    widths = 1000 + (draws[:, 0] * 10000).astype(int)
+    centers = (draws[:, 1] * n_samples).astype(int) - 10000
     logger.info(f"Adding {n_beeps} beeps to waveform.")
 
-    for _ in range(n_beeps):
-        width = 1000 + int(np.random.rand() * 10000)
-        center = int(np.random.rand() * waveform.shape[1]) - 10000
-        gaussian += np.exp(-((x - center) ** 2) / (width**2))
-    waveform += gaussian * bep
+    # each envelope is below float precision 6 widths from its center, so on long recordings only that window is
+    # evaluated
+    reach = 6 * int(widths.max())
+    centers = centers[:, None]
+    widths = widths[:, None].astype(np.float32)
+
+    if 2 * reach + 1 < n_samples:
+        positions = centers + np.arange(-reach, reach + 1)
+        envelopes = np.exp(
+            -((positions - centers).astype(np.float32) ** 2) / widths**2
+        )
+        inside = (positions >= 0) & (positions < n_samples)
+        gaussian = np.bincount(
+            positions[inside], weights=envelopes[inside], minlength=n_samples
+        )
+        x = np.flatnonzero(gaussian)
+        bep = 100 * torch.sin(
+            2 * torch.pi * 440.0 * (torch.from_numpy(x) / sample_rate)
+        )
+        waveform[:, x] += (torch.from_numpy(gaussian[x]) * bep).to(waveform.dtype)
+    else:
+        x = np.arange(n_samples)
+        gaussian = np.exp(-((x - centers).astype(np.float32) ** 2) / widths**2).sum(0)
+        bep = 100 * torch.sin(
+            2 * torch.pi * 440.0 * (torch.from_numpy(x) / sample_rate)
+        )
+        waveform += (torch.from_numpy(gaussian) * bep).to(waveform.dtype)
 
     return waveform
 
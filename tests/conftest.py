@@ -0,0 +1,31 @@
+import pickle
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def make_pickles(tmp_path):
+    """
+    :return: function (n, name, seed=0, rows=32) writing n examples as disco extract does (a pickled list of float32
+    features and float64 labels, one or two classes each) to tmp_path/name and returning their paths.
+    """
+
+    def make(n, name, seed=0, rows=32):
+        rng = np.random.default_rng(seed)
+        directory = tmp_path / name
+        directory.mkdir()
+        files = []
+        for i in range(n):
+            length = int(rng.integers(16, 80))
+            labels = np.repeat(
+                rng.integers(0, 3, 2), [length // 2, length - length // 2]
+            )
+            features = rng.uniform(0, 100, (rows, length)).astype(np.float32)
+            path = directory / f"example_{i}.pkl"
+            with open(path, "wb") as dst:
+                pickle.dump([features, labels.astype(np.float64)], dst)
+            files.append(str(path))
+        return files
+
+    return make
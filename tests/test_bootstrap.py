@@ -0,0 +1,57 @@
+import json
+import os
+
+import torch
+
+from disco_sound.bootstrap import train_bootstrap_ensemble
+from disco_sound.models.unet_1d import UNet1D
+
+
+def test_train_bootstrap_ensemble(make_pickles, tmp_path):
+    model_args = dict(
+        in_channels=28,
+        out_channels=3,
+        learning_rate=1e-3,
+        mask_character=-1,
+        widths=[4, 8, 8, 8],
+    )
+    log_dir = tmp_path / "logs"
+    log_dir.mkdir()
+    summary = train_bootstrap_ensemble(
+        model_class=UNet1D,
+        model_args=model_args,
+        dataset_name="SpectrogramDatasetMultiLabel",
+        train_dataset_args={
+            "files": make_pickles(12, "train", seed=1),
+            "vertical_trim": 4,
+        },
+        val_dataset_args={"files": make_pickles(4, "val", seed=2), "vertical_trim": 4},
+        dataloader_args={"batch_size": 4, "num_workers": 0},
+        trainer_args={
+            "accelerator": "cpu",
+            "devices": 1,
+            "precision": "bf16",
+            "max_epochs": 2,
+            "enable_progress_bar": False,
+        },
+        log_dir=str(log_dir),
+        members=2,
+        shard_directory=str(tmp_path / "shards"),
+        async_checkpoints=True,
+    )
+
+    assert [m["member"] for m in summary["members"]] == [0, 1]
+    with open(log_dir / "bootstrap_summary.json") as src:
+        assert json.load(src)["members"] == summary["members"]
+
+    x = torch.randn(2, model_args["in_channels"], 40)
+    outputs = []
+    for member in summary["members"]:
+        path = member["best_model_path"]
+        assert path.startswith(str(log_dir / f"member_{member['member']}"))
+        assert os.path.isfile(path)
+        model = UNet1D.load_from_checkpoint(path, map_location="cpu").eval()
+        with torch.no_grad():
+            outputs.append(model(x))
+    # members are seeded differently and train on different draws
+    assert not torch.equal(outputs[0], outputs[1])
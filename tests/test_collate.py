@@ -0,0 +1,51 @@
+import pytest
+import torch
+
+from disco_sound import make_dataloader
+from disco_sound.datasets.beetles_data import SpectrogramDatasetMultiLabel, pad_batch
+
+
+@pytest.fixture
+def dataset(make_pickles):
+    return SpectrogramDatasetMultiLabel(make_pickles(40, "train"), vertical_trim=4)
+
+
+def expected_batches(dataset, batch_size):
+    for i in range(0, len(dataset), batch_size):
+        examples = [dataset[j] for j in range(i, min(i + batch_size, len(dataset)))]
+        yield pad_batch(examples, mask_flag=dataset.mask_flag)
+
+
+def assert_batches_equal(batch, expected):
+    features, masks, labels = batch
+    expected_features, expected_masks, expected_labels = expected
+    length = expected_features.shape[-1]
+    # batches are padded further, to a multiple of divisible_by
+    assert features.shape[-1] % 16 == 0 and features.shape[-1] >= length
+    torch.testing.assert_close(features[..., :length], expected_features)
+    assert torch.equal(masks[..., :length], expected_masks)
+    assert torch.equal(labels[..., :length], expected_labels)
+    assert masks[..., length:].all() and (labels[..., length:] == -1).all()
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_materialized_batches_are_distinct(dataset, num_workers):
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=2, num_workers=num_workers, collate_fn=dataset.collate_fn()
+    )
+    batches = list(loader)
+    assert len(batches) == 20
+    assert len({batch[0].data_ptr() for batch in batches}) == len(batches)
+    for batch, expected in zip(batches, expected_batches(dataset, 2)):
+        assert_batches_equal(batch, expected)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_training_loader_reuses_buffers(dataset, num_workers):
+    loader = make_dataloader(dataset, {"batch_size": 2, "num_workers": num_workers})
+    assert loader.collate_fn.n_buffers == 5
+    # batches used as they come, as the Trainer does, are right
+    for batch, expected in zip(loader, expected_batches(dataset, 2)):
+        assert_batches_equal(batch, expected)
+    if not num_workers:
+        assert len(loader.collate_fn._buffers) == 5
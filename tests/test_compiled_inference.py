@@ -0,0 +1,81 @@
+import pytest
+import torch
+
+import disco_sound.util.compiled_inference as compiled_inference
+from disco_sound.models.unet_1d import UNet1D
+from disco_sound.util.compiled_inference import CompiledModel, compile_model
+
+TILE_SHAPE = (4, 8, 64)
+# frozen, oneDNN-optimized graphs reorder some float sums; differences measured so far are ~3e-8
+ATOL = 1e-6
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return UNet1D(
+        in_channels=TILE_SHAPE[1],
+        out_channels=3,
+        learning_rate=1e-3,
+        mask_character=-1,
+        widths=[4, 8, 8, 8],
+    ).eval()
+
+
+@pytest.fixture(scope="module")
+def compiled(model):
+    return compile_model(model, TILE_SHAPE)
+
+
+@pytest.mark.parametrize("batch_size", [4, 3, 1, 10], ids=lambda b: f"batch_{b}")
+def test_compiled_matches_eager(model, compiled, batch_size):
+    # 4 is the compiled batch size, 3 and 1 a last partial batch, and 10 is split into 4 + 4 + 2
+    x = torch.randn(batch_size, *TILE_SHAPE[1:])
+    with torch.no_grad():
+        expected = model(x)
+        actual = compiled(x)
+    assert isinstance(compiled, CompiledModel)
+    assert actual.shape == expected.shape
+    torch.testing.assert_close(actual, expected, rtol=0, atol=ATOL)
+
+
+@pytest.mark.parametrize(
+    "shape", [(4, 8, 128), (4, 6, 64)], ids=["tile_length", "channels"]
+)
+def test_wrong_tile_shape_raises(compiled, shape):
+    with pytest.raises(ValueError, match="compiled for tiles of shape"):
+        compiled(torch.zeros(shape))
+
+
+def test_cache_hit_loads_without_tracing(model, tmp_path, monkeypatch):
+    first = compile_model(model, TILE_SHAPE, cache_directory=str(tmp_path))
+    cached = list(tmp_path.glob("*.torchscript"))
+    assert len(cached) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("a cached model was traced again")
+
+    monkeypatch.setattr(compiled_inference, "_trace", fail)
+    second = compile_model(model, TILE_SHAPE, cache_directory=str(tmp_path))
+    assert list(tmp_path.glob("*.torchscript")) == cached
+    assert not list(tmp_path.glob("*.tmp"))
+
+    x = torch.randn(6, *TILE_SHAPE[1:])
+    with torch.no_grad():
+        expected = model(x)
+        torch.testing.assert_close(first(x), expected, rtol=0, atol=ATOL)
+        torch.testing.assert_close(second(x), expected, rtol=0, atol=ATOL)
+
+
+def test_cache_key_depends_on_weights_and_tile_shape(model, tmp_path):
+    compile_model(model, TILE_SHAPE, cache_directory=str(tmp_path))
+    compile_model(model, (2, *TILE_SHAPE[1:]), cache_directory=str(tmp_path))
+
+    changed = UNet1D(**model.hparams).eval()
+    compile_model(changed, TILE_SHAPE, cache_directory=str(tmp_path))
+    assert len(list(tmp_path.glob("*.torchscript"))) == 3
+
+
+def test_unknown_backend_raises(model):
+    with pytest.raises(ValueError, match="backend must be one of"):
+        compile_model(model, TILE_SHAPE, backend="onnx")
@@ -0,0 +1,32 @@
+import torch
+
+from disco_sound.distill import student_hparams
+from disco_sound.models.unet_1d import UNet1D
+from disco_sound.prune import prune
+
+
+def test_student_of_a_pruned_teacher():
+    torch.manual_seed(0)
+    teacher = prune(
+        UNet1D(
+            in_channels=8,
+            out_channels=3,
+            learning_rate=1e-3,
+            mask_character=-1,
+            widths=[8, 16, 16, 16],
+        ),
+        0.5,
+    )
+    pruned_block_widths = teacher.block_widths
+    assert teacher.hparams["block_widths"] == pruned_block_widths
+
+    student = UNet1D(**student_hparams(teacher, [4, 8, 8, 8], 1e-2))
+    assert student.widths == [4, 8, 8, 8]
+    assert student.block_widths == student._block_widths()
+    assert student.learning_rate == 1e-2
+    assert student(torch.randn(2, 8, 32)).shape == (2, 3, 32)
+    # the teacher's hyperparameters are left alone
+    assert teacher.hparams["block_widths"] == pruned_block_widths
+
+    student = UNet1D(**student_hparams(teacher, None, 1e-2))
+    assert student.block_widths == pruned_block_widths
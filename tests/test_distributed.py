@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from disco_sound.distributed import is_distributed, rank_share, shard_dataset_args
+from disco_sound.util.shards import convert_pickles
+
+
+@pytest.fixture(autouse=True)
+def no_launcher(monkeypatch):
+    for variable in ("WORLD_SIZE", "RANK", "SLURM_PROCID", "NODE_RANK", "LOCAL_RANK"):
+        monkeypatch.delenv(variable, raising=False)
+
+
+@pytest.mark.parametrize("n, world_size", [(6, 2), (7, 3), (2, 4), (10, 1)])
+def test_rank_share_pads_cyclically(n, world_size):
+    shares = [rank_share(np.arange(n), rank, world_size) for rank in range(world_size)]
+    size = -(-n // world_size)
+    assert all(len(share) == size for share in shares)
+    # dealt out round-robin from the indices repeated as often as needed
+    dealt = np.stack(shares, axis=1).ravel()
+    np.testing.assert_array_equal(dealt, np.resize(np.arange(n), size * world_size))
+
+
+def test_bootstrap_draw_is_shared_out(make_pickles):
+    files = make_pickles(7, "train")
+    dataset_args = {"files": files, "vertical_trim": 4, "bootstrap_sample": True}
+    shares = [
+        shard_dataset_args(
+            "SpectrogramDatasetMultiLabel", dataset_args, rank, 3, seed=5
+        )["files"]
+        for rank in range(3)
+    ]
+    # every rank draws the same sample, so the shares deal out one draw
+    draw = np.random.default_rng(5).choice(files, size=len(files), replace=True)
+    dealt = [f for row in zip(*shares) for f in row]
+    assert dealt == [str(f) for f in np.resize(draw, 9)]
+    # and a different seed draws a different sample
+    other = shard_dataset_args(
+        "SpectrogramDatasetMultiLabel", dataset_args, 0, 3, seed=6
+    )["files"]
+    assert other != shares[0]
+
+
+def test_sharded_bootstrap_draw_is_shared_out(make_pickles, tmp_path):
+    convert_pickles(make_pickles(5, "extracted"), str(tmp_path / "shard"))
+    dataset_args = {"shards": str(tmp_path / "shard"), "bootstrap_sample": True}
+    shares = [
+        shard_dataset_args("ShardedSpectrogramDataset", dataset_args, rank, 2)
+        for rank in range(2)
+    ]
+    assert all("bootstrap_sample" not in args for args in shares)
+    draw = np.random.default_rng(0).integers(0, 5, 5)
+    dealt = np.stack([args["examples"] for args in shares], axis=1).ravel()
+    np.testing.assert_array_equal(dealt, np.resize(draw, 6))
+
+
+def test_only_ddp_is_distributed():
+    trainer_args = {"accelerator": "cpu", "devices": 2}
+    assert is_distributed(dict(trainer_args, strategy="ddp"))
+    assert not is_distributed(trainer_args)
+    assert not is_distributed(dict(trainer_args, strategy="ddp_spawn", devices=1))
+
+
+@pytest.mark.parametrize("strategy", ["ddp_spawn", "ddp_fork", "ddp_notebook"])
+def test_spawned_strategies_are_rejected(strategy):
+    # their processes would all train on the share of the process that built the datasets
+    with pytest.raises(ValueError, match=strategy):
+        is_distributed({"accelerator": "cpu", "devices": 2, "strategy": strategy})
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from disco_sound.util.download import (
+    PART_SUFFIX,
+    DownloadError,
+    download_file,
+    download_models,
+)
+
+CONTENT = bytes(range(256)) * 40
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.files, honoring "Range: bytes=<start>-" requests unless server.honor_range is False.
+    """
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.server.requests.append((self.path, range_header))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        if range_header is not None and self.server.honor_range:
+            start = int(re.match(r"bytes=(\d+)-$", range_header).group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"
+            )
+            body = body[start:]
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.files = {"/model.pt": CONTENT}
+    httpd.honor_range = True
+    httpd.requests = []
+    thread = threading.Thread(
+        target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def write_part(destination, data):
+    with open(destination + PART_SUFFIX, "wb") as dst:
+        dst.write(data)
+
+
+def read(path):
+    with open(path, "rb") as src:
+        return src.read()
+
+
+def test_download(server, tmp_path):
+    destination = str(tmp_path / "model.pt")
+    download_file(
+        server.url + "/model.pt",
+        destination,
+        sha256=hashlib.sha256(CONTENT).hexdigest(),
+    )
+    assert read(destination) == CONTENT
+    assert not os.path.exists(destination + PART_SUFFIX)
+    assert server.requests == [("/model.pt", None)]
+
+
+def test_resume_partial_download(server, tmp_path):
+    destination = str(tmp_path / "model.pt")
+    write_part(destination, CONTENT[:1000])
+    download_file(server.url + "/model.pt", destination)
+    assert server.requests == [("/model.pt", "bytes=1000-")]
+    assert read(destination) == CONTENT
+    assert not os.path.exists(destination + PART_SUFFIX)
+
+
+def test_restart_when_range_is_ignored(server, tmp_path):
+    server.honor_range = False
+    destination = str(tmp_path / "model.pt")
+    # garbage that would corrupt the file if it were appended to
+    write_part(destination, b"x" * 1000)
+    download_file(server.url + "/model.pt", destination)
+    assert server.requests == [("/model.pt", "bytes=1000-")]
+    assert read(destination) == CONTENT
+
+
+def test_complete_partial_download(server, tmp_path):
+    destination = str(tmp_path / "model.pt")
+    write_part(destination, CONTENT)
+    download_file(server.url + "/model.pt", destination, size=len(CONTENT))
+    assert server.requests == [("/model.pt", f"bytes={len(CONTENT)}-")]
+    assert read(destination) == CONTENT
+    assert not os.path.exists(destination + PART_SUFFIX)
+
+
+def test_sha256_mismatch(server, tmp_path):
+    destination = str(tmp_path / "model.pt")
+    with pytest.raises(DownloadError, match="sha256"):
+        download_file(server.url + "/model.pt", destination, sha256="0" * 64)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + PART_SUFFIX)
+
+
+def test_corrupt_existing_file_is_downloaded_again(server, tmp_path):
+    destination = str(tmp_path / "model.pt")
+    with open(destination, "wb") as dst:
+        dst.write(b"x" * len(CONTENT))
+    download_file(
+        server.url + "/model.pt",
+        destination,
+        sha256=hashlib.sha256(CONTENT).hexdigest(),
+    )
+    assert read(destination) == CONTENT
+
+
+def test_not_found(server, tmp_path):
+    destination = str(tmp_path / "missing.pt")
+    with pytest.raises(DownloadError, match="code 404"):
+        download_file(server.url + "/missing.pt", destination)
+    assert not os.path.exists(destination)
+
+
+def test_download_models(server, tmp_path):
+    files = {f"model_{i}.pt": bytes([i]) * (1000 + i) for i in range(5)}
+    server.files = {"/" + name: body for name, body in files.items()}
+    manifest = {
+        name: {"size": len(body), "sha256": hashlib.sha256(body).hexdigest()}
+        for name, body in files.items()
+    }
+
+    paths = download_models(
+        str(tmp_path), server.url + "/model_{}.pt", range(5), manifest, max_workers=3
+    )
+    assert paths == sorted(str(tmp_path / name) for name in files)
+    for name, body in files.items():
+        assert read(tmp_path / name) == body
+    assert sorted(path for path, _ in server.requests) == sorted(server.files)
+
+    # everything is in place, so nothing is requested again
+    server.requests.clear()
+    download_models(str(tmp_path), server.url + "/model_{}.pt", range(5), manifest)
+    assert server.requests == []
+
+
+def test_download_models_keeps_successes(server, tmp_path):
+    server.files = {"/model_0.pt": CONTENT, "/model_2.pt": CONTENT}
+    with pytest.raises(DownloadError, match="1 of 3 models"):
+        download_models(str(tmp_path), server.url + "/model_{}.pt", range(3))
+    assert read(tmp_path / "model_0.pt") == CONTENT
+    assert read(tmp_path / "model_2.pt") == CONTENT
+    assert not os.path.exists(tmp_path / "model_1.pt")
@@ -0,0 +1,247 @@
+"""
+The Intervals-based run-length encoding, heuristic and .csv code against the implementation it replaced, copied below
+from before the rewrite.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import disco_sound.util.inference_utils as infer
+from disco_sound.cfg import name_to_class_code
+from disco_sound.util.intervals import Intervals
+
+SAMPLE_RATE = 48000
+HOP_LENGTH = 200
+HEADER = "Selection,View,Channel,Begin Time (s),End Time (s),Low Freq (Hz),High Freq (Hz),Sound_Type\n"
+
+
+def legacy_aggregate_predictions(predictions):
+    diff = np.diff(predictions)
+    (idx,) = diff.nonzero()
+    current_class = predictions[0]
+    current_idx = 0
+    class_idx_to_prediction_start_and_end = []
+
+    if len(idx) == 0:
+        dct = {
+            "class": current_class,
+            "start": current_idx,
+            "end": predictions.shape[-1],
+        }
+        class_idx_to_prediction_start_and_end.append(dct)
+
+    else:
+        for i in range(len(idx)):
+            dct = {"class": current_class, "start": current_idx, "end": idx[i]}
+            class_idx_to_prediction_start_and_end.append(dct)
+            current_class = predictions[idx[i] + 1]
+            current_idx = idx[i] + 1
+
+    return class_idx_to_prediction_start_and_end
+
+
+def legacy_remove_a_chirps_in_between_b_chirps(
+    predictions, iqr, name_to_class_code, return_preds=True
+):
+    transitions = legacy_aggregate_predictions(predictions)
+    new_list = []
+    for t in transitions:
+        x = t.copy()
+        if (
+            t["end"] - t["start"] <= 20
+            and t["class"] != name_to_class_code["BACKGROUND"]
+        ):
+            predictions[t["start"] : t["end"] + 1] = name_to_class_code["BACKGROUND"]
+            x["class"] = name_to_class_code["BACKGROUND"]
+            new_list.append(x)
+
+    for i in range(1, len(transitions) - 1):
+        current_dct = transitions[i]
+        current_class = current_dct["class"]
+        if (
+            current_class == name_to_class_code["A"]
+            and transitions[i - 1]["class"] == name_to_class_code["B"]
+            and transitions[i + 1]["class"] == name_to_class_code["B"]
+        ):
+            predictions[current_dct["start"] : current_dct["end"]] = name_to_class_code[
+                "BACKGROUND"
+            ]
+        new_list.append(current_dct)
+
+    if return_preds:
+        return predictions
+    else:
+        return new_list
+
+
+def legacy_save_csv_from_predictions(output_csv_path, predictions):
+    class_idx_to_prediction_start_end = legacy_remove_a_chirps_in_between_b_chirps(
+        predictions, None, name_to_class_code, return_preds=False
+    )
+    class_code_to_name = {v: k for k, v in name_to_class_code.items()}
+    list_of_dicts_for_dataframe = []
+    i = 1
+    for class_to_start_and_end in class_idx_to_prediction_start_end:
+        end = class_to_start_and_end["end"]
+        start = class_to_start_and_end["start"]
+
+        dataframe_dict = {
+            "Selection": i,
+            "View": 0,
+            "Channel": 0,
+            "Begin Time (s)": infer.convert_spectrogram_index_to_seconds(
+                start, hop_length=HOP_LENGTH, sample_rate=SAMPLE_RATE
+            ),
+            "End Time (s)": infer.convert_spectrogram_index_to_seconds(
+                end, hop_length=HOP_LENGTH, sample_rate=SAMPLE_RATE
+            ),
+            "Low Freq (Hz)": 0,
+            "High Freq (Hz)": 0,
+            "Sound_Type": class_code_to_name[class_to_start_and_end["class"]],
+        }
+
+        list_of_dicts_for_dataframe.append(dataframe_dict)
+        i += 1
+
+    pd.DataFrame.from_dict(list_of_dicts_for_dataframe).to_csv(
+        output_csv_path, index=False
+    )
+
+
+def runs(*lengths_and_classes):
+    return np.concatenate(
+        [np.full(length, c, dtype=np.int64) for length, c in lengths_and_classes]
+    )
+
+
+A, B, BACKGROUND = (name_to_class_code[c] for c in ("A", "B", "BACKGROUND"))
+
+EDGE_CASES = {
+    "single_element": runs((1, A)),
+    "single_short_run": runs((20, A)),
+    "single_run_of_21": runs((21, B)),
+    "all_background": runs((500, BACKGROUND)),
+    "all_one_class": runs((500, B)),
+    "two_runs": runs((300, A), (200, BACKGROUND)),
+    "short_runs_at_both_ends": runs((3, A), (100, BACKGROUND), (5, B)),
+    "long_runs_at_both_ends": runs((50, B), (100, BACKGROUND), (50, A)),
+    "run_lengths_around_the_threshold": runs(
+        (20, A), (21, B), (22, A), (23, BACKGROUND), (21, A), (22, B), (30, A)
+    ),
+    "a_in_between_bs": runs((40, B), (30, A), (40, B), (5, BACKGROUND)),
+    "a_in_between_bs_at_the_end": runs((40, B), (30, A), (40, B)),
+    "a_in_between_bs_at_the_start": runs((30, A), (40, B), (30, A), (40, B), (9, A)),
+    "short_a_in_between_bs": runs((40, B), (10, A), (40, B), (40, A), (40, B), (2, A)),
+}
+
+
+def random_predictions(seed):
+    rng = np.random.default_rng(seed)
+    kind = seed % 3
+    if kind == 0:
+        # noisy, mostly one-element runs
+        return rng.integers(0, 3, rng.integers(1, 400))
+    n_runs = rng.integers(1, 60)
+    lengths = rng.integers(1, 60, n_runs)
+    if kind == 1:
+        classes = rng.integers(0, 3, n_runs)
+    else:
+        # mostly B/A/B patterns
+        classes = rng.choice([A, B, B, BACKGROUND], n_runs)
+    return np.repeat(classes, lengths).astype(np.int64)
+
+
+CASES = [pytest.param(p, id=name) for name, p in EDGE_CASES.items()] + [
+    pytest.param(random_predictions(seed), id=f"random_{seed}") for seed in range(150)
+]
+
+
+@pytest.mark.parametrize("predictions", CASES)
+def test_from_predictions_round_trip(predictions):
+    intervals = Intervals.from_predictions(predictions)
+    assert np.all(intervals.lengths > 0)
+    assert np.all(intervals.classes[1:] != intervals.classes[:-1])
+    np.testing.assert_array_equal(
+        intervals.to_predictions(len(predictions), -1), predictions
+    )
+
+
+@pytest.mark.parametrize("predictions", CASES)
+def test_aggregate_predictions_matches_legacy(predictions):
+    assert infer.aggregate_predictions(predictions) == legacy_aggregate_predictions(
+        predictions
+    )
+
+
+@pytest.mark.parametrize("predictions", CASES)
+def test_remove_a_chirps_in_between_b_chirps_matches_legacy(predictions):
+    legacy_predictions = predictions.copy()
+    legacy_rows = legacy_remove_a_chirps_in_between_b_chirps(
+        legacy_predictions, None, name_to_class_code, return_preds=False
+    )
+
+    new_predictions = predictions.copy()
+    rows = infer.remove_a_chirps_in_between_b_chirps(
+        new_predictions, None, name_to_class_code, return_preds=False
+    )
+    assert rows == legacy_rows
+    np.testing.assert_array_equal(new_predictions, legacy_predictions)
+
+    # with return_preds, the same array is edited in place and returned
+    returned_predictions = predictions.copy()
+    returned = infer.remove_a_chirps_in_between_b_chirps(
+        returned_predictions, None, name_to_class_code
+    )
+    assert returned is returned_predictions
+    np.testing.assert_array_equal(returned, legacy_predictions)
+
+
+@pytest.mark.parametrize("predictions", CASES)
+def test_save_csv_from_intervals_matches_legacy(predictions, tmp_path):
+    legacy_csv = tmp_path / "legacy.csv"
+    legacy_save_csv_from_predictions(legacy_csv, predictions.copy())
+
+    rows = infer.remove_a_chirps_in_between_b_chirps(
+        predictions.copy(), None, name_to_class_code, return_preds=False
+    )
+    intervals = Intervals(
+        [r["start"] for r in rows],
+        [r["end"] for r in rows],
+        np.array([r["class"] for r in rows], dtype=predictions.dtype),
+    )
+    csv = tmp_path / "new.csv"
+    infer.save_csv_from_intervals(
+        str(csv), intervals, SAMPLE_RATE, HOP_LENGTH, name_to_class_code
+    )
+    if rows:
+        assert csv.read_bytes() == legacy_csv.read_bytes()
+    else:
+        # the one documented difference: a .csv with no rows holds the header instead of a bare newline
+        assert legacy_csv.read_text() == "\n"
+        assert csv.read_text() == HEADER
+
+
+def test_empty_predictions(tmp_path):
+    """
+    The legacy code raised IndexError on empty predictions. The Intervals path gives no runs, leaves the array alone
+    and writes a .csv holding only the header (the legacy code's empty DataFrame would have written a bare newline).
+    """
+    predictions = np.zeros(0, dtype=np.int64)
+    with pytest.raises(IndexError):
+        legacy_aggregate_predictions(predictions)
+
+    assert len(Intervals.from_predictions(predictions)) == 0
+    assert infer.aggregate_predictions(predictions) == []
+    assert (
+        infer.remove_a_chirps_in_between_b_chirps(
+            predictions, None, name_to_class_code, return_preds=False
+        )
+        == []
+    )
+
+    csv = tmp_path / "empty.csv"
+    df = infer.save_csv_from_predictions(
+        str(csv), predictions, SAMPLE_RATE, HOP_LENGTH, name_to_class_code
+    )
+    assert len(df) == 0
+    assert csv.read_text() == HEADER
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import torch
+
+from disco_sound.models.unet_1d import UNet1D
+from disco_sound.util.receptive_field import (
+    _is_seamless,
+    receptive_field,
+    seamless_tiling,
+)
+
+LENGTH = 512
+# far from the edges, so every output frame's receptive field fits in the sequence
+MARGIN = 128
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return UNet1D(
+        in_channels=8, out_channels=3, learning_rate=1e-3, mask_character=-1
+    ).eval()
+
+
+@pytest.fixture(scope="module")
+def reach(model):
+    """
+    Perturb each input column of a random sequence in turn and record which output frames change.
+    :return: tuple (np.array, np.array). The most columns to the left and to the right of an output frame whose
+    perturbation changed it, indexed by the frame's position modulo divisible_by, over frames away from the edges;
+    and a (column x frame) boolean array of the changes.
+    """
+    torch.manual_seed(1)
+    x = torch.randn(1, model.in_channels, LENGTH)
+    perturbed = x.repeat(LENGTH, 1, 1)
+    perturbed[torch.arange(LENGTH), :, torch.arange(LENGTH)] += 100.0
+
+    changed = []
+    with torch.no_grad():
+        # the unperturbed sequence goes in every batch: a batch's size can change the convolutions' rounding
+        for batch in perturbed.split(63):
+            out = model(torch.cat([x, batch]))
+            changed.append((out[1:] != out[0]).any(dim=1))
+    changed = torch.cat(changed).numpy()
+
+    alignment = model.divisible_by
+    left = np.zeros(alignment, dtype=int)
+    right = np.zeros(alignment, dtype=int)
+    columns, frames = np.nonzero(changed)
+    interior = (frames >= MARGIN) & (frames < LENGTH - MARGIN)
+    for column, frame in zip(columns[interior], frames[interior]):
+        residue = frame % alignment
+        left[residue] = max(left[residue], frame - column)
+        right[residue] = max(right[residue], column - frame)
+    return left, right, changed
+
+
+def test_perturbations_stay_within_the_receptive_field(model, reach):
+    left, right = receptive_field(model)
+    changed = reach[2]
+    columns, frames = np.nonzero(changed)
+    residues = frames % model.divisible_by
+    assert np.all(frames - columns <= left[residues])
+    assert np.all(columns - frames <= right[residues])
+
+
+def test_receptive_field_is_tight(model, reach):
+    # some perturbation at the edge of every frame's receptive field changes it
+    left, right = receptive_field(model)
+    np.testing.assert_array_equal(reach[0], left)
+    np.testing.assert_array_equal(reach[1], right)
+
+
+def test_smallest_seamless_overlap(model):
+    left, right = receptive_field(model)
+    assert seamless_tiling([model], 1024) == (1024, 96)
+    # smaller overlaps on the pooling grid keep frames whose receptive field reaches past the tile
+    for tile_overlap in (80, 88):
+        assert not _is_seamless(left, right, 1024, tile_overlap)
+    assert _is_seamless(left, right, 1024, 96)
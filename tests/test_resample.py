@@ -0,0 +1,40 @@
+import pytest
+import torch
+import torchaudio
+
+from disco_sound.util.resample import Resampler
+
+RATES = [(44100, 48000), (48000, 44100), (96000, 48000), (22050, 48000), (8000, 11025)]
+
+
+@pytest.fixture(scope="module")
+def waveform():
+    torch.manual_seed(0)
+    return 4 * torch.randn(2, 30011)
+
+
+@pytest.mark.parametrize("orig_freq, new_freq", RATES)
+@pytest.mark.parametrize("chunk_size", [2**20, 1000, 4097])
+def test_matches_torchaudio(waveform, orig_freq, new_freq, chunk_size):
+    resampled = Resampler(orig_freq, new_freq, chunk_size=chunk_size)(waveform)
+    expected = torchaudio.functional.resample(waveform, orig_freq, new_freq)
+    assert resampled.shape == expected.shape
+    # the same filter, summed in a different order, so equal up to float32 rounding over its many taps
+    torch.testing.assert_close(
+        resampled, expected, rtol=0, atol=3e-5 * float(waveform.abs().max())
+    )
+    # and at least as close as torchaudio's to the float64 result
+    exact = torchaudio.functional.resample(waveform.double(), orig_freq, new_freq)
+    error = (resampled.double() - exact).abs().max()
+    assert error <= 1.5 * (expected.double() - exact).abs().max()
+
+
+def test_stream_matches_whole_waveform(waveform):
+    resampler = Resampler(44100, 48000)
+    chunks = waveform[None].split([1, 4000, 9999, 16011], dim=-1)
+    streamed = torch.cat(list(resampler.stream(chunks)), dim=-1)
+    torch.testing.assert_close(streamed, resampler(waveform[None]))
+
+
+def test_same_rate_is_unchanged(waveform):
+    assert Resampler(48000, 48000)(waveform) is waveform
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from disco_sound.datasets.beetles_data import (
+    ShardedSpectrogramDataset,
+    SpectrogramDatasetMultiLabel,
+)
+from disco_sound.util.shards import convert_pickles
+
+
+@pytest.mark.parametrize("mask_beginning_and_end", [False, True])
+def test_sharded_dataset_matches_pickles(
+    make_pickles, tmp_path, mask_beginning_and_end
+):
+    pickles = make_pickles(3, "extracted")
+    args = dict(
+        vertical_trim=4,
+        mask_beginning_and_end=mask_beginning_and_end,
+        begin_mask=5,
+        end_mask=5,
+    )
+    convert_pickles(pickles, str(tmp_path / "shard"))
+    sharded = ShardedSpectrogramDataset(str(tmp_path / "shard"), **args)
+    unsharded = SpectrogramDatasetMultiLabel(pickles, **args)
+
+    assert len(sharded) == len(unsharded)
+    for i in range(len(sharded)):
+        features, labels = sharded[i]
+        expected_features, expected_labels = unsharded[i]
+        # nll_loss needs int64 targets; shards store int16
+        assert labels.dtype == torch.int64
+        assert torch.equal(labels, expected_labels)
+        torch.testing.assert_close(features, expected_features)
@@ -0,0 +1,84 @@
+import math
+
+import pandas as pd
+import pytest
+import torch
+from pytorch_lightning import Trainer
+from pytorch_lightning.loggers import CSVLogger
+
+from disco_sound.callbacks import CallbackSet, monitors_throughput
+from disco_sound.datasets.beetles_data import PadCollate
+from disco_sound.models.unet_1d import UNet1D
+
+
+def examples(n, seed):
+    generator = torch.Generator().manual_seed(seed)
+    data = []
+    for _ in range(n):
+        length = int(torch.randint(20, 60, (1,), generator=generator))
+        labels = torch.randint(0, 3, (1,), generator=generator).repeat(length)
+        features = torch.randn(16, length, generator=generator) + labels.float()
+        data.append((features, labels))
+    return data
+
+
+def loader(data):
+    return torch.utils.data.DataLoader(
+        data, batch_size=4, collate_fn=PadCollate(mask_flag=-1)
+    )
+
+
+@pytest.mark.parametrize("precision", [32, "bf16"])
+def test_fit_with_throughput_monitor(tmp_path, precision):
+    torch.manual_seed(0)
+    CallbackSet.reset()
+    model = UNet1D(
+        in_channels=16,
+        out_channels=3,
+        learning_rate=1e-3,
+        mask_character=-1,
+        widths=[4, 8, 8, 8],
+    )
+    trainer = Trainer(
+        accelerator="cpu",
+        devices=1,
+        precision=precision,
+        max_epochs=2,
+        log_every_n_steps=2,
+        callbacks=CallbackSet.callbacks(),
+        logger=CSVLogger(str(tmp_path)),
+        default_root_dir=str(tmp_path),
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(model, loader(examples(24, 1)), loader(examples(8, 2)))
+
+    # bf16 autocasts the convolutions; the weights and the loss stay float32
+    assert all(p.dtype == torch.float32 for p in model.parameters())
+    metrics = pd.read_csv(trainer.logger.experiment.metrics_file_path)
+    for name in ("train_loss", "train_acc", "val_loss", "val_acc"):
+        values = metrics[name].dropna()
+        assert len(values) == 2
+        assert all(math.isfinite(v) for v in values)
+    assert (metrics["train_acc"].dropna().between(0, 1)).all()
+    for name in ("samples_per_s", "frames_per_s", "forward_s", "backward_s"):
+        values = metrics[f"throughput/{name}"].dropna()
+        assert len(values) > 0 and (values > 0).all()
+    assert CallbackSet.checkpoint_callback.best_model_path
+
+
+def test_throughput_monitor_is_left_out_of_gpu_training(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    assert not monitors_throughput({"accelerator": "gpu"})
+    assert not monitors_throughput({"accelerator": "auto"})
+    assert monitors_throughput({"accelerator": "cpu"})
+    assert monitors_throughput({"accelerator": "gpu"}, throughput_monitor=True)
+    assert not monitors_throughput({"accelerator": "cpu"}, throughput_monitor=False)
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: False)
+    assert monitors_throughput({})
+
+    CallbackSet.reset()
+    assert CallbackSet.throughput_monitor in CallbackSet.callbacks()
+    callbacks = CallbackSet.callbacks(throughput_monitor=False)
+    assert CallbackSet.throughput_monitor not in callbacks
+    assert CallbackSet.checkpoint_callback in callbacks